@@ -6,3 +6,5 @@ configs.deterministic = False
 # data configs
 configs.data = Config()
 configs.data.num_workers = 16
+# build each batch in one worker call with vectorized sampling (frustum datasets only)
+configs.data.batched_loading = False
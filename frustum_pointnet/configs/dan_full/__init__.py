@@ -3,9 +3,15 @@ from utils.config import Config, configs
 # data configs
 configs.data.classes = ('Car',)
 configs.data.num_classes = len(configs.data.classes)
+# target samples per source sample in a training step (node alignment trainers need 1)
+configs.data.domain_ratio = 1.0
+# training steps copied to the device ahead of the current one
+configs.data.num_prefetch = 2
 
 # evaluate configs
 configs.evaluate = Config()
 configs.evaluate.num_tests = 20
+# draw the num_tests resamplings in one pass and one forward per batch
+configs.evaluate.single_forward = False
 configs.evaluate.ground_truth_path = 'data/kitti/ground_truth'
 configs.evaluate.image_id_file_path = 'data/kitti/image_sets/val.txt'
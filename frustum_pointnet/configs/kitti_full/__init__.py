@@ -7,5 +7,7 @@ configs.data.num_classes = len(configs.data.classes)
 # evaluate configs
 configs.evaluate = Config()
 configs.evaluate.num_tests = 20
+# draw the num_tests resamplings in one pass and one forward per batch
+configs.evaluate.single_forward = False
 configs.evaluate.ground_truth_path = 'data/kitti/ground_truth'
 configs.evaluate.image_id_file_path = 'data/kitti/image_sets/val.txt'
@@ -0,0 +1,17 @@
+from datasets.vkitti import FrustumVkittiFrames
+from utils.config import Config, configs
+
+# dataset configs: crop the frustums from the frame stores of generate_vkitti_frustum.py --gen_frames at training
+# time, with fresh 2D box perturbations every epoch; use on top of a model config, e.g.,
+#   python train_vkitti.py configs/vkitti/frustum/pointnet.py configs/vkitti/frustum/frames.py
+configs.dataset = Config(FrustumVkittiFrames)
+configs.dataset.root = 'data/vkitti/frustum/frustum_data'
+configs.dataset.num_points = 1024
+configs.dataset.classes = configs.data.classes
+configs.dataset.num_heading_angle_bins = configs.data.num_heading_angle_bins
+configs.dataset.class_name_to_size_template_id = configs.data.class_name_to_size_template_id
+configs.dataset.perturb_box2d = True
+configs.dataset.augment_x = 5
+configs.dataset.random_flip = True
+configs.dataset.random_shift = True
+configs.dataset.frustum_rotate = True
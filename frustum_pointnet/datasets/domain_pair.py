@@ -0,0 +1,139 @@
+import collections
+
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
+
+__all__ = ['PairedDomainLoader']
+
+
+class PairedDomainDataset(Dataset):
+    def __init__(self, source, target, batched_loading=False):
+        """
+        Dataset of (source, target) batch pairs, indexed by a pair of index lists
+        :param source: source domain dataset
+        :param target: target domain dataset, only its inputs are returned since adaptation does not use its labels.
+                       They are built by target.get_inputs if it has one, which skips the labels altogether
+        :param batched_loading: bool, whether the datasets build a batch from a list of indices themselves
+        """
+        self.source = source
+        self.target = target
+        self.batched_loading = batched_loading
+
+    def __len__(self):
+        return len(self.source)
+
+    def get_batch(self, dataset, indices):
+        if self.batched_loading:
+            return dataset[indices]
+        return default_collate([dataset[index] for index in indices])
+
+    def get_inputs(self, dataset, indices):
+        if hasattr(dataset, 'get_inputs'):
+            return dataset.get_inputs(indices)
+        inputs, _ = self.get_batch(dataset, indices)
+        return inputs
+
+    def __getitem__(self, indices):
+        source_indices, target_indices = indices
+        return self.get_batch(self.source, source_indices), self.get_inputs(self.target, target_indices)
+
+
+class PairedBatchSampler(Sampler):
+    def __init__(self, source_size, target_size, source_batch_size, target_batch_size):
+        """
+        Endless sampler of (source indices, target indices) batch pairs.
+        Each domain is reshuffled on its own whenever a pass over it ends, dropping its last incomplete batch.
+        :param source_size: int, #source samples
+        :param target_size: int, #target samples
+        :param source_batch_size: int
+        :param target_batch_size: int
+        """
+        assert source_size >= source_batch_size and target_size >= target_batch_size
+        self.source_size = source_size
+        self.target_size = target_size
+        self.source_batch_size = source_batch_size
+        self.target_batch_size = target_batch_size
+
+    @staticmethod
+    def shuffled_batches(size, batch_size):
+        while True:
+            permutation = torch.randperm(size).tolist()
+            for start in range(0, size - batch_size + 1, batch_size):
+                yield permutation[start:start + batch_size]
+
+    def __iter__(self):
+        source_batches = self.shuffled_batches(self.source_size, self.source_batch_size)
+        target_batches = self.shuffled_batches(self.target_size, self.target_batch_size)
+        while True:
+            yield next(source_batches), next(target_batches)
+
+
+def apply_to_tensors(batch, fn):
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, dict):
+        return {k: apply_to_tensors(v, fn) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(apply_to_tensors(v, fn) for v in batch)
+    return batch
+
+
+class PairedDomainLoader:
+    def __init__(self, source, target, batch_size, domain_ratio=1.0, num_prefetch=2, batched_loading=False,
+                 device='cuda', **kwargs):
+        """
+        Loader of ((inputs, targets), inputs_t) source/target batch pairs for domain adaptation training.
+        Both domains are loaded by one pool of DataLoader workers over an endless sampler, so the workers are started
+        once and kept across epochs; every epoch yields len(source) // batch_size pairs from the same iterator.
+        Pairs are copied to the device num_prefetch steps ahead from pinned memory, on a side stream on cuda.
+        :param source: source domain dataset
+        :param target: target domain dataset
+        :param batch_size: int, #source samples per step
+        :param domain_ratio: float, #target samples per source sample in a step
+        :param num_prefetch: int, #steps copied to the device ahead of the current one
+        :param batched_loading: bool, whether the datasets build a batch from a list of indices themselves
+        :param device: device the batches are copied to
+        :param kwargs: other DataLoader arguments (num_workers, worker_init_fn, ...)
+        """
+        self.batch_size = batch_size
+        self.target_batch_size = max(1, int(round(batch_size * domain_ratio)))
+        self.num_steps = len(source) // batch_size
+        self.num_prefetch = num_prefetch
+        # batch_size=None disables auto-collation: the sampled index pairs are passed to the dataset as they are
+        self.loader = DataLoader(PairedDomainDataset(source, target, batched_loading=batched_loading),
+                                 batch_size=None, pin_memory=True,
+                                 sampler=PairedBatchSampler(len(source), len(target),
+                                                            self.batch_size, self.target_batch_size), **kwargs)
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        self._iterator = None
+        self._prefetched = collections.deque()
+
+    def __len__(self):
+        return self.num_steps
+
+    def prefetch(self):
+        batch = next(self._iterator)
+        if self.stream is None:
+            self._prefetched.append((apply_to_tensors(batch, lambda t: t.to(self.device)), None))
+            return
+        with torch.cuda.stream(self.stream):
+            batch = apply_to_tensors(batch, lambda t: t.to(self.device, non_blocking=True))
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        self._prefetched.append((batch, copied))
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        for _ in range(self.num_steps):
+            while len(self._prefetched) <= self.num_prefetch:
+                self.prefetch()
+            batch, copied = self._prefetched.popleft()
+            if copied is not None:
+                current_stream = torch.cuda.current_stream()
+                current_stream.wait_event(copied)
+                # tensors allocated on the side stream must not be reused before the current stream is done with them
+                apply_to_tensors(batch, lambda t: t.record_stream(current_stream))
+            yield batch
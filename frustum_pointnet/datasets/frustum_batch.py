@@ -0,0 +1,114 @@
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+
+from datasets.frustum_store import gather_ragged, ragged_lengths, take_rows
+
+__all__ = ['get_frustum_batch', 'batched_data_loader']
+
+
+def batched_data_loader(dataset, batch_size, shuffle=False, drop_last=False, **kwargs):
+    """
+    DataLoader whose workers receive the indices of a whole batch and build it with one dataset[indices] call
+    :param dataset: dataset whose __getitem__ accepts a list of indices and returns a collated batch
+    :param batch_size: int
+    :param shuffle: bool, whether to reshuffle the indices every epoch
+    :param drop_last: bool, whether to drop the last incomplete batch
+    :param kwargs: other DataLoader arguments (num_workers, pin_memory, worker_init_fn, ...)
+    :return: DataLoader
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    # batch_size=None disables auto-collation: the batch sampler indices are passed to the dataset as they are
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last), **kwargs)
+
+
+def angle_to_bin_id(angles, num_angle_bins):
+    """
+    Batched version of _FrustumKittiDataset.angle_to_bin_id
+    :param angles: numpy array (B,), unit: rad
+    :param num_angle_bins: int, #angle bins
+    :return:
+        bin_ids: numpy array (B,) int64
+        angle_residuals: numpy array (B,), bin_id * (2pi/N) + angle_residual = angle
+    """
+    angles = angles % (2 * np.pi)
+    angle_per_bin = 2 * np.pi / float(num_angle_bins)
+    shifted_angles = (angles + angle_per_bin / 2) % (2 * np.pi)
+    bin_ids = (shifted_angles / angle_per_bin).astype(np.int64)
+    angle_residuals = shifted_angles - (bin_ids * angle_per_bin + angle_per_bin / 2)
+    return bin_ids, angle_residuals
+
+
+def get_frustum_batch(dataset, indices, class_name_to_size_template, inputs_only=False):
+    """
+    Vectorized _FrustumKittiDataset.__getitem__ over a batch: resampling, random flip/shift and heading binning each
+    run as one array operation over the batch.
+    :param dataset: _FrustumKittiDataset or _FrustumVkittiDataset
+    :param indices: list of frustum ids
+    :param class_name_to_size_template: dict, class name to size template (3,)
+    :param inputs_only: bool, only build the inputs, e.g., of target domain batches whose labels are not used
+    :return: (inputs, targets) dicts of batched tensors, as the default collate would stack them, or inputs only
+    """
+    data = dataset.data
+    indices = np.asarray(indices, dtype=np.int64)
+    batch_size, num_points = len(indices), dataset.num_points
+
+    rotation_angles = np.pi / 2.0 + take_rows(data.frustum_rotation_angles, indices).astype(np.float64)
+    class_names = [data.class_names[i] for i in indices]
+    class_ids = np.array([dataset.class_name_to_class_id[c] for c in class_names], dtype=np.int64)
+    one_hot_vectors = np.eye(dataset.num_classes, dtype=np.float32)[class_ids]
+
+    # resample num_points points per frustum with replacement, frustum-rotated clouds are precomputed
+    point_column = data.rotated_point_clouds if dataset.frustum_rotate else data.point_clouds
+    choice = (np.random.random((batch_size, num_points)) *
+              ragged_lengths(point_column, indices)[:, None]).astype(np.int64)
+    point_clouds = gather_ragged(point_column, indices, choice)  # (B, N, C), a copy
+
+    if dataset.from_rgb_detection:
+        features = np.empty((batch_size, point_clouds.shape[2], num_points), dtype=np.float32)
+        features[...] = point_clouds.transpose(0, 2, 1)
+        inputs = {'features': torch.from_numpy(features), 'one_hot_vectors': torch.from_numpy(one_hot_vectors)}
+        if inputs_only:
+            return inputs
+        return inputs, \
+               {'rotation_angle': torch.from_numpy(rotation_angles.astype(np.float32)),
+                'rgb_score': torch.from_numpy(take_rows(data.probs, indices))}
+
+    heading_angles = take_rows(data.heading_angles, indices).astype(np.float64)
+    if dataset.frustum_rotate:
+        centers = take_rows(data.rotated_centers, indices).astype(np.float64)
+        heading_angles -= rotation_angles
+    else:
+        boxes_3d = take_rows(data.boxes_3d, indices)
+        centers = (boxes_3d[:, 0, :] + boxes_3d[:, 6, :]) / 2.0
+
+    # Data Augmentation
+    if dataset.random_flip:
+        # note: rotation_angle won't be correct if we have random_flip so do not use it in case of random flipping
+        flip = np.random.random(batch_size) > 0.5  # 50% chance flipping
+        point_clouds[flip, :, 0] = -point_clouds[flip, :, 0]
+        centers[flip, 0] = -centers[flip, 0]
+        heading_angles[flip] = np.pi - heading_angles[flip]
+    if dataset.random_shift:
+        dist = np.sqrt(centers[:, 0] ** 2 + centers[:, 1] ** 2)
+        shift = np.clip(np.random.randn(batch_size) * dist * 0.05, dist * 0.8, dist * 1.2)
+        point_clouds[:, :, 2] += shift[:, None]
+        centers[:, 2] += shift
+
+    features = np.empty((batch_size, point_clouds.shape[2], num_points), dtype=np.float32)
+    features[...] = point_clouds.transpose(0, 2, 1)
+    inputs = {'features': torch.from_numpy(features), 'one_hot_vectors': torch.from_numpy(one_hot_vectors)}
+    if inputs_only:
+        return inputs
+
+    mask_logits = gather_ragged(data.mask_logits, indices, choice).astype(np.int64)
+    heading_bin_ids, heading_residuals = angle_to_bin_id(heading_angles, dataset.num_heading_angle_bins)
+    size_template_ids = np.array([dataset.class_name_to_size_template_id[c] for c in class_names], dtype=np.int64)
+    size_residuals = take_rows(data.sizes, indices) - np.stack([class_name_to_size_template[c] for c in class_names])
+    return inputs, \
+           {'mask_logits': torch.from_numpy(mask_logits), 'center': torch.from_numpy(centers.astype(np.float32)),
+            'heading_bin_id': torch.from_numpy(heading_bin_ids),
+            'heading_residual': torch.from_numpy(heading_residuals.astype(np.float32)),
+            'size_template_id': torch.from_numpy(size_template_ids),
+            'size_residual': torch.from_numpy(size_residuals.astype(np.float32)),
+            'class_id': torch.from_numpy(class_ids), 'rotation_angle': torch.from_numpy(rotation_angles.astype(np.float32))}
@@ -0,0 +1,303 @@
+import bisect
+import json
+import os
+import pickle
+
+import numpy as np
+
+from utils.container import G
+
+__all__ = ['load_frustums', 'take_rows', 'ragged_lengths', 'gather_ragged', 'rotate_batch_along_y',
+           'FRUSTUM_FIELDS', 'RGB_DETECTION_FIELDS', 'ROTATED_FIELDS']
+
+# fields of a frustum pickle, in dump order (see preprocessing/frustum_store.py)
+FRUSTUM_FIELDS = ['ids', 'boxes_2d', 'boxes_3d', 'point_clouds', 'mask_logits',
+                  'class_names', 'heading_angles', 'sizes', 'frustum_rotation_angles']
+RGB_DETECTION_FIELDS = ['ids', 'boxes_2d', 'point_clouds', 'class_names',
+                        'frustum_rotation_angles', 'probs']
+# frustum-rotated point clouds and box centers, see attach_rotated_columns
+ROTATED_FIELDS = ['rotated_point_clouds', 'rotated_centers']
+
+STORE_SUFFIX = '.frustums'
+META_FILE = 'meta.json'
+OFFSETS_FILE = 'offsets.bin'
+
+
+class MemmapColumn:
+    def __init__(self, filename, dtype, shape):
+        """
+        Raw row-major column of a frustum store, memory-mapped on first access.
+        The mapping is not pickled, so every DataLoader worker maps the file itself and
+        all workers share the page cache instead of holding copies of the data.
+        :param filename: path of the column file
+        :param dtype: numpy dtype of the column
+        :param shape: tuple, shape of the column, first dim is #rows
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            if self.shape[0] == 0:
+                self._array = np.zeros(self.shape, dtype=self.dtype)
+            else:
+                self._array = np.asarray(np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape))
+        return self._array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+
+class RaggedColumn:
+    def __init__(self, values, offsets):
+        """
+        Ragged column, item i is the read-only view values[offsets[i]:offsets[i+1]]
+        :param values: MemmapColumn, rows of all items
+        :param offsets: MemmapColumn, (#items + 1,) int64 row offsets
+        """
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values.array[self.offsets[index]:self.offsets[index + 1]]
+
+
+class CategoricalColumn:
+    def __init__(self, codes, categories):
+        """
+        :param codes: MemmapColumn, integer code of each item
+        :param categories: list of str, category of each code
+        """
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.categories[self.codes[index]]
+
+
+class ConcatColumn:
+    def __init__(self, columns):
+        """
+        Concatenation of columns (e.g., of the per-scene stores of a split) without copying
+        :param columns: list of indexable columns
+        """
+        self.columns = columns
+        self.cumulative_sizes = np.cumsum([len(c) for c in columns]).tolist()
+
+    def __len__(self):
+        return self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        column_id = bisect.bisect_right(self.cumulative_sizes, index)
+        if column_id > 0:
+            index -= self.cumulative_sizes[column_id - 1]
+        return self.columns[column_id][index]
+
+
+class RotatedColumn:
+    def __init__(self, column, rotation_angles):
+        """
+        Ragged point column rotated along y on access, for stores without materialized rotated_point_clouds
+        :param column: RaggedColumn of points
+        :param rotation_angles: numpy array (#items,), from z to x axis, unit: rad
+        """
+        self.column = column
+        self.rotation_angles = rotation_angles
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, index):
+        points = np.array(self.column[index])
+        return rotate_batch_along_y(points[None], self.rotation_angles[index:index + 1])[0]
+
+
+def rotate_batch_along_y(points, rotation_angles):
+    """
+    Batched _FrustumKittiDataset.rotate_points_along_y, in place
+    :param points: numpy array (B, N, C), first 3 channels are XYZ-coords
+    :param rotation_angles: numpy array (B,), from z to x axis, unit: rad
+    :return:
+        points: numpy array (B, N, C) with [0, 2] rotated
+    """
+    v_cos = np.cos(rotation_angles)[:, None]
+    v_sin = np.sin(rotation_angles)[:, None]
+    x = points[:, :, 0].copy()
+    z = points[:, :, 2]
+    points[:, :, 0] = x * v_cos - z * v_sin
+    points[:, :, 2] = x * v_sin + z * v_cos
+    return points
+
+
+def _split_concat(column, indices):
+    """
+    Yield (sub-column, local indices, positions in indices) for the sub-columns of a ConcatColumn
+    """
+    starts = np.concatenate([[0], column.cumulative_sizes[:-1]]).astype(np.int64)
+    column_ids = np.searchsorted(column.cumulative_sizes, indices, side='right')
+    for column_id in np.unique(column_ids):
+        positions = np.flatnonzero(column_ids == column_id)
+        yield column.columns[column_id], indices[positions] - starts[column_id], positions
+
+
+def _concat_gather(column, indices, fn, *args):
+    parts, positions = [], []
+    for sub_column, sub_indices, sub_positions in _split_concat(column, indices):
+        parts.append(fn(sub_column, sub_indices, *(arg[sub_positions] for arg in args)))
+        positions.append(sub_positions)
+    return np.concatenate(parts)[np.argsort(np.concatenate(positions))]
+
+
+def take_rows(column, indices):
+    """
+    Rows of a fixed-width column stacked into one array
+    :param column: column or list
+    :param indices: numpy array (B,) of item ids
+    :return: numpy array (B, ...)
+    """
+    if isinstance(column, ConcatColumn):
+        return _concat_gather(column, indices, take_rows)
+    if isinstance(column, MemmapColumn):
+        return column.array[indices]
+    if isinstance(column, np.ndarray):
+        return column[indices]
+    return np.stack([np.asarray(column[i]) for i in indices])
+
+
+def ragged_lengths(column, indices):
+    """
+    :param column: RaggedColumn or list of arrays
+    :param indices: numpy array (B,) of item ids
+    :return: numpy array (B,), #rows of each item
+    """
+    if isinstance(column, ConcatColumn):
+        return _concat_gather(column, indices, ragged_lengths)
+    if isinstance(column, RotatedColumn):
+        return ragged_lengths(column.column, indices)
+    if isinstance(column, RaggedColumn):
+        offsets = column.offsets.array
+        return offsets[indices + 1] - offsets[indices]
+    return np.array([len(column[i]) for i in indices], dtype=np.int64)
+
+
+def gather_ragged(column, indices, rows):
+    """
+    Gather rows of ragged items, a RaggedColumn is read with one fancy index into its flat values
+    :param column: RaggedColumn or list of arrays
+    :param indices: numpy array (B,) of item ids
+    :param rows: numpy array (B, N) of row ids within each item
+    :return: numpy array (B, N, ...)
+    """
+    if isinstance(column, ConcatColumn):
+        return _concat_gather(column, indices, gather_ragged, rows)
+    if isinstance(column, RotatedColumn):
+        # only the gathered points are rotated
+        return rotate_batch_along_y(gather_ragged(column.column, indices, rows), column.rotation_angles[indices])
+    if isinstance(column, RaggedColumn):
+        return column.values.array[column.offsets.array[indices][:, None] + rows]
+    return np.stack([np.asarray(column[i])[r] for i, r in zip(indices, rows)])
+
+
+def open_frustum_store(path):
+    """
+    Columns of a frustum store written by preprocessing/frustum_store.py
+    :param path: store directory, <name>.frustums
+    :return: dict of field name to column
+    """
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    num_frustums = meta['num_frustums']
+    offsets = MemmapColumn(os.path.join(path, OFFSETS_FILE), np.int64, (num_frustums + 1,))
+    columns = {}
+    for field, info in meta['fields'].items():
+        num_rows = meta['num_rows'] if info['ragged'] else num_frustums
+        column = MemmapColumn(os.path.join(path, field + '.bin'), info['dtype'], [num_rows] + info['shape'])
+        if info['ragged']:
+            column = RaggedColumn(column, offsets)
+        elif field == 'class_names':
+            column = CategoricalColumn(column, meta['class_names'])
+        columns[field] = column
+    return columns
+
+
+def load_pickle(filename, fields):
+    with open(filename, 'rb') as fp:
+        return {field: pickle.load(fp, encoding='latin1') for field in fields}
+
+
+def attach_rotated_columns(source):
+    """
+    Add the frustum-rotated columns (ROTATED_FIELDS) to the columns of one store or pickle.
+    Store columns materialized by preprocessing/frustum_store.py --frustum_rotate are used as they are.
+    Otherwise, the box centers are rotated once at load, pickled point clouds are rotated once in place and moved from
+    point_clouds to rotated_point_clouds, and store point clouds are rotated on access.
+    :param source: dict of field name to column
+    """
+    num_frustums = len(source['frustum_rotation_angles'])
+    # frustum rotation angle shifted by pi/2, as in _FrustumKittiDataset.__getitem__
+    rotation_angles = np.pi / 2.0 + take_rows(source['frustum_rotation_angles'],
+                                              np.arange(num_frustums)).astype(np.float64)
+    if 'rotated_point_clouds' not in source:
+        point_clouds = source['point_clouds']
+        if isinstance(point_clouds, list):
+            for point_cloud, rotation_angle in zip(point_clouds, rotation_angles):
+                rotate_batch_along_y(point_cloud[None], rotation_angle[None])
+            # the list now holds rotated clouds, it must not be read as point_clouds anymore
+            source['rotated_point_clouds'] = source.pop('point_clouds')
+        else:
+            source['rotated_point_clouds'] = RotatedColumn(point_clouds, rotation_angles)
+    if 'rotated_centers' not in source and 'boxes_3d' in source:
+        boxes_3d = take_rows(source['boxes_3d'], np.arange(num_frustums))
+        centers = (boxes_3d[:, 0, :] + boxes_3d[:, 6, :]) / 2.0
+        source['rotated_centers'] = rotate_batch_along_y(centers[:, None, :], rotation_angles)[:, 0, :]
+
+
+def load_frustums(root, names, fields, frustum_rotate=False):
+    """
+    Load frustums as columns indexed by frustum id.
+    <name>.frustums stores are memory-mapped, <name>.pickle files are loaded into memory.
+    :param root: directory of the prepared frustums
+    :param names: list of file names without suffix, their frustums are concatenated in order
+    :param fields: list of field names, in pickle dump order
+    :param frustum_rotate: bool, whether to add the frustum-rotated ROTATED_FIELDS columns, they then replace
+                           point_clouds (see attach_rotated_columns)
+    :return: G of field name to column
+    """
+    sources = []
+    for name in names:
+        path = os.path.join(root, name)
+        if os.path.isdir(path + STORE_SUFFIX):
+            source = open_frustum_store(path + STORE_SUFFIX)
+        else:
+            source = load_pickle(path + '.pickle', fields)
+        if frustum_rotate:
+            attach_rotated_columns(source)
+        sources.append(source)
+        print('Load file:', name)
+    if frustum_rotate:
+        fields = [field for field in fields if field != 'point_clouds'] + \
+                 [field for field in ROTATED_FIELDS if field in sources[0]]
+    data = G()
+    for field in fields:
+        columns = [source[field] for source in sources]
+        data[field] = columns[0] if len(columns) == 1 else ConcatColumn(columns)
+    return data
@@ -1,11 +1,9 @@
-import os
-import pickle
-
 import numpy as np
 from torch.utils.data import Dataset
 
+from datasets.frustum_batch import get_frustum_batch
+from datasets.frustum_store import FRUSTUM_FIELDS, RGB_DETECTION_FIELDS, load_frustums
 from datasets.kitti.attributes import kitti_attributes as kitti
-from utils.container import G
 
 
 class FrustumKitti(dict):
@@ -65,45 +63,21 @@ class _FrustumKittiDataset(Dataset):
         self.random_shift = random_shift
         self.frustum_rotate = frustum_rotate
         self.from_rgb_detection = from_rgb_detection
-        self.data = G()
-
+        name = 'frustum_caronly' if self.num_classes == 1 else 'frustum_carpedcyc'
+        # frustum_rotation_angles: clockwise angle from positive x-axis
         if self.from_rgb_detection:
-            if self.num_classes == 1:
-                file = f'frustum_caronly_{split}_rgb_detection.pickle'
-            else:
-                file = f'frustum_carpedcyc_{split}_rgb_detection.pickle'
-            
-            with open(os.path.join(self.root, file), 'rb') as fp:
-                self.data.ids = pickle.load(fp)
-                self.data.boxes_2d = pickle.load(fp, encoding='latin1')
-                self.data.point_clouds = pickle.load(fp, encoding='latin1')
-                self.data.class_names = pickle.load(fp, encoding='latin1')
-                # frustum_angle is clockwise angle from positive x-axis
-                self.data.frustum_rotation_angles = pickle.load(fp, encoding='latin1')
-                self.data.probs = pickle.load(fp, encoding='latin1')
+            self.data = load_frustums(self.root, [f'{name}_{split}_rgb_detection'], RGB_DETECTION_FIELDS,
+                                      frustum_rotate=self.frustum_rotate)
         else:
-            if self.num_classes == 1:
-                file = f'frustum_caronly_{split}.pickle'
-            else:
-                file = f'frustum_carpedcyc_{split}.pickle'
-
-            with open(os.path.join(self.root, file), 'rb') as fp:
-                self.data.ids = pickle.load(fp)
-                self.data.boxes_2d = pickle.load(fp, encoding='latin1')
-                self.data.boxes_3d = pickle.load(fp, encoding='latin1')
-                self.data.point_clouds = pickle.load(fp, encoding='latin1')
-                self.data.mask_logits = pickle.load(fp, encoding='latin1')
-                self.data.class_names = pickle.load(fp, encoding='latin1')
-                self.data.heading_angles = pickle.load(fp, encoding='latin1')
-                self.data.sizes = pickle.load(fp, encoding='latin1')
-                # frustum_angle is clockwise angle from positive x-axis
-                self.data.frustum_rotation_angles = pickle.load(fp, encoding='latin1')
-        print("Load file:", file)
-        
+            self.data = load_frustums(self.root, [f'{name}_{split}'], FRUSTUM_FIELDS,
+                                      frustum_rotate=self.frustum_rotate)
+
     def __len__(self):
-        return len(self.data.point_clouds)
+        return len(self.data.frustum_rotation_angles)
 
     def __getitem__(self, index):
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
         # frustum rotation angle is from x clockwise to z
         # rotation angle is from z clockwise to x
         # frustum rotation angle shifted by pi/2 so that it can be directly used to adjust ground truth heading angle
@@ -116,10 +90,11 @@ class _FrustumKittiDataset(Dataset):
         one_hot_vector = one_hot_vector.astype(np.float32)
 
         # Get point cloud
-        point_cloud = self.data.point_clouds[index]
         if self.frustum_rotate:
-            # Use np.copy to avoid corrupting original data
-            point_cloud = self.rotate_points_along_y(np.copy(point_cloud), rotation_angle)
+            # rotated once at load or conversion, see load_frustums
+            point_cloud = self.data.rotated_point_clouds[index]
+        else:
+            point_cloud = self.data.point_clouds[index]
         choice = np.random.choice(point_cloud.shape[0], self.num_points, replace=True)
         point_cloud = point_cloud[choice, :]
 
@@ -128,13 +103,14 @@ class _FrustumKittiDataset(Dataset):
                    {'rotation_angle': rotation_angle.astype(np.float32), 'rgb_score': self.data.probs[index]}
 
         mask_logits = self.data.mask_logits[index][choice]
-        center = (self.data.boxes_3d[index][0, :] + self.data.boxes_3d[index][6, :]) / 2.0
         heading_angle = self.data.heading_angles[index]
         size_template_id = self.class_name_to_size_template_id[class_name]
         size_residual = self.data.sizes[index] - kitti.class_name_to_size_template[class_name]
         if self.frustum_rotate:
-            center = self.rotate_points_along_y(np.expand_dims(center, 0), rotation_angle).squeeze()
+            center = np.array(self.data.rotated_centers[index])
             heading_angle -= rotation_angle
+        else:
+            center = (self.data.boxes_3d[index][0, :] + self.data.boxes_3d[index][6, :]) / 2.0
 
         # Data Augmentation
         if self.random_flip:
@@ -157,6 +133,22 @@ class _FrustumKittiDataset(Dataset):
                 'size_template_id': size_template_id, 'size_residual': size_residual.astype(np.float32),
                 'class_id': self.class_name_to_class_id[class_name], 'rotation_angle': rotation_angle.astype(np.float32)}
 
+    def get_batch(self, indices):
+        """
+        Collated batch of frustums, built with vectorized sampling and augmentation (see batched_data_loader)
+        :param indices: list of frustum ids
+        :return: (inputs, targets) dicts of batched tensors
+        """
+        return get_frustum_batch(self, indices, kitti.class_name_to_size_template)
+
+    def get_inputs(self, indices):
+        """
+        Collated inputs of frustums, without gathering their labels (e.g., for target domain batches)
+        :param indices: list of frustum ids
+        :return: inputs dict of batched tensors
+        """
+        return get_frustum_batch(self, indices, kitti.class_name_to_size_template, inputs_only=True)
+
     @staticmethod
     def rotate_points_along_y(features, rotation_angle):
         """
@@ -1 +1,2 @@
 from datasets.vkitti.frustum import FrustumVkitti
+from datasets.vkitti.frames import FrustumVkittiFrames
@@ -0,0 +1,212 @@
+import os
+import sys
+
+import numpy as np
+from torch.utils.data.dataloader import default_collate
+
+from datasets.frustum_store import STORE_SUFFIX, ConcatColumn, open_frustum_store
+from datasets.vkitti.attributes import vkitti_attributes as vkitti
+from datasets.vkitti.frustum import _FrustumVkittiDataset, scenes_dict
+from utils.container import G
+
+# box helpers shared with preprocessing/generate_vkitti_frustum.py, which writes the frame stores
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..')))
+from preprocessing import box_util
+
+__all__ = ['FrustumVkittiFrames']
+
+# fields of the stores written by preprocessing/generate_vkitti_frustum.py --gen_frames
+FRAME_FIELDS = ['ids', 'point_clouds', 'points_2d', 'calibs']
+OBJECT_FIELDS = ['ids', 'frame_indices', 'boxes_2d', 'boxes_3d', 'class_names', 'heading_angles', 'sizes']
+
+
+class FrustumVkittiFrames(dict):
+    def __init__(self, root, num_points, split=None, classes=('Car', 'Van', 'Truck'),
+                 num_heading_angle_bins=12, class_name_to_size_template_id=None, perturb_box2d=True, augment_x=5,
+                 random_flip=False, random_shift=False, frustum_rotate=False, prefix=None):
+        super().__init__()
+        if class_name_to_size_template_id is None:
+            class_name_to_size_template_id = {cat: cls for cls, cat in enumerate(vkitti.class_names)}
+        if not isinstance(split, (list, tuple)):
+            if split is None:
+                split = ['train', 'val']
+            else:
+                split = [split]
+        if 'train' in split:
+            self['train'] = _FrustumVkittiFramesDataset(
+                root=root, num_points=num_points, split='train', classes=classes,
+                num_heading_angle_bins=num_heading_angle_bins,
+                class_name_to_size_template_id=class_name_to_size_template_id,
+                perturb_box2d=perturb_box2d, augment_x=augment_x,
+                random_flip=random_flip, random_shift=random_shift, frustum_rotate=frustum_rotate, prefix=prefix)
+        if 'val' in split:
+            self['val'] = _FrustumVkittiFramesDataset(
+                root=root, num_points=num_points, split='val', classes=classes,
+                num_heading_angle_bins=num_heading_angle_bins,
+                class_name_to_size_template_id=class_name_to_size_template_id,
+                perturb_box2d=False, augment_x=1,
+                random_flip=False, random_shift=False, frustum_rotate=frustum_rotate, prefix=prefix)
+
+
+class _FrustumVkittiFramesDataset(_FrustumVkittiDataset):
+    def __init__(self, root, num_points, split, classes, num_heading_angle_bins, class_name_to_size_template_id,
+                 perturb_box2d=False, augment_x=1, random_flip=False, random_shift=False, frustum_rotate=False,
+                 prefix=None, num_perturb_trials=10, min_box_height=25):
+        """
+        Frustum Virtual Kitti Dataset cropping the frustums of 2D boxes from the frame stores at access time, so box
+        perturbations are drawn afresh every epoch instead of frozen augment_x times into the frustum pickles
+        :param root: directory path to the frame stores
+        :param num_points: number of points to process for each scene
+        :param split: 'train' or 'val'
+        :param classes: tuple of classes names
+        :param num_heading_angle_bins: #heading angle bins, int
+        :param class_name_to_size_template_id: dict
+        :param perturb_box2d: bool, whether to randomly shift and scale the 2D box before cropping
+        :param augment_x: int, #frustums of each object per epoch
+        :param random_flip: bool, in 50% randomly flip the point cloud in left and right (after the frustum rotation)
+        :param random_shift: bool, if True randomly shift the point cloud back and forth by a random distance
+        :param frustum_rotate: bool, whether to do frustum rotation
+        :param prefix: str, file name prefix of the stores, frustum_caronly for a single class and
+                       frustum_carvantruck otherwise if None (as generate_vkitti_frustum.py --car_only names them)
+        :param num_perturb_trials: int, #perturbed boxes tried before falling back to the ground truth box
+        :param min_box_height: float, perturbed boxes lower than this or without object points are rejected
+        """
+        assert split in ['train', 'val']
+        self.root = root
+        self.split = split
+        self.classes = classes
+        self.num_classes = len(classes)
+        self.class_name_to_class_id = {cat: cls for cls, cat in enumerate(self.classes)}
+        self.num_heading_angle_bins = num_heading_angle_bins
+        self.class_name_to_size_template_id = class_name_to_size_template_id
+
+        self.num_points = num_points
+        self.perturb_box2d = perturb_box2d
+        self.augment_x = augment_x
+        self.num_perturb_trials = num_perturb_trials
+        self.min_box_height = min_box_height
+        self.random_flip = random_flip
+        self.random_shift = random_shift
+        self.frustum_rotate = frustum_rotate
+        self.from_rgb_detection = False
+
+        if prefix is None:
+            prefix = 'frustum_caronly' if self.num_classes == 1 else 'frustum_carvantruck'
+
+        self.frames, self.objects = G(), G()
+        frame_stores, object_stores = [], []
+        for scene in scenes_dict[split]:
+            name = os.path.join(self.root, f'{prefix}_{split}_{scene}')
+            frame_stores.append(open_frustum_store(name + '_frames' + STORE_SUFFIX))
+            object_stores.append(open_frustum_store(name + '_objects' + STORE_SUFFIX))
+            print('Load file:', name)
+        # frame_indices of the objects are local to the store of their scene
+        self.frame_offsets = np.cumsum([0] + [len(s['ids']) for s in frame_stores[:-1]])
+        self.object_offsets = np.cumsum([len(s['ids']) for s in object_stores])
+        for stores, columns, fields in [(frame_stores, self.frames, FRAME_FIELDS),
+                                        (object_stores, self.objects, OBJECT_FIELDS)]:
+            for field in fields:
+                columns[field] = ConcatColumn([store[field] for store in stores])
+        self.num_objects = len(self.objects.ids)
+
+    def __len__(self):
+        return self.num_objects * self.augment_x
+
+    def crop_frustum(self, object_id):
+        """
+        Crop the frustum of an object from its frame, with a perturbed 2D box if perturb_box2d
+        :return: point cloud (N, C), mask logits (N,), frustum rotation angle
+        """
+        scene_id = int(np.searchsorted(self.object_offsets, object_id, side='right'))
+        frame_id = self.frame_offsets[scene_id] + self.objects.frame_indices[object_id]
+        points = self.frames.point_clouds[frame_id]
+        points_2d = self.frames.points_2d[frame_id]
+        box2d = self.objects.boxes_2d[object_id]
+        box3d = self.objects.boxes_3d[object_id]
+
+        for trial in range(self.num_perturb_trials + 1):
+            if self.perturb_box2d and trial < self.num_perturb_trials:
+                xmin, ymin, xmax, ymax = box_util.random_shift_box2d(box2d)
+            else:
+                # objects are only stored if their ground truth box passes the checks
+                xmin, ymin, xmax, ymax = box2d
+            point_ids = box_util.points_in_sorted_box2d(points_2d, (xmin, ymin, xmax, ymax))
+            point_cloud = points[point_ids]
+            mask_logits = box_util.points_in_box3d(point_cloud[:, 0:3], box3d)
+            if ymax - ymin >= self.min_box_height and np.any(mask_logits):
+                break
+
+        # Get frustum angle (according to center pixel in 2D BOX), at some random depth
+        c_u, c_v, f_u, f_v, b_x, b_y = self.frames.calibs[frame_id]
+        depth = 20
+        x = (((xmin + xmax) / 2.0 - c_u) * depth) / f_u + b_x
+        frustum_angle = -1 * np.arctan2(depth, x)
+        return point_cloud, mask_logits, frustum_angle
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
+        object_id = index % self.num_objects
+        point_cloud, mask_logits, frustum_angle = self.crop_frustum(object_id)
+
+        # frustum rotation angle is from x clockwise to z
+        # rotation angle is from z clockwise to x
+        # frustum rotation angle shifted by pi/2 so that it can be directly used to adjust ground truth heading angle
+        rotation_angle = np.pi / 2.0 + frustum_angle
+
+        # Compute one hot vector
+        class_name = self.objects.class_names[object_id]
+        one_hot_vector = np.zeros(self.num_classes)
+        one_hot_vector[self.class_name_to_class_id[class_name]] = 1
+        one_hot_vector = one_hot_vector.astype(np.float32)
+
+        # Resample, then rotate the resampled points only
+        choice = np.random.choice(point_cloud.shape[0], self.num_points, replace=True)
+        point_cloud = point_cloud[choice, :]
+        mask_logits = mask_logits[choice]
+        boxes_3d = self.objects.boxes_3d[object_id]
+        center = (boxes_3d[0, :] + boxes_3d[6, :]) / 2.0
+        heading_angle = self.objects.heading_angles[object_id]
+        size_template_id = self.class_name_to_size_template_id[class_name]
+        size_residual = self.objects.sizes[object_id] - vkitti.class_name_to_size_template[class_name]
+        if self.frustum_rotate:
+            point_cloud = self.rotate_points_along_y(point_cloud, rotation_angle)
+            center = self.rotate_points_along_y(np.expand_dims(center, 0), rotation_angle).squeeze()
+            heading_angle -= rotation_angle
+
+        # Data Augmentation
+        if self.random_flip:
+            # note: rotation_angle won't be correct if we have random_flip so do not use it in case of random flipping
+            if np.random.random() > 0.5:  # 50% chance flipping
+                point_cloud[:, 0] = -point_cloud[:, 0]
+                center[0] = -center[0]
+                heading_angle = np.pi - heading_angle
+        if self.random_shift:
+            dist = np.sqrt(np.sum(center[0] ** 2 + center[1] ** 2))
+            shift = np.clip(np.random.randn() * dist * 0.05, dist * 0.8, dist * 1.2)
+            point_cloud[:, 2] += shift
+            center[2] += shift
+
+        heading_bin_id, heading_residual = self.angle_to_bin_id(heading_angle, self.num_heading_angle_bins)
+
+        return {'features': point_cloud.astype(np.float32).T, 'one_hot_vectors': one_hot_vector},\
+               {'mask_logits': mask_logits.astype(np.int64), 'center': center.astype(np.float32),
+                'heading_bin_id': heading_bin_id,  'heading_residual': np.array(heading_residual, dtype=np.float32),
+                'size_template_id': size_template_id, 'size_residual': size_residual.astype(np.float32),
+                'class_id': self.class_name_to_class_id[class_name], 'rotation_angle': rotation_angle.astype(np.float32)}
+
+    def get_batch(self, indices):
+        """
+        Batch of frustums cropped one by one, for batched_data_loader
+        :param indices: list of frustum ids
+        :return: (inputs, targets) dicts of batched tensors
+        """
+        return default_collate([self[int(index)] for index in indices])
+
+    def get_inputs(self, indices):
+        """
+        Collated inputs of frustums, the labels are still computed since cropping checks the 3D box
+        :param indices: list of frustum ids
+        :return: inputs dict of batched tensors
+        """
+        return default_collate([self[int(index)][0] for index in indices])
@@ -68,6 +68,7 @@ def evaluate(configs=None):
     from torch.utils.data import DataLoader
     from tqdm import tqdm
 
+    from datasets.frustum_batch import batched_data_loader
     from ..utils import eval_from_files
 
     ###########
@@ -94,6 +95,7 @@ def evaluate(configs=None):
     #################################
     print(f'\n==> loading dataset "{configs.dataset}"')
     dataset = configs.dataset()[configs.dataset.split]
+    data_loader = batched_data_loader if configs.data.batched_loading else DataLoader
 
     print(f'\n==> creating model "{configs.model}"')
     model = configs.model()
@@ -111,6 +113,10 @@ def evaluate(configs=None):
 
     model.eval()
 
+    if configs.evaluate.num_tests > 1 and configs.evaluate.get('single_forward', False):
+        evaluate_single_forward(configs, model, dataset, data_loader, stats_path, predictions_path)
+        return
+
     for test_index in range(configs.evaluate.num_tests):
         if test_index == 0:
             print(configs)
@@ -139,16 +145,10 @@ def evaluate(configs=None):
             if configs.evaluate.num_tests == 1:
                 return
             else:
-                for class_name, v in current_results.items():
-                    if class_name not in results:
-                        results[class_name] = dict()
-                    for kind, r in v.items():
-                        if kind not in results[class_name]:
-                            results[class_name][kind] = []
-                        results[class_name][kind].append(r)
+                update_results(results, current_results)
                 continue
 
-        loader = DataLoader(
+        loader = data_loader(
             dataset, shuffle=False, batch_size=configs.evaluate.batch_size,
             num_workers=configs.data.num_workers, pin_memory=True,
             worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
@@ -204,13 +204,21 @@ def evaluate(configs=None):
         if configs.evaluate.num_tests == 1:
             return
         else:
-            for class_name, v in current_results.items():
-                if class_name not in results:
-                    results[class_name] = dict()
-                for kind, r in v.items():
-                    if kind not in results[class_name]:
-                        results[class_name][kind] = []
-                    results[class_name][kind].append(r)
+            update_results(results, current_results)
+    print_results(results)
+
+
+def update_results(results, current_results):
+    for class_name, v in current_results.items():
+        if class_name not in results:
+            results[class_name] = dict()
+        for kind, r in v.items():
+            if kind not in results[class_name]:
+                results[class_name][kind] = []
+            results[class_name][kind].append(r)
+
+
+def print_results(results):
     for class_name, v in results.items():
         print(f'{class_name}  AP(Average Precision)')
         for kind, r in v.items():
@@ -222,6 +230,118 @@ def evaluate(configs=None):
             print(f'{kind:<4} AP: {rs}')
 
 
+class RepeatedSampling:
+    def __init__(self, dataset, num_samplings):
+        """
+        Dataset wrapper returning num_samplings independent point resamplings of each frustum, stacked along dim 1
+        :param dataset: frustum dataset
+        :param num_samplings: int, K
+        """
+        self.dataset = dataset
+        self.num_samplings = num_samplings
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple, np.ndarray)):
+            # batched frustum dataset: the K samplings of frustum b are rows b * K ... b * K + K - 1
+            batch = self.dataset[np.repeat(index, self.num_samplings)]
+            return tuple({k: v.view(len(index), self.num_samplings, *v.shape[1:]) for k, v in d.items()}
+                         for d in batch)
+        samplings = [self.dataset[index] for _ in range(self.num_samplings)]
+        return tuple({k: np.stack([s[i][k] for s in samplings]) for k in samplings[0][i]} for i in range(2))
+
+
+def evaluate_single_forward(configs, model, dataset, data_loader, stats_path, predictions_path):
+    """
+    Evaluate num_tests resamplings of every frustum with one pass over the dataset: the worker draws the K
+    resamplings, they are stacked along the batch dim into one forward, and the K predictions are scattered into K
+    result sets, whose AP mean +/- std is reported as with sequential tests.
+    """
+    import time
+
+    import torch
+    from tqdm import tqdm
+
+    from ..utils import eval_from_files
+
+    print(configs)
+    num_tests = configs.evaluate.num_tests
+    seed = random.randint(1, int(time.time())) % (2 ** 32 - 1)
+    print(f'\n==> Test [{num_tests:02d} resamplings in one forward] initial seed\n[seed] = {seed}')
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    stats_paths = [stats_path.format(test_index) for test_index in range(num_tests)]
+    predictions_paths = [predictions_path.format(test_index) for test_index in range(num_tests)]
+    if all(os.path.exists(path) for path in stats_paths):
+        print(f'==> hit {os.path.dirname(stats_path)}')
+        predictions = np.stack([np.load(path) for path in stats_paths])
+    else:
+        loader = data_loader(
+            RepeatedSampling(dataset, num_tests), shuffle=False, batch_size=configs.evaluate.batch_size,
+            num_workers=configs.data.num_workers, pin_memory=True,
+            worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
+        )
+
+        predictions = np.zeros((num_tests, len(dataset), 8))
+        size_templates = configs.data.size_templates.to(configs.device)
+        heading_angle_bin_centers = torch.arange(
+            0, 2 * np.pi, 2 * np.pi / configs.data.num_heading_angle_bins).to(configs.device)
+        current_step = 0
+
+        with torch.no_grad():
+            for inputs, targets in tqdm(loader, desc='eval', ncols=0):
+                for k, v in inputs.items():
+                    # (B, K, ...) -> (B * K, ...)
+                    inputs[k] = v.view(-1, *v.shape[2:]).to(configs.device, non_blocking=True)
+                outputs = model(inputs)
+
+                center = outputs['center']  # (B * K, 3)
+                heading_scores = outputs['heading_scores']  # (B * K, NH)
+                heading_residuals = outputs['heading_residuals']  # (B * K, NH)
+                size_scores = outputs['size_scores']  # (B * K, NS)
+                size_residuals = outputs['size_residuals']  # (B * K, NS, 3)
+
+                batch_id = torch.arange(center.size(0), device=center.device)
+                heading_bin_id = torch.argmax(heading_scores, dim=1)
+                heading = heading_angle_bin_centers[heading_bin_id] + heading_residuals[batch_id, heading_bin_id]
+                size_template_id = torch.argmax(size_scores, dim=1)
+                size = size_templates[size_template_id] + size_residuals[batch_id, size_template_id]  # (B * K, 3)
+
+                batch_size = targets['rotation_angle'].size(0)
+                center = center.view(batch_size, num_tests, 3).cpu().numpy()
+                heading = heading.view(batch_size, num_tests).cpu().numpy()
+                size = size.view(batch_size, num_tests, 3).cpu().numpy()
+                # rotation angle and rgb score do not depend on the resampling
+                rotation_angle = targets['rotation_angle'][:, 0].cpu().numpy()  # (B, )
+                rgb_score = targets['rgb_score'][:, 0].cpu().numpy()  # (B, )
+
+                for test_index in range(num_tests):
+                    update_predictions(predictions=predictions[test_index], center=center[:, test_index],
+                                       heading=heading[:, test_index], size=size[:, test_index],
+                                       rotation_angle=rotation_angle, rgb_score=rgb_score,
+                                       current_step=current_step, batch_size=batch_size)
+                current_step += batch_size
+
+        for test_index in range(num_tests):
+            np.save(stats_paths[test_index], predictions[test_index])
+
+    results = dict()
+    for test_index in range(num_tests):
+        image_ids = write_predictions(predictions_paths[test_index], ids=dataset.data.ids,
+                                      classes=dataset.data.class_names, boxes_2d=dataset.data.boxes_2d,
+                                      predictions=predictions[test_index],
+                                      image_id_file_path=configs.evaluate.image_id_file_path)
+        _, current_results = eval_from_files(prediction_folder=predictions_paths[test_index],
+                                             ground_truth_folder=configs.evaluate.ground_truth_path,
+                                             image_ids=image_ids, verbose=True)
+        update_results(results, current_results)
+    print_results(results)
+
+
 @numba.jit()
 def update_predictions(predictions, center, heading, size, rotation_angle, rgb_score, current_step, batch_size):
     for b in range(batch_size):
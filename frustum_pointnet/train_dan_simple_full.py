@@ -4,11 +4,8 @@ import os
 import random
 import shutil
 
-from tqdm import trange
-
 from modules import mmd
 from modules.loss import discrepancy_loss
-from utils.common import loop_iterable
 
 
 def prepare():
@@ -102,6 +99,8 @@ def main():
     from torch.utils.data import DataLoader
     from tqdm import tqdm
 
+    from datasets.domain_pair import PairedDomainLoader
+
     ################################
     # Train / Eval Kernel Function #
     ################################
@@ -118,7 +117,7 @@ def main():
             writer.add_scalar('lr_dis', lr, epoch)
 
     # train kernel
-    def train(model, source_loader, target_loader, criterion, discrepancy,
+    def train(model, loader, criterion, discrepancy,
               optimizer_g, optimizer_cls, scheduler_g, scheduler_cls,
               current_step, writer, cons):
 
@@ -127,33 +126,9 @@ def main():
         loss_adv_total = 0
         data_total = 0
 
-        batch_iterator = zip(loop_iterable(source_loader),
-                             loop_iterable(target_loader))
-
-        for _ in trange(len(source_loader)):
-            (inputs, targets), (inputs_t, _) = next(batch_iterator)
-
-            if isinstance(inputs, dict):
-                for k, v in inputs.items():
-                    batch_size = v.size(0)
-                    inputs[k] = v.to(configs.device, non_blocking=True)
-            else:
-                batch_size = inputs.size(0)
-                inputs = inputs.to(configs.device, non_blocking=True)
-
-            if isinstance(inputs_t, dict):
-                for k, v in inputs_t.items():
-                    batch_size = v.size(0)
-                    inputs_t[k] = v.to(configs.device, non_blocking=True)
-            else:
-                batch_size = inputs_t.size(0)
-                inputs_t = inputs_t.to(configs.device, non_blocking=True)
-
-            if isinstance(targets, dict):
-                for k, v in targets.items():
-                    targets[k] = v.to(configs.device, non_blocking=True)
-            else:
-                targets = targets.to(configs.device, non_blocking=True)
+        # batches arrive on the device, prefetched by the loader
+        for (inputs, targets), inputs_t in tqdm(loader, ncols=0):
+            batch_size = inputs['features'].size(0)
 
             outputs = model(inputs)
 
@@ -244,23 +219,27 @@ def main():
 
     print(f'\n==> loading source dataset "{configs.source_dataset}"')
     source_dataset = configs.source_dataset()
-    source_loaders = {"train": DataLoader(
-        source_dataset["train"], shuffle=True,
-        batch_size=configs.train.batch_size, drop_last=True,
-        num_workers=configs.data.num_workers, pin_memory=True,
-        worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
-    )}
 
     print(f'\n==> loading target dataset "{configs.target_dataset}"')
     target_dataset = configs.target_dataset()
     target_loaders = {}
     for split in target_dataset:
+        if split == 'train':
+            continue
         target_loaders[split] = DataLoader(
-            target_dataset[split], shuffle=(split == 'train'),
+            target_dataset[split], shuffle=False,
             batch_size=configs.train.batch_size, drop_last=True,
             num_workers=configs.data.num_workers, pin_memory=True,
             worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
         )
+    # one worker pool loads the (source, target) training batch pairs and is kept across epochs
+    train_loader = PairedDomainLoader(
+        source_dataset['train'], target_dataset['train'], batch_size=configs.train.batch_size,
+        domain_ratio=configs.data.get('domain_ratio', 1.0), num_prefetch=configs.data.get('num_prefetch', 2),
+        batched_loading=configs.data.batched_loading, device=configs.device,
+        num_workers=configs.data.num_workers,
+        worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
+    )
 
     print(f'\n==> creating model "{configs.model}"')
     model = configs.model()
@@ -357,8 +336,7 @@ def main():
 
             # train
             print(f'\n==> training epoch {current_epoch}/{configs.train.num_epochs}')
-            train(model, source_loader=source_loaders['train'],
-                  target_loader=target_loaders['train'],
+            train(model, loader=train_loader,
                   criterion=criterion, discrepancy=discrepancy,
                   optimizer_g=optimizer_g, optimizer_cls=optimizer_cls,
                   scheduler_g=scheduler_g, scheduler_cls=scheduler_c,
@@ -366,13 +344,6 @@ def main():
             current_step += step_size
 
             # evaluate
-            meters = dict()
-            for split, loader in source_loaders.items():
-                if split != 'train':
-                    meters.update(evaluate(model, loader=loader, split=split))
-            for k, meter in meters.items():
-                print(f'Source [{k}] = {meter:2f}')
-
             meters = dict()
             for split, loader in target_loaders.items():
                 if split != 'train':
@@ -87,6 +87,8 @@ def main():
     from torch.utils.data import DataLoader
     from tqdm import tqdm
 
+    from datasets.frustum_batch import batched_data_loader
+
     ################################
     # Train / Eval Kernel Function #
     ################################
@@ -167,14 +169,15 @@ def main():
     print(f'\n==> loading dataset "{configs.dataset}"')
     dataset = configs.dataset()
     kitti_val_dataset = configs.kitti_dataset()
+    data_loader = batched_data_loader if configs.data.batched_loading else DataLoader
     loaders = {}
     for split in dataset:
-        loaders[split] = DataLoader(
+        loaders[split] = data_loader(
             dataset[split], shuffle=(split == 'train'), batch_size=configs.train.batch_size,
             num_workers=configs.data.num_workers, pin_memory=True,
             worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
         )
-    kitti_val_loader = DataLoader(
+    kitti_val_loader = data_loader(
             kitti_val_dataset["val"], shuffle=False, batch_size=configs.train.batch_size,
             num_workers=configs.data.num_workers, pin_memory=True,
             worker_init_fn=lambda worker_id: np.random.seed(seed + worker_id)
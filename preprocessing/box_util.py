@@ -0,0 +1,74 @@
+''' Vectorized 3D box membership tests.
+
+Boxes are given by their 8 corners in the order of compute_box_3d:
+        1 -------- 0
+       /|         /|
+      2 -------- 3 .
+      | |        | |
+      . 5 -------- 4
+      |/         |/
+      6 -------- 7
+so the edges 0->1, 0->3 and 0->4 span the box. A point p is inside iff its
+projection on every edge e satisfies 0 <= (p - c0).e <= |e|^2, which is the
+same test in_hull does with a Delaunay triangulation of the corners.
+
+The 2D box helpers are shared by the frustum extraction and the datasets
+that crop frustums at training time (frustum_pointnet/datasets/vkitti/frames.py),
+so both perturb and crop boxes the same way.
+'''
+
+import numpy as np
+
+
+def box3d_edges(box3d):
+    ''' box3d: (8,3) corners -> (3,3) edge vectors 0->1, 0->3, 0->4 '''
+    return box3d[[1, 3, 4]] - box3d[0]
+
+
+def points_in_box3d(pc, box3d):
+    ''' pc: (N,3), box3d: (8,3) -> (N,) bool '''
+    edges = box3d_edges(box3d)
+    proj = np.dot(pc - box3d[0], np.transpose(edges))
+    extent = np.sum(edges ** 2, axis=1)
+    return np.all((proj >= 0) & (proj <= extent), axis=1)
+
+
+def points_in_boxes3d(pc, boxes3d):
+    ''' pc: (N,3), boxes3d: (K,8,3) -> (K,N) bool, row k marks the points in box k '''
+    inside = np.zeros((len(boxes3d), len(pc)), dtype=bool)
+    if len(pc) == 0:
+        return inside
+    pc_min, pc_max = pc.min(axis=0), pc.max(axis=0)
+    for k, box3d in enumerate(boxes3d):
+        # skip boxes whose axis aligned bounds miss the cloud
+        if np.any(box3d.min(axis=0) > pc_max) or np.any(box3d.max(axis=0) < pc_min):
+            continue
+        inside[k] = points_in_box3d(pc, box3d)
+    return inside
+
+
+def random_shift_box2d(box2d, shift_ratio=0.1, rng=np.random):
+    ''' Randomly shift box center, randomly scale width and height '''
+    r = shift_ratio
+    xmin, ymin, xmax, ymax = box2d
+    h = ymax - ymin
+    w = xmax - xmin
+    cx = (xmin + xmax) / 2.0
+    cy = (ymin + ymax) / 2.0
+    cx2 = cx + w * r * (rng.random_sample() * 2 - 1)
+    cy2 = cy + h * r * (rng.random_sample() * 2 - 1)
+    h2 = h * (1 + rng.random_sample() * 2 * r - r)  # 0.9 to 1.1
+    w2 = w * (1 + rng.random_sample() * 2 * r - r)  # 0.9 to 1.1
+    return np.array(
+        [cx2 - w2 / 2.0, cy2 - h2 / 2.0, cx2 + w2 / 2.0, cy2 + h2 / 2.0])
+
+
+def points_in_sorted_box2d(points_2d, box2d):
+    ''' points_2d: (N,2) image coords (u,v) sorted by v, box2d: (xmin,ymin,xmax,ymax)
+        -> ids of the points with xmin <= u < xmax and ymin <= v < ymax,
+        the rows of the box are found by a binary search
+    '''
+    xmin, ymin, xmax, ymax = box2d
+    start, stop = np.searchsorted(points_2d[:, 1], [ymin, ymax])
+    u = points_2d[start:stop, 0]
+    return start + np.flatnonzero((u >= xmin) & (u < xmax))
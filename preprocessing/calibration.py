@@ -0,0 +1,304 @@
+''' Camera/LiDAR transform engine shared by the KITTI, Virtual KITTI and Waymo
+calibrations.
+
+The dataset modules only parse their calibration files into the three
+matrices of the KITTI convention (P, Tr_velo_to_cam, R0_rect) and build a
+CameraCalibration from them. All projections live here, as single matmuls
+with composite transforms, so they are optimized once for all pipelines.
+
+Point transforms run on one of three backends, chosen with set_backend:
+    numpy  BLAS matmul (default)
+    numba  fused multiply-add loop over the points, parallel over rows
+    torch  torch.matmul on CPU tensors sharing memory with the arrays
+All of them accept float32 or float64 points and an optional preallocated
+out buffer, and batched (B,N,3) points with (B,3,4) transforms.
+
+Usage:
+    python calibration.py --num_points 2000000 --dtype float32
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numpy', 'numba', 'torch')
+_backend = 'numpy'
+
+
+def set_backend(name):
+    ''' Select the point transform backend, one of BACKENDS '''
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend: {}'.format(name))
+    if name == 'numba' and numba is None:
+        raise ImportError('The numba backend requires numba')
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+def hom_mat(Tr):
+    ''' Extend a 3x4 transform to 4x4 by appending [0, 0, 0, 1] '''
+    return np.vstack((Tr, [0, 0, 0, 1]))
+
+
+def inverse_rigid_trans(Tr):
+    ''' Inverse a rigid body transform matrix (3x4 as [R|t])
+        [R'|-R't; 0|1]
+    '''
+    inv_Tr = np.zeros_like(Tr)  # 3x4
+    inv_Tr[0:3, 0:3] = np.transpose(Tr[0:3, 0:3])
+    inv_Tr[0:3, 3] = np.dot(-np.transpose(Tr[0:3, 0:3]), Tr[0:3, 3])
+    return inv_Tr
+
+
+def uv_to_hom(uv_depth):
+    ''' Input: nx3 points as (u, v, depth).
+        Output: nx3 points as (u*depth, v*depth, depth), which the I2R/I2V
+                transforms take together with an implicit homogeneous 1.
+    '''
+    uvd = np.array(uv_depth, dtype=np.result_type(uv_depth.dtype, np.float32))
+    uvd[..., 0:2] *= uvd[..., 2:3]
+    return uvd
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _affine_numba(pts, R, t, out):
+        for i in numba.prange(pts.shape[0]):
+            x, y, z = pts[i, 0], pts[i, 1], pts[i, 2]
+            for j in range(3):
+                out[i, j] = R[j, 0] * x + R[j, 1] * y + R[j, 2] * z + t[j]
+
+
+def _affine(pts, R, t, out):
+    ''' out[..., j] = sum_k R[..., j, k] * pts[..., k] + t[..., j] '''
+    R = np.asarray(R)
+    dtype = out.dtype if out is not None else np.result_type(pts.dtype, R.dtype)
+    pts = pts.astype(dtype, copy=False)
+    R = np.array(R, dtype=dtype)
+    if t is not None:
+        # broadcast the translation of every batch over its points
+        t = np.array(t, dtype=dtype)[..., np.newaxis, :] if R.ndim == 3 else np.array(t, dtype=dtype)
+    if _backend == 'numba' and pts.ndim == 2:
+        if out is None:
+            out = np.empty((len(pts), 3), dtype=dtype)
+        _affine_numba(np.ascontiguousarray(pts), R,
+                      np.zeros(3, dtype=dtype) if t is None else t, out)
+        return out
+    if _backend == 'torch':
+        import torch
+        res = torch.matmul(torch.from_numpy(np.ascontiguousarray(pts)),
+                           torch.from_numpy(np.ascontiguousarray(np.swapaxes(R, -1, -2))))
+        if t is not None:
+            res += torch.from_numpy(t)
+        if out is None:
+            return res.numpy()
+        out[...] = res.numpy()
+        return out
+    out = np.matmul(pts, np.swapaxes(R, -1, -2), out=out)
+    if t is not None:
+        out += t
+    return out
+
+
+def rotate_points(pts_3d, R, out=None):
+    ''' Input: nx3 (or Bxnx3) points and a 3x3 (or Bx3x3) rotation.
+        Output: points R * x, written into out if given.
+    '''
+    return _affine(pts_3d, R, None, out)
+
+
+def transform_points(pts_3d, Tr, out=None):
+    ''' Input: nx3 (or Bxnx3) points and a 3x4 (or Bx3x4) transform [R|t].
+        Output: points R * x + t, written into out if given.
+    '''
+    return _affine(pts_3d, Tr[..., 0:3], Tr[..., 3], out)
+
+
+def project_points(pts_3d, Tr):
+    ''' Input: nx3 (or Bxnx3) points and a 3x4 (or Bx3x4) camera matrix.
+        Output: nx2 (or Bxnx2) image coordinates.
+    '''
+    pts_2d = transform_points(pts_3d, Tr)
+    pts_2d[..., 0] /= pts_2d[..., 2]
+    pts_2d[..., 1] /= pts_2d[..., 2]
+    return pts_2d[..., 0:2]
+
+
+class CameraCalibration(object):
+    ''' Calibration matrices and utils
+        3d XYZ in <label>.txt are in rect camera coord.
+        2d box xy are in image2 coord
+        Points in <lidar>.bin are in Velodyne coord.
+
+        y_image2 = P^2_rect * x_rect
+        y_image2 = P^2_rect * R0_rect * Tr_velo_to_cam * x_velo
+        x_ref = Tr_velo_to_cam * x_velo
+        x_rect = R0_rect * x_ref
+
+        P^2_rect = [f^2_u,  0,      c^2_u,  -f^2_u b^2_x;
+                    0,      f^2_v,  c^2_v,  -f^2_v b^2_y;
+                    0,      0,      1,      0]
+                 = K * [1|t]
+
+        image2 coord:
+         ----> x-axis (u)
+        |
+        |
+        v y-axis (v)
+
+        velodyne coord:
+        front x, left y, up z
+
+        rect/ref camera coord:
+        right x, down y, front z
+
+        Ref (KITTI paper): http://www.cvlibs.net/publications/Geiger2013IJRR.pdf
+
+        The chained transforms are composed once in __init__:
+            V2R = R0_rect * Tr_velo_to_cam        (velo -> rect, 3x4)
+            R2V = Tr_cam_to_velo * R0_rect^-1     (rect -> velo, 3x4)
+            V2I = P^2_rect * V2R                  (velo -> image2, 3x4)
+            I2V = R2V * I2R                       (uv_depth -> velo, 3x4)
+        where I2R maps [u*d, v*d, d, 1] to rect camera coord. Every
+        projection then is a single matmul. The 3d outputs can be written
+        into a caller-provided buffer with out=, e.g. a float32 nx3 array.
+    '''
+
+    def __init__(self, P, V2C, R0, C2V=None, R0_inv=None):
+        '''
+        :param P: 3x4 projection matrix from rect camera coord to image2 coord
+        :param V2C: 3x4 rigid transform from velodyne to reference camera coord
+        :param R0: 3x3 rotation from reference camera coord to rect camera coord
+        :param C2V: optional 3x4 inverse of V2C, computed if not given
+        :param R0_inv: optional inverse of R0, computed if not given
+        '''
+        self.P = np.reshape(P, [3, 4])
+        self.V2C = np.reshape(V2C, [3, 4])
+        self.C2V = inverse_rigid_trans(self.V2C) if C2V is None else C2V
+        self.R0 = np.reshape(R0, [3, 3])
+        self.R0_inv = np.linalg.inv(self.R0) if R0_inv is None else R0_inv
+
+        # Camera intrinsics and extrinsics
+        self.c_u = self.P[0, 2]
+        self.c_v = self.P[1, 2]
+        self.f_u = self.P[0, 0]
+        self.f_v = self.P[1, 1]
+        self.b_x = self.P[0, 3] / (-self.f_u)  # relative
+        self.b_y = self.P[1, 3] / (-self.f_v)
+
+        # Composite transforms
+        self.V2R = np.dot(self.R0, self.V2C)
+        self.R2V = np.hstack((np.dot(self.C2V[:, 0:3], self.R0_inv), self.C2V[:, 3:4]))
+        self.V2I = np.dot(self.P, hom_mat(self.V2R))
+        self.I2R = np.array([[1 / self.f_u, 0, -self.c_u / self.f_u, self.b_x],
+                             [0, 1 / self.f_v, -self.c_v / self.f_v, self.b_y],
+                             [0, 0, 1, 0]])
+        self.I2V = np.dot(self.R2V, hom_mat(self.I2R))
+
+    def cart2hom(self, pts_3d):
+        ''' Input: nx3 points in Cartesian
+            Oupput: nx4 points in Homogeneous by pending 1
+        '''
+        n = pts_3d.shape[0]
+        pts_3d_hom = np.hstack((pts_3d, np.ones((n, 1))))
+        return pts_3d_hom
+
+    # ===========================
+    # ------- 3d to 3d ----------
+    # ===========================
+    def project_velo_to_ref(self, pts_3d_velo, out=None):
+        return transform_points(pts_3d_velo, self.V2C, out)
+
+    def project_ref_to_velo(self, pts_3d_ref, out=None):
+        return transform_points(pts_3d_ref, self.C2V, out)
+
+    def project_rect_to_ref(self, pts_3d_rect, out=None):
+        ''' Input and Output are nx3 points '''
+        return rotate_points(pts_3d_rect, self.R0_inv, out)
+
+    def project_ref_to_rect(self, pts_3d_ref, out=None):
+        ''' Input and Output are nx3 points '''
+        return rotate_points(pts_3d_ref, self.R0, out)
+
+    def project_rect_to_velo(self, pts_3d_rect, out=None):
+        ''' Input: nx3 points in rect camera coord.
+            Output: nx3 points in velodyne coord.
+        '''
+        return transform_points(pts_3d_rect, self.R2V, out)
+
+    def project_velo_to_rect(self, pts_3d_velo, out=None):
+        return transform_points(pts_3d_velo, self.V2R, out)
+
+    # ===========================
+    # ------- 3d to 2d ----------
+    # ===========================
+    def project_rect_to_image(self, pts_3d_rect):
+        ''' Input: nx3 points in rect camera coord.
+            Output: nx2 points in image2 coord.
+        '''
+        return project_points(pts_3d_rect, self.P)
+
+    def project_velo_to_image(self, pts_3d_velo):
+        ''' Input: nx3 points in velodyne coord.
+            Output: nx2 points in image2 coord.
+        '''
+        return project_points(pts_3d_velo, self.V2I)
+
+    # ===========================
+    # ------- 2d to 3d ----------
+    # ===========================
+    def project_image_to_rect(self, uv_depth, out=None):
+        ''' Input: nx3 first two channels are uv, 3rd channel
+                   is depth in rect camera coord.
+            Output: nx3 points in rect camera coord.
+        '''
+        return transform_points(uv_to_hom(uv_depth), self.I2R, out)
+
+    def project_image_to_velo(self, uv_depth, out=None):
+        return transform_points(uv_to_hom(uv_depth), self.I2V, out)
+
+
+def benchmark(num_points, dtype, repeats=5):
+    ''' Time the projections of a KITTI-like calibration on every available backend '''
+    rng = np.random.RandomState(0)
+    P = np.array([[721.5, 0, 609.6, 44.9], [0, 721.5, 172.9, 0.2], [0, 0, 1, 0.003]])
+    V2C = np.array([[0.0075, -1.0, -0.0006, -0.0041],
+                    [0.0148, 0.0007, -0.9999, -0.0763],
+                    [0.9999, 0.0075, 0.0148, -0.2718]])
+    calib = CameraCalibration(P, V2C, np.eye(3))
+    pts = (rng.rand(num_points, 3) * [80, 40, 3] + [0, -20, -2]).astype(dtype)
+    out = np.empty((num_points, 3), dtype=dtype)
+    previous = get_backend()
+    for name in BACKENDS:
+        try:
+            set_backend(name)
+        except ImportError:
+            print('{:>6}: not available'.format(name))
+            continue
+        calib.project_velo_to_rect(pts, out)  # warm up, e.g. numba compilation
+        start = time.time()
+        for _ in range(repeats):
+            calib.project_velo_to_rect(pts, out)
+            calib.project_velo_to_image(pts)
+        print('{:>6}: {:.1f} ms per velo_to_rect + velo_to_image'.format(
+            name, (time.time() - start) / repeats * 1000))
+    set_backend(previous)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the calibration backends')
+    parser.add_argument('--num_points', type=int, default=2000000)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float64'])
+    args = parser.parse_args()
+
+    benchmark(args.num_points, np.dtype(args.dtype))
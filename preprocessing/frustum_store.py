@@ -0,0 +1,415 @@
+''' Streaming, columnar on-disk storage for frustum datasets.
+
+The frustum extractors used to keep every frustum in nine parallel lists and
+pickle them at the end, so their memory grew with the dataset. A frustum
+store is written incrementally instead, a chunk of records at a time, into
+    <name>.frustums/meta.json     number of frustums, field dtypes and shapes,
+                                  class name vocabulary
+    <name>.frustums/offsets.bin   int64 row offsets of the ragged fields
+    <name>.frustums/<field>.bin   one raw row-major column per field
+point_clouds and mask_logits are ragged: frustum i owns their rows
+offsets[i]:offsets[i + 1]. All other fields hold one fixed-shape row per
+frustum and class_names are stored as int16 codes into the vocabulary.
+
+add_frustum_rotation materializes the frustum-rotated point clouds and box
+centers of a store as extra columns, so training and evaluation with
+frustum rotation skip the per-access rotation.
+
+The legacy pickle layout (one pickled list per field, in FRUSTUM_FIELDS
+order) can still be produced: the store is then converted on close, each
+list streamed into the pickle a chunk of items at a time. Its readers still
+load the whole pickle into memory, so stores are the default output. Existing pickles are
+converted to stores, optionally with the rotated columns, with
+    python frustum_store.py [--frustum_rotate] <name>.pickle [<name>.pickle ...]
+'''
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+STORE_SUFFIX = '.frustums'
+META_FILE = 'meta.json'
+OFFSETS_FILE = 'offsets.bin'
+
+# fields of a frustum pickle, in dump order
+FRUSTUM_FIELDS = ['ids', 'boxes_2d', 'boxes_3d', 'point_clouds', 'mask_logits',
+                  'class_names', 'heading_angles', 'sizes', 'frustum_rotation_angles']
+RGB_DETECTION_FIELDS = ['ids', 'boxes_2d', 'point_clouds', 'class_names',
+                        'frustum_rotation_angles', 'probs']
+
+# optional fields materialized by add_frustum_rotation
+ROTATED_FIELDS = ['rotated_point_clouds', 'rotated_centers']
+# stores of frames and of their objects, to crop frustums at training time:
+# one record per frame with its image FOV points sorted by image row
+FRAME_FIELDS = ['ids', 'point_clouds', 'points_2d', 'calibs']
+# one record per object, frame_indices are records of the frame store
+OBJECT_FIELDS = ['ids', 'frame_indices', 'boxes_2d', 'boxes_3d', 'class_names',
+                 'heading_angles', 'sizes']
+
+RAGGED_FIELDS = ('point_clouds', 'mask_logits', 'rotated_point_clouds', 'points_2d')
+FIELD_DTYPES = {'ids': np.int64, 'boxes_2d': np.float64, 'boxes_3d': np.float64,
+                'point_clouds': np.float32, 'mask_logits': np.uint8,
+                'class_names': np.int16, 'heading_angles': np.float64,
+                'sizes': np.float64, 'frustum_rotation_angles': np.float64,
+                'probs': np.float64, 'rotated_point_clouds': np.float32,
+                'rotated_centers': np.float64, 'points_2d': np.float32,
+                'calibs': np.float64, 'frame_indices': np.int64}
+# dtypes the extractors used to pickle, restored when writing legacy pickles
+LEGACY_DTYPES = {'mask_logits': np.float64}
+
+
+class FrustumStoreWriter(object):
+    ''' Append frustums to a store, flushing every chunk_size records. '''
+
+    def __init__(self, path, fields=FRUSTUM_FIELDS, chunk_size=256):
+        '''
+        :param path: store directory, usually <name>.frustums
+        :param fields: list of field names, every record has all of them
+        :param chunk_size: int, number of records buffered between writes
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.fields = list(fields)
+        self.chunk_size = chunk_size
+        self.class_names = []
+        self.class_name_to_code = {}
+        self.shapes = {}
+        self.buffers = {field: [] for field in self.fields}
+        self.num_frustums = 0
+        self.num_rows = 0
+        self.files = {field: open(os.path.join(path, field + '.bin'), 'wb')
+                      for field in self.fields}
+        self.offsets_file = open(os.path.join(path, OFFSETS_FILE), 'wb')
+        np.zeros(1, dtype=np.int64).tofile(self.offsets_file)
+        self.offsets = []
+
+    def _class_code(self, class_name):
+        if class_name not in self.class_name_to_code:
+            self.class_name_to_code[class_name] = len(self.class_names)
+            self.class_names.append(class_name)
+        return self.class_name_to_code[class_name]
+
+    def append(self, **record):
+        ''' Add one frustum given as field=value keyword arguments '''
+        num_rows = None
+        for field in self.fields:
+            value = record[field]
+            if field == 'class_names':
+                value = self._class_code(value)
+            value = np.asarray(value, dtype=FIELD_DTYPES[field])
+            if field in RAGGED_FIELDS:
+                if num_rows is None:
+                    num_rows = len(value)
+                elif len(value) != num_rows:
+                    raise ValueError('Ragged fields of a frustum differ in length: '
+                                     '{} vs {}'.format(len(value), num_rows))
+                shape = value.shape[1:]
+            else:
+                shape = value.shape
+            if self.shapes.setdefault(field, shape) != shape:
+                raise ValueError('Field {} has shape {}, expected {}'.format(
+                    field, shape, self.shapes[field]))
+            self.buffers[field].append(value)
+        self.num_rows += num_rows or 0
+        self.offsets.append(self.num_rows)
+        self.num_frustums += 1
+        if len(self.offsets) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, reader):
+        ''' Append all frustums of a FrustumStoreReader '''
+        for i in range(len(reader)):
+            self.append(**reader.record(i))
+
+    def flush(self):
+        for field in self.fields:
+            values = self.buffers[field]
+            if len(values) == 0:
+                continue
+            if field in RAGGED_FIELDS:
+                values = np.concatenate(values)
+            else:
+                values = np.stack(values)
+            np.ascontiguousarray(values).tofile(self.files[field])
+            self.buffers[field] = []
+        np.array(self.offsets, dtype=np.int64).tofile(self.offsets_file)
+        self.offsets = []
+
+    def close(self):
+        self.flush()
+        for fp in self.files.values():
+            fp.close()
+        self.offsets_file.close()
+        meta = {'num_frustums': self.num_frustums, 'num_rows': self.num_rows,
+                'class_names': self.class_names,
+                'fields': {field: {'dtype': np.dtype(FIELD_DTYPES[field]).name,
+                                   'shape': list(self.shapes.get(field, ())),
+                                   'ragged': field in RAGGED_FIELDS}
+                           for field in self.fields}}
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dump_list(items, fp, chunk_size=256):
+    ''' Write the pickle of list(items) without building the list: the list
+        opcodes are written by hand around the pickles of its items, which
+        are appended a chunk at a time. Every item is pickled on its own, so
+        their memo entries may reuse ids, which pickle.load allows.
+    '''
+    fp.write(pickle.PROTO + bytes([2]) + pickle.EMPTY_LIST)
+    chunk = []
+    for item in items:
+        data = pickle.dumps(item, protocol=2)
+        # strip the protocol header and the STOP opcode of the item pickle
+        chunk.append(data[2:-1])
+        if len(chunk) == chunk_size:
+            fp.write(pickle.MARK + b''.join(chunk) + pickle.APPENDS)
+            chunk = []
+    if chunk:
+        fp.write(pickle.MARK + b''.join(chunk) + pickle.APPENDS)
+    fp.write(pickle.STOP)
+
+
+class PickleFrustumWriter(FrustumStoreWriter):
+    ''' Stream frustums into a temporary store and stream the legacy pickle,
+        one field at a time, out of it on close.
+    '''
+
+    def __init__(self, filename, fields=FRUSTUM_FIELDS, chunk_size=256):
+        self.filename = filename
+        super().__init__(filename + STORE_SUFFIX + '.tmp', fields, chunk_size)
+
+    def close(self):
+        super().close()
+        reader = FrustumStoreReader(self.path)
+        with open(self.filename, 'wb') as fp:
+            for field in self.fields:
+                dump_list(reader.iter_list(field), fp, self.chunk_size)
+        del reader
+        shutil.rmtree(self.path)
+
+
+class FrustumStoreReader(object):
+    ''' Memory-mapped read access to the frustums of a store. '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.path = path
+        self.num_frustums = meta['num_frustums']
+        self.class_names = meta['class_names']
+        self.fields = list(meta['fields'])
+        self.offsets = self._memmap(OFFSETS_FILE, np.int64, (self.num_frustums + 1,))
+        self.columns = {}
+        for field, info in meta['fields'].items():
+            num_rows = meta['num_rows'] if info['ragged'] else self.num_frustums
+            self.columns[field] = self._memmap(field + '.bin', np.dtype(info['dtype']),
+                                               (num_rows,) + tuple(info['shape']))
+
+    def _memmap(self, filename, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, filename), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return self.num_frustums
+
+    def get(self, field, i):
+        ''' Value of field for frustum i, ragged fields are zero-copy views '''
+        column = self.columns[field]
+        if field in RAGGED_FIELDS:
+            return column[self.offsets[i]:self.offsets[i + 1]]
+        if field == 'class_names':
+            return self.class_names[column[i]]
+        return column[i]
+
+    def record(self, i):
+        return {field: self.get(field, i) for field in self.fields}
+
+    def iter_list(self, field):
+        ''' Items of a field in the legacy pickle layout '''
+        dtype = LEGACY_DTYPES.get(field, FIELD_DTYPES[field])
+        for i in range(self.num_frustums):
+            if field == 'class_names':
+                yield self.get(field, i)
+            else:
+                # [()] turns 0-d rows into numpy scalars, as the extractors pickled them
+                yield np.array(self.get(field, i), dtype=dtype)[()]
+
+    def to_list(self, field):
+        ''' In-memory list of a field in the legacy pickle layout '''
+        return list(self.iter_list(field))
+
+
+class PickleFrustumReader(object):
+    ''' FrustumStoreReader interface over the lists of a legacy pickle.
+        The whole pickle is loaded into memory.
+    '''
+
+    def __init__(self, filename, fields=FRUSTUM_FIELDS):
+        self.fields = list(fields)
+        with open(filename, 'rb') as fp:
+            self.frustums = {field: pickle.load(fp, encoding='latin1') for field in self.fields}
+
+    def __len__(self):
+        return len(self.frustums[self.fields[0]])
+
+    def get(self, field, i):
+        return self.frustums[field][i]
+
+    def record(self, i):
+        return {field: self.get(field, i) for field in self.fields}
+
+
+def open_frustum_reader(filename, fields=FRUSTUM_FIELDS):
+    ''' Reader of the <filename>.frustums store or of <filename>.pickle '''
+    if os.path.isdir(filename + STORE_SUFFIX):
+        return FrustumStoreReader(filename + STORE_SUFFIX)
+    return PickleFrustumReader(filename + '.pickle', fields)
+
+
+def frustums_exist(filename):
+    return os.path.isdir(filename + STORE_SUFFIX) or os.path.isfile(filename + '.pickle')
+
+
+def remove_frustums(filename):
+    ''' Delete <filename>.frustums and <filename>.pickle if they exist '''
+    if os.path.isdir(filename + STORE_SUFFIX):
+        shutil.rmtree(filename + STORE_SUFFIX)
+    if os.path.isfile(filename + '.pickle'):
+        os.remove(filename + '.pickle')
+
+
+def replace_frustums(src_filename, dst_filename):
+    ''' Move the frustums of src_filename to dst_filename, in either format '''
+    remove_frustums(dst_filename)
+    for suffix in (STORE_SUFFIX, '.pickle'):
+        if os.path.exists(src_filename + suffix):
+            os.rename(src_filename + suffix, dst_filename + suffix)
+
+
+def open_frustum_writer(filename, fields=FRUSTUM_FIELDS, output_format='store'):
+    ''' Writer of <filename>.pickle or of the <filename>.frustums store '''
+    if output_format == 'pickle':
+        return PickleFrustumWriter(filename + '.pickle', fields)
+    elif output_format == 'store':
+        return FrustumStoreWriter(filename + STORE_SUFFIX, fields)
+    raise ValueError('Unknown frustum output format: {}'.format(output_format))
+
+
+def load_frustums(filename, fields=FRUSTUM_FIELDS):
+    ''' Dict of field lists of <filename>.frustums or <filename>.pickle, whose
+        fields are dumped in the order given by fields
+    '''
+    if os.path.isdir(filename + STORE_SUFFIX):
+        reader = FrustumStoreReader(filename + STORE_SUFFIX)
+        return {field: reader.to_list(field) for field in fields}
+    with open(filename + '.pickle', 'rb') as fp:
+        return {field: pickle.load(fp, encoding='latin1') for field in fields}
+
+
+def convert_pickle_to_store(filename, fields=None):
+    ''' Write the frustums of <filename>.pickle into the <filename>.frustums store.
+        fields default to RGB_DETECTION_FIELDS for *_rgb_detection pickles and
+        to FRUSTUM_FIELDS otherwise.
+    '''
+    if fields is None:
+        fields = RGB_DETECTION_FIELDS if filename.endswith('_rgb_detection') else FRUSTUM_FIELDS
+    reader = PickleFrustumReader(filename + '.pickle', fields)
+    tmp_path = filename + STORE_SUFFIX + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    with FrustumStoreWriter(tmp_path, fields) as writer:
+        writer.extend(reader)
+    if os.path.isdir(filename + STORE_SUFFIX):
+        shutil.rmtree(filename + STORE_SUFFIX)
+    os.rename(tmp_path, filename + STORE_SUFFIX)
+    return writer.num_frustums
+
+
+def rotate_points_along_y(points, rotation_angles):
+    ''' Rotate nxC points (first 3 channels XYZ in rect camera coord) around
+        the y-axis by per-point angles, from z to x, in place.
+    '''
+    v_cos = np.cos(rotation_angles)
+    v_sin = np.sin(rotation_angles)
+    x = points[:, 0].copy()
+    z = points[:, 2]
+    points[:, 0] = x * v_cos - z * v_sin
+    points[:, 2] = x * v_sin + z * v_cos
+    return points
+
+
+def add_frustum_rotation(path, chunk_size=4096):
+    ''' Write the frustum-rotated point clouds (rotated_point_clouds, sharing
+        the point_clouds offsets) and, if the store has boxes_3d, the rotated
+        box centers (rotated_centers) into a store. Frustum i is rotated by
+        pi/2 + frustum_rotation_angles[i], as the frustum datasets do.
+    '''
+    reader = FrustumStoreReader(path)
+    if reader.num_frustums == 0:
+        return
+    angles = np.pi / 2.0 + np.asarray(reader.columns['frustum_rotation_angles'], dtype=np.float64)
+    point_clouds = reader.columns['point_clouds']
+    # written aside first, the reader may map the columns of an earlier run
+    with open(os.path.join(path, 'rotated_point_clouds.bin.tmp'), 'wb') as fp:
+        for start in range(0, reader.num_frustums, chunk_size):
+            stop = min(start + chunk_size, reader.num_frustums)
+            row0, row1 = reader.offsets[start], reader.offsets[stop]
+            points = np.array(point_clouds[row0:row1], dtype=FIELD_DTYPES['rotated_point_clouds'])
+            row_angles = np.repeat(angles[start:stop], np.diff(reader.offsets[start:stop + 1]))
+            rotate_points_along_y(points, row_angles).tofile(fp)
+    fields = {'rotated_point_clouds': {'dtype': np.dtype(FIELD_DTYPES['rotated_point_clouds']).name,
+                                       'shape': list(point_clouds.shape[1:]), 'ragged': True}}
+    if 'boxes_3d' in reader.columns:
+        boxes_3d = reader.columns['boxes_3d']
+        centers = (np.asarray(boxes_3d[:, 0, :]) + np.asarray(boxes_3d[:, 6, :])) / 2.0
+        rotate_points_along_y(centers, angles).astype(FIELD_DTYPES['rotated_centers']).tofile(
+            os.path.join(path, 'rotated_centers.bin.tmp'))
+        fields['rotated_centers'] = {'dtype': np.dtype(FIELD_DTYPES['rotated_centers']).name,
+                                     'shape': [3], 'ragged': False}
+
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    meta['fields'].update(fields)
+    for field in fields:
+        os.replace(os.path.join(path, field + '.bin.tmp'), os.path.join(path, field + '.bin'))
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert legacy frustum pickles to frustum stores.')
+    parser.add_argument('pickles', nargs='+',
+                        help='frustum pickle files, e.g. frustum_caronly_train.pickle, or existing .frustums stores')
+    parser.add_argument('--remove_pickle', action='store_true', help='delete each pickle once converted')
+    parser.add_argument('--frustum_rotate', action='store_true',
+                        help='also store the frustum-rotated point clouds and box centers')
+    args = parser.parse_args()
+
+    for pickle_filename in args.pickles:
+        pickle_filename = pickle_filename.rstrip(os.sep)
+        filename = pickle_filename[:-len('.pickle')] if pickle_filename.endswith('.pickle') else pickle_filename
+        if filename.endswith(STORE_SUFFIX):
+            # an existing store, only add the rotated columns
+            filename = filename[:-len(STORE_SUFFIX)]
+        else:
+            num_frustums = convert_pickle_to_store(filename)
+            if args.remove_pickle:
+                os.remove(filename + '.pickle')
+            print('Converted %d frustums to %s' % (num_frustums, filename + STORE_SUFFIX))
+        if args.frustum_rotate:
+            add_frustum_rotation(filename + STORE_SUFFIX)
+            print('Added frustum rotation to %s' % (filename + STORE_SUFFIX))
+    print('Finish converting frustum pickles')
@@ -1,13 +1,32 @@
 import argparse
 import os
+from multiprocessing import Pool
 
 import numpy as np
-import skimage.io as skio
 import matplotlib.pyplot as plt
+from PIL import Image
 
+import image_util
 import kitti_util
 
 
+def rasterize_depth(pts_2d, depth, height, width):
+    ''' Scatter points into a height x width depth map, keeping the nearest
+        depth of every pixel. Pixels without points are -1.
+    '''
+    pts_2d = np.round(pts_2d).astype(int)
+    pixel_ids = pts_2d[:, 1] * width + pts_2d[:, 0]
+    # sort by pixel, then by depth, and keep the first point of each pixel
+    order = np.lexsort((depth, pixel_ids))
+    pixel_ids = pixel_ids[order]
+    nearest = np.ones(len(pixel_ids), dtype=bool)
+    nearest[1:] = pixel_ids[1:] != pixel_ids[:-1]
+
+    depth_map = np.zeros((height, width)) - 1
+    depth_map.flat[pixel_ids[nearest]] = depth[order][nearest]
+    return depth_map
+
+
 def generate_dispariy_from_velo(pc_velo, height, width, calib):
     pts_2d = calib.project_velo_to_image(pc_velo)
 
@@ -18,12 +37,7 @@ def generate_dispariy_from_velo(pc_velo, height, width, calib):
     imgfov_pc_velo = pc_velo[fov_inds, :]
     imgfov_pts_2d  = pts_2d[fov_inds, :]
     imgfov_pc_rect = calib.project_velo_to_rect(imgfov_pc_velo)
-    depth_map      = np.zeros((height, width)) - 1
-    imgfov_pts_2d  = np.round(imgfov_pts_2d).astype(int)
-
-    for i in range(imgfov_pts_2d.shape[0]):
-        depth = imgfov_pc_rect[i, 2]
-        depth_map[int(imgfov_pts_2d[i, 1]), int(imgfov_pts_2d[i, 0])] = depth
+    depth_map      = rasterize_depth(imgfov_pts_2d, imgfov_pc_rect[:, 2], height, width)
 
     baseline = 0.54
 
@@ -31,46 +45,87 @@ def generate_dispariy_from_velo(pc_velo, height, width, calib):
     return disp_map
 
 
+def save_disparity(filename, disp, fmt):
+    ''' Save a disparity map without its extension in one of the formats
+        npy: dense float64 array, empty pixels are negative
+        png: KITTI-style uint16 png of disparity * 256, empty pixels are 0
+        coo: npz of rows, cols and float32 values of the valid pixels
+    '''
+    valid = disp > 0
+    if fmt == 'npy':
+        np.save(filename, disp)
+    elif fmt == 'png':
+        disp_png = np.zeros(disp.shape, dtype=np.uint16)
+        disp_png[valid] = np.clip(np.round(disp[valid] * 256), 1, 65535)
+        Image.fromarray(disp_png).save(filename + '.png')
+    elif fmt == 'coo':
+        rows, cols = np.nonzero(valid)
+        np.savez(filename, rows=rows.astype(np.uint16), cols=cols.astype(np.uint16),
+                 values=disp[rows, cols].astype(np.float32), shape=np.array(disp.shape))
+    else:
+        raise ValueError('Unknown disparity format: {}'.format(fmt))
+
+
+def process_frame(args, predix):
+    calib_file = '{}/{}.txt'.format(args.calib_dir, predix)
+    calib = kitti_util.load_calibration(calib_file)
+    # load point cloud
+    lidar = np.fromfile(args.lidar_dir + '/' + predix + '.bin', dtype=np.float32).reshape((-1, 4))[:, :3]
+    # KITTI frames differ slightly in size, so probe every header
+    width, height = image_util.get_image_size('{}/{}.png'.format(args.image_dir, predix))
+    disp = generate_dispariy_from_velo(lidar, height, width, calib)
+    save_disparity(args.disparity_dir + '/' + predix, disp, args.format)
+    # skio.imsave(f'disp_{predix}.png', disp)
+    return predix
+
+
+def _init_worker(worker_args):
+    global _worker_args
+    _worker_args = worker_args
+
+
+def _process_frame_worker(predix):
+    return process_frame(_worker_args, predix)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate Disparity')
     parser.add_argument('--data_path', type=str, default='~/Kitti/object/training/')
     parser.add_argument('--split_file', type=str, default='~/Kitti/object/train.txt')
+    parser.add_argument('--format', type=str, default='npy', choices=['npy', 'png', 'coo'],
+                        help='dense npy, sparse uint16 png (x256) or sparse coo npz')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
     args = parser.parse_args()
 
     assert os.path.isdir(args.data_path)
-    lidar_dir = args.data_path + '/velodyne/'
-    calib_dir = args.data_path + '/calib/'
-    image_dir = args.data_path + '/image_2/'
-    disparity_dir = args.data_path + '/disparity/'
+    args.lidar_dir = args.data_path + '/velodyne/'
+    args.calib_dir = args.data_path + '/calib/'
+    args.image_dir = args.data_path + '/image_2/'
+    args.disparity_dir = args.data_path + '/disparity/'
 
-    assert os.path.isdir(lidar_dir)
-    assert os.path.isdir(calib_dir)
-    assert os.path.isdir(image_dir)
+    assert os.path.isdir(args.lidar_dir)
+    assert os.path.isdir(args.calib_dir)
+    assert os.path.isdir(args.image_dir)
 
-    if not os.path.isdir(disparity_dir):
-        os.makedirs(disparity_dir)
+    if not os.path.isdir(args.disparity_dir):
+        os.makedirs(args.disparity_dir)
 
-    lidar_files = [x for x in os.listdir(lidar_dir) if x[-3:] == 'bin']
+    lidar_files = [x for x in os.listdir(args.lidar_dir) if x[-3:] == 'bin']
     lidar_files = sorted(lidar_files)
 
     assert os.path.isfile(args.split_file)
     with open(args.split_file, 'r') as f:
-        file_names = [x.strip() for x in f.readlines()]
+        file_names = set(x.strip() for x in f.readlines())
 
     print(f'found {len(lidar_files)} files ...')
 
-    for fn in lidar_files:
-        predix = fn[:-4]
-        if predix not in file_names:
-            continue
-        calib_file = '{}/{}.txt'.format(calib_dir, predix)
-        calib = kitti_util.Calibration(calib_file)
-        # load point cloud
-        lidar = np.fromfile(lidar_dir + '/' + fn, dtype=np.float32).reshape((-1, 4))[:, :3]
-        image_file = '{}/{}.png'.format(image_dir, predix)
-        image = skio.imread(image_file)
-        height, width = image.shape[:2]
-        disp = generate_dispariy_from_velo(lidar, height, width, calib)
-        np.save(disparity_dir + '/' + predix, disp)
-        # skio.imsave(f'disp_{predix}.png', disp)
-        print('Finish Disparity {}'.format(predix))
+    predixes = [fn[:-4] for fn in lidar_files if fn[:-4] in file_names]
+    if args.workers > 1:
+        with Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+            for predix in pool.imap_unordered(_process_frame_worker, predixes, chunksize=8):
+                print('Finish Disparity {}'.format(predix))
+    else:
+        for predix in predixes:
+            process_frame(args, predix)
+            print('Finish Disparity {}'.format(predix))
@@ -1,13 +1,21 @@
 import argparse
+import json
 import os
+import queue
+import threading
+import time
+import zlib
+from multiprocessing import Pool
 
 import imageio
-import imagesize
 import numpy as np
 import scipy.misc as ssc
+import torch
 from PIL import Image
 
+import image_util
 import kitti_util
+from sparsify import sparsify
 
 
 def project_disp_to_points(calib, disp, max_high):
@@ -15,28 +23,234 @@ def project_disp_to_points(calib, disp, max_high):
     baseline = 0.54
     mask = disp > 0
     depth = calib.f_u * baseline / (disp + 1. - mask)
-    rows, cols = depth.shape
-    c, r = np.meshgrid(np.arange(cols), np.arange(rows))
-    points = np.stack([c, r, depth])
-    points = points.reshape((3, -1))
-    points = points.T
-    points = points[mask.reshape(-1)]
-    cloud = calib.project_image_to_velo(points)
+    rays = kitti_util.get_ray_table(calib, depth.shape)
+    cloud = rays.project(depth, mask)
     valid = (cloud[:, 0] >= 0) & (cloud[:, 2] < max_high)
     return cloud[valid]
 
+
+def project_disps_to_points(calibs, disps, max_high, baseline=0.54, num_threads=None):
+    ''' Batched project_disp_to_points over B frames of the same size.
+
+    Input:
+        calibs: list of B Calibration, one per frame
+        disps: BxHxW disparity maps, numpy array or tensor
+        max_high: points higher than this (velo z) are dropped
+        num_threads: torch CPU threads used by this call, None keeps the
+            current setting; the previous setting is restored on return
+    Output:
+        points: Nx3 float32 tensor, the velodyne points of all frames
+        offsets: (B+1) int64 tensor, frame i is points[offsets[i]:offsets[i+1]]
+    '''
+    if num_threads is None:
+        return _project_disps_to_points(calibs, disps, max_high, baseline)
+    previous_num_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        return _project_disps_to_points(calibs, disps, max_high, baseline)
+    finally:
+        torch.set_num_threads(previous_num_threads)
+
+
+def _project_disps_to_points(calibs, disps, max_high, baseline):
+    disps = torch.as_tensor(disps, dtype=torch.float32)
+    batch_size, rows, cols = disps.shape
+    rays = [kitti_util.get_ray_table(calib, (rows, cols)) for calib in calibs]
+    directions = torch.from_numpy(np.stack([r.directions for r in rays]))  # BxHxWx3
+    ray_offsets = torch.from_numpy(np.stack([r.offset for r in rays]))  # Bx3
+    f_u = torch.tensor([calib.f_u for calib in calibs], dtype=torch.float32)
+
+    mask = disps > 0
+    depth = (f_u * baseline).view(batch_size, 1, 1) / torch.where(mask, disps, torch.ones_like(disps))
+    cloud = torch.addcmul(ray_offsets.view(batch_size, 1, 1, 3), directions, depth.unsqueeze(-1))
+    valid = mask & (cloud[..., 0] >= 0) & (cloud[..., 2] < max_high)
+
+    points = cloud[valid]
+    counts = valid.view(batch_size, -1).sum(dim=1)
+    offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)])
+    return points, offsets
+
+
 def project_depth_to_points(calib, depth, max_high):
-    rows, cols = depth.shape
-    c, r = np.meshgrid(np.arange(cols), np.arange(rows))
-    points = np.stack([c, r, depth])
-    points = points.reshape((3, -1))
-    points = points.T
-    mask = (c%2 == 0) & (r%2==0)
-    points = points[mask.reshape(-1)]
-    cloud = calib.project_image_to_velo(points)
+    rays = kitti_util.get_ray_table(calib, depth.shape)
+    cloud = rays.project(depth, step=2)
     valid = (cloud[:, 0] >= 0) & (cloud[:, 2] < max_high)
     return cloud[valid]
 
+
+def load_frame(args, fn):
+    ''' Read the calibration and disparity (or depth) map of one frame. '''
+    predix = fn[:-9]
+    calib_file = '{}/{}.txt'.format(args.calib_dir, predix)
+    calib = kitti_util.load_calibration(calib_file)
+    # disp_map = ssc.imread(args.disparity_dir + '/' + fn) / 256.
+    if fn[-3:] == 'png':
+        disp_map = np.array(Image.open(args.disparity_dir + '/' + fn))
+    elif fn[-3:] == 'npy':
+        disp_map = Image.fromarray(np.load(args.disparity_dir + '/' + fn))
+        size = image_util.get_image_size(os.path.join(args.image_dir, "{}.png".format(predix)))
+        disp_map.resize(size, Image.BILINEAR)
+        disp_map = np.array(disp_map)
+    else:
+        assert False
+    return calib, disp_map
+
+
+def convert_frame(args, calib, disp_map, predix):
+    ''' Back-project one disparity (or depth) map to a nx4 float32 cloud. '''
+    if not args.is_depth:
+        disp_map = (disp_map*256).astype(np.uint16)/256.
+        lidar = project_disp_to_points(calib, disp_map, args.max_high)
+    else:
+        disp_map = (disp_map).astype(np.float32) / 255.0 * 80
+        disp_map[disp_map > 50] = 50
+        disp_map[disp_map < 1] = 1
+        # print(np.max(disp_map), np.min(disp_map))
+        lidar = project_depth_to_points(calib, disp_map, args.max_high)
+    lidar = sparsify(lidar, args.sparsify, voxel_size=args.voxel_size,
+                     ref_distance=args.ref_distance, min_keep_ratio=args.min_keep_ratio,
+                     num_beams=args.num_beams, azimuth_res=args.azimuth_res,
+                     seed=zlib.crc32(predix.encode()))
+    # pad 1 in the indensity dimension
+    lidar = np.concatenate([lidar, np.ones((lidar.shape[0], 1))], 1)
+    return lidar.astype(np.float32)
+
+
+def conversion_options(args):
+    ''' Options the .bin of a frame depends on, recorded in the manifest. '''
+    return {'max_high': args.max_high, 'is_depth': args.is_depth,
+            'sparsify': args.sparsify, 'voxel_size': args.voxel_size,
+            'ref_distance': args.ref_distance, 'min_keep_ratio': args.min_keep_ratio,
+            'num_beams': args.num_beams, 'azimuth_res': args.azimuth_res}
+
+
+def is_up_to_date(args, fn):
+    ''' True if the .bin of a frame is newer than its disparity and calib. '''
+    predix = fn[:-9]
+    out_file = '{}/{}.bin'.format(args.save_dir, predix)
+    if not os.path.isfile(out_file):
+        return False
+    out_mtime = os.path.getmtime(out_file)
+    in_files = [os.path.join(args.disparity_dir, fn),
+                '{}/{}.txt'.format(args.calib_dir, predix)]
+    return all(os.path.getmtime(f) < out_mtime for f in in_files)
+
+
+def process_frame(args, fn, same_options=False, loaded=None):
+    ''' Generate the pseudo-LiDAR of one frame and return its manifest entry.
+        The frame is skipped if its output is up to date and same_options
+        tells that it was generated with the current conversion options.
+        loaded is the (calib, disp_map, read_time) of the frame if it was
+        already read by read_ahead, otherwise the frame is read here.
+    '''
+    predix = fn[:-9]
+    if loaded is None and not args.force and same_options and is_up_to_date(args, fn):
+        return {'frame': predix, 'skipped': True}
+    start = time.time()
+    if loaded is None:
+        calib, disp_map = load_frame(args, fn)
+        read_time = time.time() - start
+    else:
+        calib, disp_map, read_time = loaded
+        start -= read_time
+    lidar = convert_frame(args, calib, disp_map, predix)
+    lidar.tofile('{}/{}.bin'.format(args.save_dir, predix))
+    return {'frame': predix, 'skipped': False, 'options': conversion_options(args),
+            'num_points': int(lidar.shape[0]),
+            'read_time': read_time, 'total_time': time.time() - start}
+
+
+def read_ahead(args, jobs, depth):
+    ''' Yield (fn, same_options, loaded) for the (fn, same_options) jobs,
+        loaded as taken by process_frame. A reader thread loads the calib and
+        disparity of up to depth frames ahead of the caller, so disk reads and
+        decoding overlap the conversion of the current frame. loaded is None
+        for the frames that are up to date, process_frame skips them.
+    '''
+    if depth < 1:
+        for fn, same_options in jobs:
+            yield fn, same_options, None
+        return
+    frames = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the caller stopped consuming, instead of blocking forever
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for fn, same_options in jobs:
+                if not args.force and same_options and is_up_to_date(args, fn):
+                    loaded = None
+                else:
+                    start = time.time()
+                    calib, disp_map = load_frame(args, fn)
+                    loaded = (calib, disp_map, time.time() - start)
+                if not put((fn, same_options, loaded)):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _init_worker(worker_args):
+    global _worker_args
+    _worker_args = worker_args
+
+
+def _process_frames_worker(jobs):
+    return [process_frame(_worker_args, fn, same_options, loaded)
+            for fn, same_options, loaded in read_ahead(_worker_args, jobs, _worker_args.read_ahead)]
+
+
+def generate_lidar(args, disps, previous=None):
+    ''' Convert all disparity maps in disps, fanning frames out over
+        args.workers processes. Returns the manifest entries sorted by frame.
+        previous holds the manifest entries of the last run by frame, frames
+        converted with other options than the current ones are regenerated.
+    '''
+    previous = previous or {}
+    options = conversion_options(args)
+    jobs = [(fn, previous.get(fn[:-9], {}).get('options') == options) for fn in disps]
+    manifest = []
+    if args.workers > 1:
+        # every worker reads ahead within its own chunk of frames
+        chunksize = max(1, min(16, len(jobs) // (4 * args.workers)))
+        chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+        with Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+            for entries in pool.imap_unordered(_process_frames_worker, chunks):
+                for entry in entries:
+                    manifest.append(entry)
+                    print('{} Depth {}'.format('Skip' if entry['skipped'] else 'Finish', entry['frame']))
+    else:
+        for fn, same_options, loaded in read_ahead(args, jobs, args.read_ahead):
+            entry = process_frame(args, fn, same_options, loaded)
+            manifest.append(entry)
+            print('{} Depth {}'.format('Skip' if entry['skipped'] else 'Finish', entry['frame']))
+    return sorted(manifest, key=lambda entry: entry['frame'])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate Libar')
     parser.add_argument('--calib_dir', type=str,
@@ -49,6 +263,27 @@ if __name__ == '__main__':
                         default='../../kitti/training/image_2' )
     parser.add_argument('--max_high', type=int, default=0.5)
     parser.add_argument('--is_depth', action='store_true')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--read_ahead', type=int, default=4,
+                        help='number of frames read ahead of the conversion, 0 to disable')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate frames whose output is already up to date')
+    parser.add_argument('--sparsify', type=str, default='none',
+                        choices=['none', 'voxel', 'distance', 'beam'],
+                        help='downsample the generated pseudo-LiDAR')
+    parser.add_argument('--voxel_size', type=float, default=0.1,
+                        help='voxel edge length (m) for --sparsify voxel')
+    parser.add_argument('--ref_distance', type=float, default=20.0,
+                        help='range (m) beyond which --sparsify distance keeps every point')
+    parser.add_argument('--min_keep_ratio', type=float, default=0.1,
+                        help='lowest keep ratio of near points for --sparsify distance')
+    parser.add_argument('--num_beams', type=int, default=64,
+                        help='number of simulated laser beams for --sparsify beam')
+    parser.add_argument('--azimuth_res', type=float, default=0.2,
+                        help='azimuth resolution (deg) for --sparsify beam')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='manifest path, defaults to <save_dir>/manifest.json')
 
     args = parser.parse_args()
 
@@ -61,31 +296,18 @@ if __name__ == '__main__':
     disps = [x for x in os.listdir(args.disparity_dir) if x[-3:] == 'png' or x[-3:] == 'npy']
     disps = sorted(disps)
 
-    for fn in disps:
-        predix = fn[:-9]
-        calib_file = '{}/{}.txt'.format(args.calib_dir, predix)
-        calib = kitti_util.Calibration(calib_file)
-        # disp_map = ssc.imread(args.disparity_dir + '/' + fn) / 256.
-        if fn[-3:] == 'png':
-            disp_map = np.array(Image.open(args.disparity_dir + '/' + fn))
-        elif fn[-3:] == 'npy':
-            disp_map = Image.fromarray(np.load(args.disparity_dir + '/' + fn))
-            size = imagesize.get(os.path.join(args.image_dir, "{}.png".format(predix)))
-            disp_map.resize(size, Image.BILINEAR)
-            disp_map = np.array(disp_map)
-        else:
-            assert False
-        if not args.is_depth:
-            disp_map = (disp_map*256).astype(np.uint16)/256.
-            lidar = project_disp_to_points(calib, disp_map, args.max_high)
-        else:
-            disp_map = (disp_map).astype(np.float32) / 255.0 * 80
-            disp_map[disp_map > 50] = 50
-            disp_map[disp_map < 1] = 1
-            # print(np.max(disp_map), np.min(disp_map))
-            lidar = project_depth_to_points(calib, disp_map, args.max_high)
-        # pad 1 in the indensity dimension
-        lidar = np.concatenate([lidar, np.ones((lidar.shape[0], 1))], 1)
-        lidar = lidar.astype(np.float32)
-        lidar.tofile('{}/{}.bin'.format(args.save_dir, predix))
-        print('Finish Depth {}'.format(predix))
+    manifest_file = args.manifest or os.path.join(args.save_dir, 'manifest.json')
+    previous = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            previous = {entry['frame']: entry for entry in json.load(f)}
+
+    manifest = generate_lidar(args, disps, previous)
+    # keep options, timings and point counts of the frames skipped in this run
+    manifest = [dict(previous[entry['frame']], skipped=True) if entry['skipped'] else entry
+                for entry in manifest]
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    num_skipped = sum(entry['skipped'] for entry in manifest)
+    print('Generated {} frames, skipped {} up-to-date frames'.format(
+        len(manifest) - num_skipped, num_skipped))
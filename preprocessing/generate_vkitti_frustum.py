@@ -5,12 +5,22 @@ Date: February 2020
 
 from __future__ import print_function
 
-import pickle
 import argparse
+import hashlib
+import json
+import shutil
+import zlib
 
 from collections import defaultdict
+from functools import lru_cache
+from multiprocessing import Pool
 
 from vkitti.vkitti_object import *
+import box_util
+from image_grid import ImageGridIndex
+from frustum_store import FRAME_FIELDS, FRUSTUM_FIELDS, OBJECT_FIELDS, RGB_DETECTION_FIELDS, \
+    STORE_SUFFIX, FrustumStoreReader, FrustumStoreWriter, frustums_exist, load_frustums, \
+    open_frustum_reader, open_frustum_writer, replace_frustums
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(BASE_DIR)
@@ -27,7 +37,7 @@ def in_hull(p, hull):
 
 def extract_pc_in_box3d(pc, box3d):
     ''' pc: (N,3), box3d: (8,3) '''
-    box3d_roi_inds = in_hull(pc[:, 0:3], box3d)
+    box3d_roi_inds = box_util.points_in_box3d(pc[:, 0:3], box3d)
     return pc[box3d_roi_inds, :], box3d_roi_inds
 
 
@@ -158,151 +168,297 @@ def test(path, scene):
         mlab.savefig('{}_{}.jpg'.format(scene, sub_scene), figure=fig)
 
 
-def random_shift_box2d(box2d, shift_ratio=0.1):
-    ''' Randomly shift box center, randomly scale width and height '''
-    r = shift_ratio
-    xmin, ymin, xmax, ymax = box2d
-    h = ymax - ymin
-    w = xmax - xmin
-    cx = (xmin + xmax) / 2.0
-    cy = (ymin + ymax) / 2.0
-    cx2 = cx + w * r * (np.random.random() * 2 - 1)
-    cy2 = cy + h * r * (np.random.random() * 2 - 1)
-    h2 = h * (1 + np.random.random() * 2 * r - r)  # 0.9 to 1.1
-    w2 = w * (1 + np.random.random() * 2 * r - r)  # 0.9 to 1.1
-    return np.array(
-        [cx2 - w2 / 2.0, cy2 - h2 / 2.0, cx2 + w2 / 2.0, cy2 + h2 / 2.0])
+@lru_cache(maxsize=2)
+def get_dataset(path, split, scene, sub_scene):
+    ''' Per-process cache, so consecutive jobs of a sub-scene share its labels
+        and calibrations.
+    '''
+    return vkitti_object(path, split, scene, sub_scene)
+
+
+def frame_seed(scene, sub_scene, data_idx):
+    ''' Stable RNG seed of the box2d perturbations of a frame '''
+    return zlib.crc32('{}/{}/{}'.format(scene, sub_scene, data_idx).encode())
+
+
+def file_fingerprint(filename):
+    st = os.stat(filename)
+    return '{}:{}:{}'.format(filename, st.st_size, st.st_mtime_ns)
+
+
+def frame_fingerprint(dataset, data_idx, cam_idx, pred_depth, params):
+    ''' Hash of everything the frustums of a frame are computed from: the
+        depth map and image files (by size and mtime), the calibration, the
+        label rows and the extraction parameters, including the frame seed.
+    '''
+    h = hashlib.sha1()
+    h.update(file_fingerprint(dataset.get_depth_filename(data_idx, cam_idx, pred_depth)).encode())
+    h.update(file_fingerprint(dataset.get_image_filename(data_idx, cam_idx)).encode())
+    h.update(dataset.intrinsics[cam_idx][data_idx].tobytes())
+    h.update(dataset.extrinsics[cam_idx][data_idx].tobytes())
+    h.update(repr(dataset.get_label_records(data_idx, cam_idx).tolist()).encode())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def extract_frustum_frames(writer, path, split, scene, sub_scene, frames,
+                           perturb_box2d=False, augmentX=1,
+                           type_whitelist=['Car'], pred_depth=False):
+    ''' Extract the frustums of the given frames of a sub-scene and append
+        them to writer as they are produced. The box2d perturbations of
+        every frame draw from an RNG seeded by frame_seed.
+
+    Output:
+        stats: dict with number of rejected boxes, positive and all points,
+            and the list of the number of frustums of every frame
+    '''
+    cam_idx = 0
+    dataset = get_dataset(path, split, scene, sub_scene)
+    stats = {'rejected': 0, 'pos_cnt': 0, 'all_cnt': 0, 'counts': []}
+
+    for data_idx in frames:
+        idx = "{}/{}/{}".format(scene, sub_scene, data_idx)
+        print('------------- ', idx)
+        rng = np.random.RandomState(frame_seed(scene, sub_scene, data_idx))
+        num_frustums = writer.num_frustums
+
+        calib = dataset.get_calibration(data_idx, cam_idx) # 3 by 4 matrix
+        objects = dataset.get_label_objects(data_idx, cam_idx)
+        pc_rect, pc_image_coord, velo_x = dataset.get_rect_points(data_idx, cam_idx, pred_depth)
+        img_width, img_height = dataset.get_image_size(data_idx, cam_idx)
+        img_fov_inds = get_rect_in_image_fov(pc_image_coord, velo_x,
+            0, 0, img_width, img_height)
+        fov_index = ImageGridIndex(pc_image_coord, img_fov_inds)
+
+        # 3D BOX: Get pts rect in every 3d box of the frame at once
+        box3d_pts_3d_list = [utils.compute_box_3d(obj, calib.P)[1] for obj in objects]
+        in_box3d = box_util.points_in_boxes3d(pc_rect[:, 0:3],
+            np.reshape(box3d_pts_3d_list, (-1, 8, 3)))
+
+        for obj_idx in range(len(objects)):
+            if objects[obj_idx].type not in type_whitelist :continue
+
+            # 2D BOX: Get pts rect backprojected
+            box2d = objects[obj_idx].box2d
+            for _ in range(augmentX):
+                # Augment data by box2d perturbation
+                if perturb_box2d:
+                    xmin, ymin, xmax, ymax = box_util.random_shift_box2d(box2d, rng=rng)
+                else:
+                    xmin, ymin, xmax, ymax = box2d
+                box_fov_inds = fov_index.query(xmin, ymin, xmax, ymax)
+                pc_in_box_fov = pc_rect[box_fov_inds,:]
+                # Get frustum angle (according to center pixel in 2D BOX)
+                box2d_center = np.array([(xmin+xmax)/2.0, (ymin+ymax)/2.0])
+                uvdepth = np.zeros((1,3))
+                uvdepth[0,0:2] = box2d_center
+                uvdepth[0,2] = 20 # some random depth
+                box2d_center_rect = calib.project_image_to_rect(uvdepth)
+                frustum_angle = -1 * np.arctan2(box2d_center_rect[0,2],
+                    box2d_center_rect[0,0])
+                # 3D BOX: Get pts velo in 3d box
+                obj = objects[obj_idx]
+                box3d_pts_3d = box3d_pts_3d_list[obj_idx]
+                label = in_box3d[obj_idx][box_fov_inds].astype(np.float64)
+                # Get 3D BOX heading
+                heading_angle = obj.ry
+                # Get 3D BOX size
+                box3d_size = np.array([obj.l, obj.w, obj.h])
+
+                # Reject too far away object or object without points
+                if ymax-ymin<25 or np.sum(label)==0:
+                    stats['rejected'] += 1
+                    continue
+
+                writer.append(ids=data_idx,
+                              boxes_2d=np.array([xmin,ymin,xmax,ymax]),
+                              boxes_3d=box3d_pts_3d,
+                              point_clouds=pc_in_box_fov,
+                              mask_logits=label,
+                              class_names=objects[obj_idx].type,
+                              heading_angles=heading_angle,
+                              sizes=box3d_size,
+                              frustum_rotation_angles=frustum_angle)
+
+                # collect statistics
+                stats['pos_cnt'] += np.sum(label)
+                stats['all_cnt'] += pc_in_box_fov.shape[0]
+        stats['counts'].append(writer.num_frustums - num_frustums)
+
+    return stats
+
+
+def _extract_frustum_job(job):
+    scene, sub_scene, frames, shard_path, kwargs = job
+    with FrustumStoreWriter(shard_path) as writer:
+        return extract_frustum_frames(
+            writer, scene=scene, sub_scene=sub_scene, frames=frames, **kwargs)
+
+
+def load_frame_manifest(manifest_filename):
+    ''' {(sub_scene, frame): entry} of a scene manifest, every entry also gets
+        the index of the first frustum of its frame in the scene output
+    '''
+    with open(manifest_filename, 'r') as f:
+        entries = json.load(f)
+    previous = {}
+    start = 0
+    for entry in entries:
+        previous[(entry['sub_scene'], entry['frame'])] = dict(entry, start=start)
+        start += entry['count']
+    return previous
 
 
 def extract_frustum_data(path, split, output_filename, viz=False,
                          perturb_box2d=False, augmentX=1,
-                         type_whitelist=['Car']):
+                         type_whitelist=['Car'], workers=1, frames_per_job=100,
+                         output_format='store', pred_depth=False, force=False):
     ''' Extract point clouds and corresponding annotations in frustums
         defined generated from 2D bounding boxes
         Lidar points and 3d boxes are in *rect camera* coord system
         (as that in 3d box label files)
 
+        Every frame is fingerprinted by its inputs (see frame_fingerprint)
+        and <output>_<scene>.manifest.json records the fingerprint and the
+        number of frustums of every frame. A rerun skips scenes without
+        changed frames. Otherwise it only extracts the frames whose
+        fingerprint changed and splices them between the unchanged frustums
+        of the previous output, e.g. after new depth predictions. Previous
+        outputs are only spliced from memory-mapped stores: a previous pickle
+        is re-extracted in full, as reading it back would load it entirely.
+
+        Frames to extract are split into jobs of up to frames_per_job frames
+        of a sub-scene run over a pool of workers. Jobs stream their
+        frustums into shard stores and every frame seeds its own RNG, so the
+        output does not depend on the number of workers or on which frames
+        were recomputed. Memory stays flat in the number of frustums.
+
     Input:
-        idx_filename: string, each line of the file is a sample ID
-        split: string, either training or testing
-        output_filename: string, the name for output .pickle file
+        path: string, Virtual KITTI root directory
+        split: string, either train or val
+        output_filename: string, prefix of the output files
         viz: bool, whether to visualize extracted data
         perturb_box2d: bool, whether to perturb the box2d
             (used for data augmentation in train set)
         augmentX: scalar, how many augmentations to have for each 2D box.
         type_whitelist: a list of strings, object types we are interested in.
+        workers: int, number of worker processes
+        frames_per_job: int, number of frames of a sub-scene per job
+        output_format: string, 'pickle' or 'store' (see frustum_store)
+        pred_depth: bool, use the predicted instead of the ground truth depth maps
+        force: bool, extract all frames even if their fingerprint is unchanged
     Output:
-        None (will write a .pickle file to the disk)
+        None (will write a .pickle file or a .frustums store and a manifest
+        per scene to the disk)
     '''
     cam_idx = 0
+    kwargs = {'path': path, 'split': split, 'perturb_box2d': perturb_box2d,
+              'augmentX': augmentX, 'type_whitelist': type_whitelist,
+              'pred_depth': pred_depth}
+    shard_dir = output_filename + '_shards'
+    # drop the shards a crashed earlier run may have left behind
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
 
     for scene in scenes_dict[split]:
-        id_list = []  # identifier
-        box2d_list = []  # [xmin, ymin, xmax, ymax]
-        box3d_list = []  # (8,3) array in rect camera coord
-        input_list = []  # channel number = 4, xyz,intensity in rect camera coord
-        label_list = []  # 1 for roi object, 0 for clutter
-        type_list = []  # string e.g. Car
-        heading_list = []  # ry (along y-axis in rect camera coord) radius of
-        # (cont.) clockwise angle from positive x axis in velo coord.
-        box3d_size_list = []  # array of l,w,h
-        frustum_angle_list = []  # angle of 2d box center from pos x-axis
-        rejected = 0
-
+        scene_filename = "{}_{}".format(output_filename, scene)
+        manifest_filename = scene_filename + '.manifest.json'
+        previous = {}
+        if not force and frustums_exist(scene_filename) and os.path.isfile(manifest_filename):
+            previous = load_frame_manifest(manifest_filename)
+
+        # fingerprint every frame, in output order
+        frames = []
         for sub_scene in sub_scenes:
-            dataset = vkitti_object(path, split, scene, sub_scene)
-            pos_cnt = 0
-            all_cnt = 0
+            dataset = get_dataset(path, split, scene, sub_scene)
             for data_idx in range(len(dataset)):
-                idx = "{}/{}/{}".format(scene, sub_scene, data_idx)
-                print('------------- ', idx)
-
-                calib = dataset.get_calibration(data_idx, cam_idx) # 3 by 4 matrix
-                objects = dataset.get_label_objects(data_idx, cam_idx)
-                pc_velo = dataset.get_lidar(data_idx, cam_idx)
-                pc_rect = np.zeros_like(pc_velo)
-                pc_rect[:, 0:3] = calib.project_velo_to_rect(pc_velo[:, 0:3])
-                pc_rect[:,3] = pc_velo[:,3]
-                img = dataset.get_image(data_idx, cam_idx)
-                img_height, img_width, img_channel = img.shape
-                _, pc_image_coord, img_fov_inds = get_lidar_in_image_fov(pc_velo[:,0:3],
-                calib, 0, 0, img_width, img_height, True)
-
-                for obj_idx in range(len(objects)):
-                    if objects[obj_idx].type not in type_whitelist :continue
-
-                    # 2D BOX: Get pts rect backprojected
-                    box2d = objects[obj_idx].box2d
-                    for _ in range(augmentX):
-                        # Augment data by box2d perturbation
-                        if perturb_box2d:
-                            xmin, ymin, xmax, ymax = random_shift_box2d(box2d)
-                        else:
-                            xmin, ymin, xmax, ymax = box2d
-                        box_fov_inds = (pc_image_coord[:,0]<xmax) & \
-                            (pc_image_coord[:,0]>=xmin) & \
-                            (pc_image_coord[:,1]<ymax) & \
-                            (pc_image_coord[:,1]>=ymin)
-                        box_fov_inds = box_fov_inds & img_fov_inds
-                        pc_in_box_fov = pc_rect[box_fov_inds,:]
-                        # Get frustum angle (according to center pixel in 2D BOX)
-                        box2d_center = np.array([(xmin+xmax)/2.0, (ymin+ymax)/2.0])
-                        uvdepth = np.zeros((1,3))
-                        uvdepth[0,0:2] = box2d_center
-                        uvdepth[0,2] = 20 # some random depth
-                        box2d_center_rect = calib.project_image_to_rect(uvdepth)
-                        frustum_angle = -1 * np.arctan2(box2d_center_rect[0,2],
-                            box2d_center_rect[0,0])
-                        # 3D BOX: Get pts velo in 3d box
-                        obj = objects[obj_idx]
-                        box3d_pts_2d, box3d_pts_3d = utils.compute_box_3d(obj, calib.P)
-                        _,inds = extract_pc_in_box3d(pc_in_box_fov, box3d_pts_3d)
-                        label = np.zeros((pc_in_box_fov.shape[0]))
-                        label[inds] = 1
-                        # Get 3D BOX heading
-                        heading_angle = obj.ry
-                        # Get 3D BOX size
-                        box3d_size = np.array([obj.l, obj.w, obj.h])
-
-                        # Reject too far away object or object without points
-                        if ymax-ymin<25 or np.sum(label)==0:
-                            rejected += 1
-                            continue
-
-                        id_list.append(data_idx)
-                        box2d_list.append(np.array([xmin,ymin,xmax,ymax]))
-                        box3d_list.append(box3d_pts_3d)
-                        input_list.append(pc_in_box_fov)
-                        label_list.append(label)
-                        type_list.append(objects[obj_idx].type)
-                        heading_list.append(heading_angle)
-                        box3d_size_list.append(box3d_size)
-                        frustum_angle_list.append(frustum_angle)
-
-                        # collect statistics
-                        pos_cnt += np.sum(label)
-                        all_cnt += pc_in_box_fov.shape[0]
-
-        print("Number of boxes:{}, rejected:{}".format(len(input_list), rejected))
-        print('Average pos ratio: %f' % (pos_cnt / float(all_cnt)))
-        print('Average npoints: %f' % (float(all_cnt) / len(id_list)))
-
-        with open("{}_{}.pickle".format(output_filename, scene), 'wb') as fp:
-            pickle.dump(id_list, fp)
-            pickle.dump(box2d_list, fp)
-            pickle.dump(box3d_list, fp)
-            pickle.dump(input_list, fp)
-            pickle.dump(label_list, fp)
-            pickle.dump(type_list, fp)
-            pickle.dump(heading_list, fp)
-            pickle.dump(box3d_size_list, fp)
-            pickle.dump(frustum_angle_list, fp)
+                params = (perturb_box2d, augmentX, list(type_whitelist),
+                          frame_seed(scene, sub_scene, data_idx))
+                fingerprint = frame_fingerprint(dataset, data_idx, cam_idx, pred_depth, params)
+                frames.append((sub_scene, data_idx, fingerprint))
+
+        changed = defaultdict(list)
+        for sub_scene, data_idx, fingerprint in frames:
+            entry = previous.get((sub_scene, data_idx))
+            if entry is None or entry['fingerprint'] != fingerprint:
+                changed[sub_scene].append(data_idx)
+        output_suffix = STORE_SUFFIX if output_format == 'store' else '.pickle'
+        if previous and len(previous) == len(frames) and not any(changed.values()) \
+                and os.path.exists(scene_filename + output_suffix):
+            print("{} is up to date".format(scene_filename))
+            continue
+        if previous and not os.path.isdir(scene_filename + STORE_SUFFIX):
+            # reading unchanged frames back from a pickle would load the whole
+            # scene into memory, only stores are spliced
+            print("{}.pickle is not reused, extract with --output_format store "
+                  "to only extract changed frames on reruns".format(scene_filename))
+            previous = {}
+            changed = defaultdict(list)
+            for sub_scene, data_idx, _ in frames:
+                changed[sub_scene].append(data_idx)
+        jobs = []
+        for sub_scene in sub_scenes:
+            for start in range(0, len(changed[sub_scene]), frames_per_job):
+                job_frames = changed[sub_scene][start:start + frames_per_job]
+                shard_path = os.path.join(shard_dir, '{}_{}_{}.frustums'.format(
+                    scene, sub_scene, job_frames[0]))
+                jobs.append((scene, sub_scene, job_frames, shard_path, kwargs))
+
+        if workers > 1:
+            with Pool(workers) as pool:
+                job_stats = pool.map(_extract_frustum_job, jobs, chunksize=1)
+        else:
+            job_stats = [_extract_frustum_job(job) for job in jobs]
+
+        # (reader, first frustum, number of frustums) of every extracted frame
+        extracted = {}
+        for (_, sub_scene, job_frames, shard_path, _), stats in zip(jobs, job_stats):
+            reader = FrustumStoreReader(shard_path)
+            start = 0
+            for data_idx, count in zip(job_frames, stats['counts']):
+                extracted[(sub_scene, data_idx)] = (reader, start, count)
+                start += count
+        previous_reader = open_frustum_reader(scene_filename) if previous else None
+
+        # splice extracted and unchanged frames together in frame order
+        manifest = []
+        with open_frustum_writer(scene_filename + '.new', FRUSTUM_FIELDS, output_format) as writer:
+            for sub_scene, data_idx, fingerprint in frames:
+                if (sub_scene, data_idx) in extracted:
+                    reader, start, count = extracted[(sub_scene, data_idx)]
+                else:
+                    entry = previous[(sub_scene, data_idx)]
+                    reader, start, count = previous_reader, entry['start'], entry['count']
+                for i in range(start, start + count):
+                    writer.append(**reader.record(i))
+                manifest.append({'sub_scene': sub_scene, 'frame': data_idx,
+                                 'fingerprint': fingerprint, 'count': count})
+        replace_frustums(scene_filename + '.new', scene_filename)
+        with open(manifest_filename, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        for job in jobs:
+            shutil.rmtree(job[3])
+
+        num_extracted = sum(len(job[2]) for job in jobs)
+        rejected = sum(stats['rejected'] for stats in job_stats)
+        pos_cnt = sum(stats['pos_cnt'] for stats in job_stats)
+        all_cnt = sum(stats['all_cnt'] for stats in job_stats)
+
+        print("Number of boxes:{}, rejected:{}".format(writer.num_frustums, rejected))
+        print("Extracted {} frames, reused {} frames".format(
+            num_extracted, len(frames) - num_extracted))
+        if all_cnt > 0:
+            print('Average pos ratio: %f' % (pos_cnt / float(all_cnt)))
+            print('Average npoints: %f' % (float(all_cnt) / sum(sum(stats['counts'])
+                                                                 for stats in job_stats)))
+    shutil.rmtree(shard_dir, ignore_errors=True)
 
     if viz:
         import mayavi.mlab as mlab
+        frustums = load_frustums("{}_{}".format(output_filename, scene))
         for i in range(10):
-            p1 = input_list[i]
-            seg = label_list[i]
+            p1 = frustums['point_clouds'][i]
+            seg = frustums['mask_logits'][i]
             fig = mlab.figure(figure=None, bgcolor=(0.4, 0.4, 0.4),
                               fgcolor=None, engine=None, size=(500, 500))
             mlab.points3d(p1[:, 0], p1[:, 1], p1[:, 2], seg, mode='point',
@@ -314,6 +470,69 @@ def extract_frustum_data(path, split, output_filename, viz=False,
             raw_input()
 
 
+def extract_frame_data(path, split, output_filename, type_whitelist=['Car'], pred_depth=False):
+    ''' Store every frame once, for frustums cropped at training time
+        (frustum_pointnet/datasets/vkitti/frames.py) instead of extracted
+        augmentX times with frozen box2d perturbations.
+
+        <output>_<scene>_frames.frustums holds one record per frame: its image
+        FOV points in rect camera coord and their image coords, both sorted by
+        image row so that the points of a box are found by a binary search of
+        its rows, and the camera intrinsics (c_u, c_v, f_u, f_v, b_x, b_y) for
+        the frustum angle. <output>_<scene>_objects.frustums holds one record
+        per whitelisted object with the index of its frame record, its boxes,
+        class, heading and size. Objects rejected by extract_frustum_frames
+        (too small or without points) for their ground truth box are skipped.
+
+    Input:
+        path: string, Virtual KITTI root directory
+        split: string, either train or val
+        output_filename: string, prefix of the output stores
+        type_whitelist: a list of strings, object types we are interested in.
+        pred_depth: bool, use the predicted instead of the ground truth depth maps
+    Output:
+        None (will write two .frustums stores per scene to the disk)
+    '''
+    cam_idx = 0
+    for scene in scenes_dict[split]:
+        scene_filename = "{}_{}".format(output_filename, scene)
+        with FrustumStoreWriter(scene_filename + '_frames' + STORE_SUFFIX, FRAME_FIELDS) as frame_writer, \
+                FrustumStoreWriter(scene_filename + '_objects' + STORE_SUFFIX, OBJECT_FIELDS) as object_writer:
+            for sub_scene in sub_scenes:
+                dataset = get_dataset(path, split, scene, sub_scene)
+                for data_idx in range(len(dataset)):
+                    print('------------- ', "{}/{}/{}".format(scene, sub_scene, data_idx))
+                    calib = dataset.get_calibration(data_idx, cam_idx)
+                    objects = dataset.get_label_objects(data_idx, cam_idx)
+                    pc_rect, pc_image_coord, velo_x = dataset.get_rect_points(data_idx, cam_idx, pred_depth)
+                    img_width, img_height = dataset.get_image_size(data_idx, cam_idx)
+                    img_fov_inds = np.flatnonzero(get_rect_in_image_fov(pc_image_coord, velo_x,
+                        0, 0, img_width, img_height))
+                    order = img_fov_inds[np.argsort(pc_image_coord[img_fov_inds, 1], kind='stable')]
+                    points, points_2d = pc_rect[order], pc_image_coord[order]
+
+                    frame_index = frame_writer.num_frustums
+                    frame_writer.append(ids=data_idx, point_clouds=points, points_2d=points_2d,
+                                        calibs=[calib.c_u, calib.c_v, calib.f_u, calib.f_v, calib.b_x, calib.b_y])
+                    for obj in objects:
+                        if obj.type not in type_whitelist: continue
+                        xmin, ymin, xmax, ymax = obj.box2d
+                        box3d_pts_3d = utils.compute_box_3d(obj, calib.P)[1]
+                        box_fov_inds = box_util.points_in_sorted_box2d(points_2d, obj.box2d)
+                        if ymax-ymin<25 or not np.any(box_util.points_in_box3d(
+                                points[box_fov_inds, 0:3], box3d_pts_3d)):
+                            continue
+                        object_writer.append(ids=data_idx,
+                                             frame_indices=frame_index,
+                                             boxes_2d=obj.box2d,
+                                             boxes_3d=box3d_pts_3d,
+                                             class_names=obj.type,
+                                             heading_angles=obj.ry,
+                                             sizes=np.array([obj.l, obj.w, obj.h]))
+        print("Number of frames:{}, objects:{}".format(frame_writer.num_frustums,
+                                                      object_writer.num_frustums))
+
+
 def get_box3d_dim_statistics(path):
     ''' Collect and dump 3D bounding box statistics '''
     split = "train"
@@ -354,7 +573,8 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
                                        viz=False,
                                        type_whitelist=['Car'],
                                        img_height_threshold=25,
-                                       lidar_point_threshold=5):
+                                       lidar_point_threshold=5,
+                                       output_format='store'):
     ''' Extract point clouds in frustums extruded from 2D detection boxes.
         Update: Lidar points and 3d boxes are in *rect camera* coord system
             (as that in 3d box label files)
@@ -363,22 +583,18 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
         det_filename: string, each line is
             img_path typeid confidence xmin ymin xmax ymax
         split: string, either trianing or testing
-        output_filename: string, the name for output .pickle file
+        output_filename: string, the name of the output without extension
         type_whitelist: a list of strings, object types we are interested in.
         img_height_threshold: int, neglect image with height lower than that.
         lidar_point_threshold: int, neglect frustum with too few points.
+        output_format: string, 'pickle' or 'store' (see frustum_store)
     Output:
-        None (will write a .pickle file to the disk)
+        None (will write a .pickle file or a .frustums store to the disk)
     '''
     cache_id = -1
     cache = None
 
-    id_list = []
-    type_list = []
-    box2d_list = []
-    prob_list = []
-    input_list = [] # channel number = 4, xyz,intensity in rect camera coord
-    frustum_angle_list = [] # angle of 2d box center from pos x-axis
+    writer = open_frustum_writer(output_filename, RGB_DETECTION_FIELDS, output_format)
     r = 0
     cam_idx = 0
     tot_idx = 0
@@ -395,14 +611,11 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
                 print('------------- ', idx)
 
                 calib = dataset.get_calibration(data_idx, cam_idx) # 3 by 4 matrix
-                pc_velo = dataset.get_lidar(data_idx, cam_idx)
-                pc_rect = np.zeros_like(pc_velo)
-                pc_rect[:,0:3] = calib.project_velo_to_rect(pc_velo[:,0:3])
-                pc_rect[:,3] = pc_velo[:,3]
-                img = dataset.get_image(data_idx, cam_idx)
-                img_height, img_width, img_channel = img.shape
-                _, pc_image_coord, img_fov_inds = get_lidar_in_image_fov(
-                    pc_velo[:,0:3], calib, 0, 0, img_width, img_height, True)
+                pc_rect, pc_image_coord, velo_x = dataset.get_rect_points(data_idx, cam_idx)
+                img_width, img_height = dataset.get_image_size(data_idx, cam_idx)
+                img_fov_inds = get_rect_in_image_fov(pc_image_coord, velo_x,
+                    0, 0, img_width, img_height)
+                fov_index = ImageGridIndex(pc_image_coord, img_fov_inds)
 
                 objects = dataset.get_label_objects(data_idx, cam_idx)
                 gt_objects = []
@@ -412,11 +625,7 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
 
                     # 2D BOX: Get pts rect backprojected
                     xmin,ymin,xmax,ymax = objects[det_idx].box2d
-                    box_fov_inds = (pc_image_coord[:,0] < xmax) & \
-                        (pc_image_coord[:,0] >= xmin) & \
-                        (pc_image_coord[:,1] < ymax) & \
-                        (pc_image_coord[:,1] >= ymin)
-                    box_fov_inds = box_fov_inds & img_fov_inds
+                    box_fov_inds = fov_index.query(xmin, ymin, xmax, ymax)
                     pc_in_box_fov = pc_rect[box_fov_inds,:]
                     # Get frustum angle (according to center pixel in 2D BOX)
                     box2d_center = np.array([(xmin+xmax)/2.0, (ymin+ymax)/2.0])
@@ -432,23 +641,17 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
                         len(pc_in_box_fov)<lidar_point_threshold:
                         continue
 
-                    id_list.append(tot_idx)
-                    type_list.append(objects[det_idx].type)
-                    box2d_list.append(objects[det_idx].box2d)
-                    prob_list.append(1.0)
-                    input_list.append(pc_in_box_fov)
-                    frustum_angle_list.append(frustum_angle)
+                    writer.append(ids=tot_idx,
+                                  boxes_2d=objects[det_idx].box2d,
+                                  point_clouds=pc_in_box_fov,
+                                  class_names=objects[det_idx].type,
+                                  frustum_rotation_angles=frustum_angle,
+                                  probs=1.0)
                     gt_objects.append(objects[det_idx])
                 write_gt_file(val_folder, tot_idx, gt_objects)
                 tot_idx += 1
 
-    with open(output_filename,'wb') as fp:
-        pickle.dump(id_list, fp)
-        pickle.dump(box2d_list,fp)
-        pickle.dump(input_list, fp)
-        pickle.dump(type_list, fp)
-        pickle.dump(frustum_angle_list, fp)
-        pickle.dump(prob_list, fp)
+    writer.close()
 
     with open("val.txt", "w") as f:
         for i in range(tot_idx):
@@ -456,8 +659,9 @@ def extract_frustum_data_rgb_detection(path, split, output_filename,
 
     if viz:
         import mayavi.mlab as mlab
+        frustums = load_frustums(output_filename, RGB_DETECTION_FIELDS)
         for i in range(10):
-            p1 = input_list[i]
+            p1 = frustums['point_clouds'][i]
             fig = mlab.figure(figure=None, bgcolor=(0.4,0.4,0.4),
                 fgcolor=None, engine=None, size=(500, 500))
             mlab.points3d(p1[:,0], p1[:,1], p1[:,2], p1[:,1], mode='point',
@@ -484,6 +688,19 @@ if __name__ == '__main__':
                         help='Only generate cars; otherwise cars, peds and cycs')
     parser.add_argument('--stats', action='store_true',
                         help='generate 3d stats')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes for frustum extraction')
+    parser.add_argument('--frames_per_job', type=int, default=100,
+                        help='number of frames of a sub-scene per extraction job')
+    parser.add_argument('--output_format', type=str, default='store', choices=['pickle', 'store'],
+                        help='streamed columnar .frustums store, or legacy pickle '
+                             '(not constant-memory: its readers load it entirely)')
+    parser.add_argument('--pred_depth', action='store_true',
+                        help='extract frustums from the predicted depth maps')
+    parser.add_argument('--force', action='store_true',
+                        help='re-extract all frames, even those whose inputs did not change')
+    parser.add_argument('--gen_frames', action='store_true',
+                        help='Generate train and val split frame stores for on-the-fly frustum cropping')
     args = parser.parse_args()
 
     if args.test:
@@ -509,7 +726,10 @@ if __name__ == '__main__':
             'train',
             os.path.join(BASE_DIR, output_prefix + 'train'),
             viz=False, perturb_box2d=True, augmentX=5,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            workers=args.workers, frames_per_job=args.frames_per_job,
+            output_format=args.output_format, pred_depth=args.pred_depth,
+            force=args.force)
 
     if args.gen_val:
         extract_frustum_data(
@@ -517,12 +737,25 @@ if __name__ == '__main__':
             'val',
             os.path.join(BASE_DIR, output_prefix + 'val'),
             viz=False, perturb_box2d=False, augmentX=1,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            workers=args.workers, frames_per_job=args.frames_per_job,
+            output_format=args.output_format, pred_depth=args.pred_depth,
+            force=args.force)
+
+    if args.gen_frames:
+        for split in ['train', 'val']:
+            extract_frame_data(
+                args.path,
+                split,
+                os.path.join(BASE_DIR, output_prefix + split),
+                type_whitelist=type_whitelist,
+                pred_depth=args.pred_depth)
 
     if args.gen_val_rgb_detection:
         extract_frustum_data_rgb_detection(
             args.path,
             'val',
-            os.path.join(BASE_DIR, output_prefix+'val_rgb_detection.pickle'),
+            os.path.join(BASE_DIR, output_prefix+'val_rgb_detection'),
             viz=False,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            output_format=args.output_format)
@@ -0,0 +1,61 @@
+''' Image-plane grid index over the projected points of a frame.
+
+Selecting the points of a 2D box with a boolean mask over the whole cloud
+costs O(points) per box and per augmentation. ImageGridIndex buckets the
+points into cell_size x cell_size pixel cells once per frame, sorted in
+row-major cell order, so the cells of a box row are one contiguous slice.
+A box query only touches the points of the cells it overlaps.
+'''
+
+import numpy as np
+
+
+class ImageGridIndex(object):
+    ''' Grid of the image coordinates of a frame's points. '''
+
+    def __init__(self, pts_2d, valid=None, cell_size=32):
+        '''
+        :param pts_2d: nx2 image coordinates (u, v) of the points
+        :param valid: optional (n,) bool, only index these points (e.g. the image FOV)
+        :param cell_size: int, cell width and height in pixels
+        '''
+        inds = np.arange(len(pts_2d)) if valid is None else np.flatnonzero(valid)
+        u, v = pts_2d[inds, 0], pts_2d[inds, 1]
+        self.cell_size = float(cell_size)
+        if len(inds) == 0:
+            self.origin = np.zeros(2)
+            self.num_cols, self.num_rows = 1, 1
+            cols = rows = np.zeros(0, dtype=np.int64)
+        else:
+            self.origin = np.array([u.min(), v.min()])
+            cols = ((u - self.origin[0]) // self.cell_size).astype(np.int64)
+            rows = ((v - self.origin[1]) // self.cell_size).astype(np.int64)
+            self.num_cols, self.num_rows = int(cols.max()) + 1, int(rows.max()) + 1
+        cell_ids = rows * self.num_cols + cols
+        order = np.argsort(cell_ids, kind='stable')
+        self.inds = inds[order]
+        self.u = u[order]
+        self.v = v[order]
+        self.cell_offsets = np.searchsorted(cell_ids[order],
+                                            np.arange(self.num_rows * self.num_cols + 1))
+
+    def _cell_range(self, lo, hi, axis, num_cells):
+        first = int(np.floor((lo - self.origin[axis]) / self.cell_size))
+        last = int(np.floor((hi - self.origin[axis]) / self.cell_size))
+        return max(first, 0), min(last, num_cells - 1)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        ''' Indices, in increasing order, of the points with
+            xmin <= u < xmax and ymin <= v < ymax
+        '''
+        col0, col1 = self._cell_range(xmin, xmax, 0, self.num_cols)
+        row0, row1 = self._cell_range(ymin, ymax, 1, self.num_rows)
+        if col0 > col1 or row0 > row1:
+            return np.zeros(0, dtype=np.int64)
+        first_cells = np.arange(row0, row1 + 1) * self.num_cols + col0
+        starts = self.cell_offsets[first_cells]
+        stops = self.cell_offsets[first_cells + (col1 - col0 + 1)]
+        candidates = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+        u, v = self.u[candidates], self.v[candidates]
+        inside = (u < xmax) & (u >= xmin) & (v < ymax) & (v >= ymin)
+        return np.sort(self.inds[candidates[inside]])
@@ -0,0 +1,38 @@
+''' Image size lookup without decoding the image.
+
+The frustum and disparity generators only need the image size for their
+field of view filters. imagesize reads it from the PNG/JPEG header, and
+sequences whose frames all share one size (e.g. a Virtual KITTI camera) only
+probe the first image of their directory.
+'''
+
+import os
+
+import imagesize
+from PIL import Image
+
+_dir_sizes = {}
+
+
+def probe_image_size(img_filename):
+    ''' (width, height) read from the image header '''
+    width, height = imagesize.get(img_filename)
+    if width < 0 or height < 0:
+        # format unknown to imagesize, PIL also only parses the header on open
+        with Image.open(img_filename) as img:
+            width, height = img.size
+    return width, height
+
+
+def get_image_size(img_filename, uniform_dir=False):
+    ''' (width, height) of an image.
+        uniform_dir: bool, all images of the directory have the same size,
+                     which is probed once per process and cached
+    '''
+    if not uniform_dir:
+        return probe_image_size(img_filename)
+    image_dir = os.path.dirname(os.path.abspath(img_filename))
+    size = _dir_sizes.get(image_dir)
+    if size is None:
+        size = _dir_sizes[image_dir] = probe_image_size(img_filename)
+    return size
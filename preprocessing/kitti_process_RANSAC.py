@@ -1,55 +1,144 @@
 import argparse
 import os
+import zlib
+from multiprocessing import Pool
 
 import numpy as np
-from sklearn.linear_model import RANSACRegressor
 
 from . import kitti_util as utils
+from . import lidar_shard
 
 
-def extract_ransac(calib_dir, lidar_dir, planes_dir):
-    data_idx_list = [x[:-4] for x in os.listdir(lidar_dir) if x[-4:] == '.bin']
+def plane_from_samples(pts):
+    ''' Input: Kx3x3 array of K triplets of rect points.
+        Output: Kx3 coefficients (a, b, c) of the planes y = a*x + b*z + c
+                through each triplet and a K bool array of non-degenerate ones.
+    '''
+    normal = np.cross(pts[:, 1] - pts[:, 0], pts[:, 2] - pts[:, 0])
+    valid = np.abs(normal[:, 1]) > 1e-8
+    normal_y = np.where(valid, normal[:, 1], 1.0)
+    a = -normal[:, 0] / normal_y
+    b = -normal[:, 2] / normal_y
+    c = pts[:, 0, 1] - a * pts[:, 0, 0] - b * pts[:, 0, 2]
+    return np.stack([a, b, c], axis=1), valid
 
-    if not os.path.isdir(planes_dir):
-        os.makedirs(planes_dir)
 
-    for data_idx in data_idx_list:
+def fit_ground_plane(pc_rect, num_trials=100, residual_threshold=None,
+                     max_eval_points=4096, init_coef=None, rng=None):
+    ''' Vectorized RANSAC fit of y = a*x + b*z + c, scoring all hypotheses at
+        once. Mirrors sklearn's RANSACRegressor defaults: 3-point samples,
+        a residual threshold of the median absolute deviation of y, and a
+        least squares refit on the inliers of the best hypothesis.
+
+    Input:
+        pc_rect: nx3 points in rect camera coord
+        init_coef: optional (a, b, c) added as an extra hypothesis, e.g. the
+            plane of the previous frame of a sequence
+    Output:
+        (a, b, c)
+    '''
+    if rng is None:
+        rng = np.random.RandomState()
+    x = np.stack([pc_rect[:, 0], pc_rect[:, 2], np.ones(len(pc_rect))], axis=1)
+    y = pc_rect[:, 1]
+    if residual_threshold is None:
+        residual_threshold = np.median(np.abs(y - np.median(y)))
+
+    samples = rng.randint(len(pc_rect), size=(num_trials, 3))
+    coefs, valid = plane_from_samples(pc_rect[samples])
+    coefs = coefs[valid]
+    if init_coef is not None:
+        coefs = np.vstack([np.reshape(init_coef, (1, 3)), coefs])
+    if len(coefs) == 0:
+        return np.linalg.lstsq(x, y, rcond=None)[0]
+
+    # score the hypotheses on a random subset of the points
+    if len(pc_rect) > max_eval_points:
+        eval_inds = rng.choice(len(pc_rect), max_eval_points, replace=False)
+    else:
+        eval_inds = slice(None)
+    residuals = np.abs(y[eval_inds][np.newaxis, :] - np.dot(coefs, x[eval_inds].T))
+    best = np.argmax(np.sum(residuals <= residual_threshold, axis=1))
+
+    inliers = np.abs(y - np.dot(x, coefs[best])) <= residual_threshold
+    if np.sum(inliers) < 3:
+        return coefs[best]
+    return np.linalg.lstsq(x[inliers], y[inliers], rcond=None)[0]
+
+
+def extract_plane(calib, pc_velo, init_coef=None, rng=None):
+    ''' Ground plane of a frame as the unit normal w and offset h of the
+        plane file, plus the (a, b, c) coefficients for warm starts.
+    '''
+    pc_rect = calib.project_velo_to_rect(pc_velo[:, :3])
+    valid_loc = (pc_rect[:, 1] > 1.5) & \
+                (pc_rect[:, 1] < 1.86) & \
+                (pc_rect[:, 2] > 0) & \
+                (pc_rect[:, 2] < 40) & \
+                (pc_rect[:, 0] > -15) & \
+                (pc_rect[:, 0] < 15)
+    pc_rect = pc_rect[valid_loc]
+    if len(pc_rect) < 1:
+        return np.array([0, -1, 0]), 1.65, None
+    coef = fit_ground_plane(pc_rect, init_coef=init_coef, rng=rng)
+    w = np.array([coef[0], -1.0, coef[1]])
+    h = coef[2]
+    w = w / np.linalg.norm(w)
+    return w, h, coef
+
+
+def write_plane_file(planes_dir, data_idx, w, h):
+    lines = ['# Plane', 'Width 4', 'Height 1']
 
-        print('------------- ', data_idx)
+    plane_file = os.path.join(planes_dir, data_idx + '.txt')
+    result_lines = lines[:3]
+    result_lines.append("{:e} {:e} {:e} {:e}".format(w[0], w[1], w[2], h))
+    result_str = '\n'.join(result_lines)
+    with open(plane_file, 'w') as f:
+        f.write(result_str)
+
+
+def extract_ransac_frames(calib_dir, lidar_dir, planes_dir, data_idx_list, warm_start=False):
+    ''' Fit and write the planes of consecutive frames, optionally starting
+        each fit from the plane of the previous frame.
+    '''
+    coef = None
+    for data_idx in data_idx_list:
         calib = calib_dir + '/' + data_idx + '.txt'
-        calib = utils.Calibration(calib)
+        calib = utils.load_calibration(calib)
         pc_velo = lidar_dir + '/' + data_idx + '.bin'
-        pc_velo = np.fromfile(pc_velo, dtype=np.float32).reshape(-1, 4)
-        pc_rect = calib.project_velo_to_rect(pc_velo[:, :3])
-        valid_loc = (pc_rect[:, 1] > 1.5) & \
-                    (pc_rect[:, 1] < 1.86) & \
-                    (pc_rect[:, 2] > 0) & \
-                    (pc_rect[:, 2] < 40) & \
-                    (pc_rect[:, 0] > -15) & \
-                    (pc_rect[:, 0] < 15)
-        pc_rect = pc_rect[valid_loc]
-        if len(pc_rect) < 1:
-            w = [0, -1, 0]
-            h = 1.65
-        else:
-            reg = RANSACRegressor().fit(pc_rect[:, [0, 2]], pc_rect[:, 1])
-            w = np.zeros(3)
-            w[0] = reg.estimator_.coef_[0]
-            w[2] = reg.estimator_.coef_[1]
-            w[1] = -1.0
-            h = reg.estimator_.intercept_
-            w = w / np.linalg.norm(w)
-        print(w)
-        print(h)
-
-        lines = ['# Plane', 'Width 4', 'Height 1']
-
-        plane_file = os.path.join(planes_dir, data_idx + '.txt')
-        result_lines = lines[:3]
-        result_lines.append("{:e} {:e} {:e} {:e}".format(w[0], w[1], w[2], h))
-        result_str = '\n'.join(result_lines)
-        with open(plane_file, 'w') as f:
-            f.write(result_str)
+        pc_velo = lidar_shard.load_velo_scan(pc_velo)
+        rng = np.random.RandomState(zlib.crc32(data_idx.encode()))
+        w, h, coef = extract_plane(calib, pc_velo, coef if warm_start else None, rng)
+        write_plane_file(planes_dir, data_idx, w, h)
+    return len(data_idx_list)
+
+
+def _extract_ransac_frames_worker(args):
+    return extract_ransac_frames(*args)
+
+
+def extract_ransac(calib_dir, lidar_dir, planes_dir, workers=1, warm_start=False):
+    data_idx_list = lidar_shard.list_frames(lidar_dir)
+
+    if not os.path.isdir(planes_dir):
+        os.makedirs(planes_dir)
+
+    # contiguous chunks keep neighbouring frames of a sequence together
+    # so that warm starts still apply within each worker
+    chunk_size = 64
+    jobs = [(calib_dir, lidar_dir, planes_dir, data_idx_list[i:i + chunk_size], warm_start)
+            for i in range(0, len(data_idx_list), chunk_size)]
+    num_done = 0
+    if workers > 1:
+        with Pool(workers) as pool:
+            for num_frames in pool.imap_unordered(_extract_ransac_frames_worker, jobs):
+                num_done += num_frames
+                print('------------- {}/{}'.format(num_done, len(data_idx_list)))
+    else:
+        for job in jobs:
+            num_done += extract_ransac_frames(*job)
+            print('------------- {}/{}'.format(num_done, len(data_idx_list)))
 
 
 if __name__ == '__main__':
@@ -57,6 +146,11 @@ if __name__ == '__main__':
     parser.add_argument('--calib_dir', default='KITTI/object/training/calib')
     parser.add_argument('--lidar_dir', default='KITTI/object/training/velodyne')
     parser.add_argument('--planes_dir', default='KITTI/object/training/velodyne_planes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--warm_start', action='store_true',
+                        help='seed each fit with the plane of the previous frame (sequences)')
     args = parser.parse_args()
 
-    extract_ransac(args.calib_dir, args.lidar_dir, args.planes_dir)
+    extract_ransac(args.calib_dir, args.lidar_dir, args.planes_dir,
+                   args.workers, args.warm_start)
@@ -4,63 +4,30 @@ Author: Charles R. Qi
 Date: September 2017
 """
 
-import numpy as np
-
-
-class Calibration(object):
-    ''' Calibration matrices and utils
-        3d XYZ in <label>.txt are in rect camera coord.
-        2d box xy are in image2 coord
-        Points in <lidar>.bin are in Velodyne coord.
-
-        y_image2 = P^2_rect * x_rect
-        y_image2 = P^2_rect * R0_rect * Tr_velo_to_cam * x_velo
-        x_ref = Tr_velo_to_cam * x_velo
-        x_rect = R0_rect * x_ref
-
-        P^2_rect = [f^2_u,  0,      c^2_u,  -f^2_u b^2_x;
-                    0,      f^2_v,  c^2_v,  -f^2_v b^2_y;
-                    0,      0,      1,      0]
-                 = K * [1|t]
-
-        image2 coord:
-         ----> x-axis (u)
-        |
-        |
-        v y-axis (v)
+import os
+from collections import OrderedDict
+from functools import lru_cache
 
-        velodyne coord:
-        front x, left y, up z
+import numpy as np
 
-        rect/ref camera coord:
-        right x, down y, front z
+try:
+    from .calibration import (CameraCalibration, hom_mat, inverse_rigid_trans, rotate_points,
+                              transform_points, uv_to_hom)
+except ImportError:
+    # run as a script from preprocessing/ rather than as the preprocessing package
+    from calibration import (CameraCalibration, hom_mat, inverse_rigid_trans, rotate_points,
+                             transform_points, uv_to_hom)
 
-        Ref (KITTI paper): http://www.cvlibs.net/publications/Geiger2013IJRR.pdf
 
-        TODO(rqi): do matrix multiplication only once for each projection.
+class Calibration(CameraCalibration):
+    ''' KITTI calibration read from a calib/<idx>.txt file.
+        The projections are those of calibration.CameraCalibration with
+        P = P2, V2C = Tr_velo_to_cam and R0 = R0_rect.
     '''
 
     def __init__(self, calib_filepath):
-
         calibs = self.read_calib_file(calib_filepath)
-        # Projection matrix from rect camera coord to image2 coord
-        self.P = calibs['P2']
-        self.P = np.reshape(self.P, [3, 4])
-        # Rigid transform from Velodyne coord to reference camera coord
-        self.V2C = calibs['Tr_velo_to_cam']
-        self.V2C = np.reshape(self.V2C, [3, 4])
-        self.C2V = inverse_rigid_trans(self.V2C)
-        # Rotation from reference camera coord to rect camera coord
-        self.R0 = calibs['R0_rect']
-        self.R0 = np.reshape(self.R0, [3, 3])
-
-        # Camera intrinsics and extrinsics
-        self.c_u = self.P[0, 2]
-        self.c_v = self.P[1, 2]
-        self.f_u = self.P[0, 0]
-        self.f_v = self.P[1, 1]
-        self.b_x = self.P[0, 3] / (-self.f_u)  # relative
-        self.b_y = self.P[1, 3] / (-self.f_v)
+        super(Calibration, self).__init__(calibs['P2'], calibs['Tr_velo_to_cam'], calibs['R0_rect'])
 
     def read_calib_file(self, filepath):
         ''' Read in a calibration file and parse into a dictionary.
@@ -81,91 +48,79 @@ class Calibration(object):
 
         return data
 
-    def cart2hom(self, pts_3d):
-        ''' Input: nx3 points in Cartesian
-            Oupput: nx4 points in Homogeneous by pending 1
-        '''
-        n = pts_3d.shape[0]
-        pts_3d_hom = np.hstack((pts_3d, np.ones((n, 1))))
-        return pts_3d_hom
-
-    # =========================== 
-    # ------- 3d to 3d ---------- 
-    # =========================== 
-    def project_velo_to_ref(self, pts_3d_velo):
-        pts_3d_velo = self.cart2hom(pts_3d_velo)  # nx4
-        return np.dot(pts_3d_velo, np.transpose(self.V2C))
-
-    def project_ref_to_velo(self, pts_3d_ref):
-        pts_3d_ref = self.cart2hom(pts_3d_ref)  # nx4
-        return np.dot(pts_3d_ref, np.transpose(self.C2V))
-
-    def project_rect_to_ref(self, pts_3d_rect):
-        ''' Input and Output are nx3 points '''
-        return np.transpose(np.dot(np.linalg.inv(self.R0), np.transpose(pts_3d_rect)))
-
-    def project_ref_to_rect(self, pts_3d_ref):
-        ''' Input and Output are nx3 points '''
-        return np.transpose(np.dot(self.R0, np.transpose(pts_3d_ref)))
-
-    def project_rect_to_velo(self, pts_3d_rect):
-        ''' Input: nx3 points in rect camera coord.
-            Output: nx3 points in velodyne coord.
-        '''
-        pts_3d_ref = self.project_rect_to_ref(pts_3d_rect)
-        return self.project_ref_to_velo(pts_3d_ref)
-
-    def project_velo_to_rect(self, pts_3d_velo):
-        pts_3d_ref = self.project_velo_to_ref(pts_3d_velo)
-        return self.project_ref_to_rect(pts_3d_ref)
-
-    # =========================== 
-    # ------- 3d to 2d ---------- 
-    # =========================== 
-    def project_rect_to_image(self, pts_3d_rect):
-        ''' Input: nx3 points in rect camera coord.
-            Output: nx2 points in image2 coord.
-        '''
-        pts_3d_rect = self.cart2hom(pts_3d_rect)
-        pts_2d = np.dot(pts_3d_rect, np.transpose(self.P))  # nx3
-        pts_2d[:, 0] /= pts_2d[:, 2]
-        pts_2d[:, 1] /= pts_2d[:, 2]
-        return pts_2d[:, 0:2]
-
-    def project_velo_to_image(self, pts_3d_velo):
-        ''' Input: nx3 points in velodyne coord.
-            Output: nx2 points in image2 coord.
-        '''
-        pts_3d_rect = self.project_velo_to_rect(pts_3d_velo)
-        return self.project_rect_to_image(pts_3d_rect)
-
-    # =========================== 
-    # ------- 2d to 3d ---------- 
-    # =========================== 
-    def project_image_to_rect(self, uv_depth):
-        ''' Input: nx3 first two channels are uv, 3rd channel
-                   is depth in rect camera coord.
-            Output: nx3 points in rect camera coord.
+
+@lru_cache(maxsize=8192)
+def _load_calibration(calib_filepath, mtime):
+    return Calibration(calib_filepath)
+
+
+def load_calibration(calib_filepath):
+    ''' Process-wide memoized Calibration keyed by file path and mtime.
+        The returned object is shared between callers and must not be
+        modified in place.
+    '''
+    calib_filepath = os.path.abspath(calib_filepath)
+    return _load_calibration(calib_filepath, os.path.getmtime(calib_filepath))
+
+
+class RayTable(object):
+    ''' Per-pixel back-projection rays of a camera in velodyne coord.
+
+        A pixel (u, v) with rect depth d back-projects to
+            x_velo = d * directions[v, u] + offset
+        which folds project_image_to_rect and project_rect_to_velo into one
+        float32 multiply-add.
+    '''
+
+    def __init__(self, calib, shape):
+        rows, cols = shape
+        c, r = np.meshgrid(np.arange(cols), np.arange(rows))
+        # rect coord of every pixel at unit depth, minus the baseline offset
+        rays_rect = np.stack([(c - calib.c_u) / calib.f_u,
+                              (r - calib.c_v) / calib.f_v,
+                              np.ones((rows, cols))], axis=-1)
+        rect_to_velo = np.dot(calib.C2V[:, 0:3], np.linalg.inv(calib.R0))
+        self.directions = np.dot(rays_rect, np.transpose(rect_to_velo)).astype(np.float32)
+        self.offset = (np.dot(rect_to_velo, [calib.b_x, calib.b_y, 0]) +
+                       calib.C2V[:, 3]).astype(np.float32)
+
+    def project(self, depth, mask=None, step=1):
+        ''' Input: HxW depth map in rect camera coord, optional HxW bool mask
+                   of pixels to keep, and a pixel stride for subsampling.
+            Output: nx3 float32 points in velodyne coord, row-major order.
         '''
-        n = uv_depth.shape[0]
-        x = ((uv_depth[:, 0] - self.c_u) * uv_depth[:, 2]) / self.f_u + self.b_x
-        y = ((uv_depth[:, 1] - self.c_v) * uv_depth[:, 2]) / self.f_v + self.b_y
-        pts_3d_rect = np.zeros((n, 3))
-        pts_3d_rect[:, 0] = x
-        pts_3d_rect[:, 1] = y
-        pts_3d_rect[:, 2] = uv_depth[:, 2]
-        return pts_3d_rect
-
-    def project_image_to_velo(self, uv_depth):
-        pts_3d_rect = self.project_image_to_rect(uv_depth)
-        return self.project_rect_to_velo(pts_3d_rect)
-
-
-def inverse_rigid_trans(Tr):
-    ''' Inverse a rigid body transform matrix (3x4 as [R|t])
-        [R'|-R't; 0|1]
+        directions = self.directions[::step, ::step]
+        depth = depth[::step, ::step]
+        if mask is None:
+            directions = directions.reshape(-1, 3)
+            depth = depth.reshape(-1)
+        else:
+            mask = mask[::step, ::step]
+            directions = directions[mask]
+            depth = depth[mask]
+        cloud = directions * depth.astype(np.float32)[:, np.newaxis]
+        cloud += self.offset
+        return cloud
+
+
+_ray_tables = OrderedDict()
+_RAY_TABLE_CACHE_SIZE = 8
+
+
+def get_ray_table(calib, shape):
+    ''' Cached RayTable keyed by the calibration matrices and image shape.
+        Frames sharing a calibration (e.g. a KITTI recording day or a video
+        sequence) reuse the same table.
     '''
-    inv_Tr = np.zeros_like(Tr)  # 3x4
-    inv_Tr[0:3, 0:3] = np.transpose(Tr[0:3, 0:3])
-    inv_Tr[0:3, 3] = np.dot(-np.transpose(Tr[0:3, 0:3]), Tr[0:3, 3])
-    return inv_Tr
+    key = (np.asarray(calib.P, dtype=np.float64).tobytes(),
+           np.asarray(calib.R0, dtype=np.float64).tobytes(),
+           np.asarray(calib.C2V, dtype=np.float64).tobytes(), tuple(shape))
+    table = _ray_tables.get(key)
+    if table is None:
+        table = RayTable(calib, shape)
+        _ray_tables[key] = table
+        if len(_ray_tables) > _RAY_TABLE_CACHE_SIZE:
+            _ray_tables.popitem(last=False)
+    else:
+        _ray_tables.move_to_end(key)
+    return table
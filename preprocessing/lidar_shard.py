@@ -0,0 +1,219 @@
+''' Compact, memory-mapped shard format for (pseudo-)LiDAR scans.
+
+A shard stores many frames in two files:
+    <name>.data        all points of all frames, row-major, nxC
+    <name>.index.json  frame ids, row offsets, dtype, channels and scale
+
+xyz can be quantized to int16 with a per-shard scale (xyz = int16 * scale),
+the intensity with its own scale (intensity = int16 * intensity_scale), and
+the constant intensity column of pseudo-LiDAR can be dropped, so a point
+takes 6 bytes instead of 16. Frames are zero-copy views into a np.memmap of
+the data file.
+
+A directory of shards can stand in for a directory of <frame>.bin files:
+load_velo_scan('<dir>/<frame>.bin') reads the .bin if it exists and the
+frame from the shards in <dir> otherwise.
+
+Usage:
+    python lidar_shard.py --src_dir velodyne --dst_dir velodyne_shards \
+        --quantize --drop_intensity
+'''
+
+import argparse
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+INDEX_SUFFIX = '.index.json'
+DATA_SUFFIX = '.data'
+INT16_MAX = np.iinfo(np.int16).max
+
+
+class ShardWriter(object):
+    ''' Append frames to a shard and write its index on close. '''
+
+    def __init__(self, path, quantize=False, drop_intensity=False, max_range=128.0,
+                 max_intensity=1.0):
+        '''
+        :param path: shard path without suffix
+        :param quantize: bool, store xyz as int16 with scale max_range / 32767
+                         and intensity with scale max_intensity / 32767
+        :param drop_intensity: bool, only store xyz (intensity reads back as 1)
+        :param max_range: float, largest absolute coordinate (m) kept exactly,
+                          quantized coordinates beyond it are clipped
+        :param max_intensity: float, largest intensity kept exactly, quantized
+                              intensities beyond it are clipped
+        '''
+        self.path = path
+        self.dtype = np.int16 if quantize else np.float32
+        self.channels = 3 if drop_intensity else 4
+        self.scale = max_range / INT16_MAX if quantize else 1.0
+        self.intensity_scale = max_intensity / INT16_MAX if quantize else 1.0
+        self.scales = np.array([self.scale] * 3 + [self.intensity_scale])[0:self.channels]
+        self.frames = []
+        self.offsets = [0]
+        self.num_clipped = 0
+        self.fp = open(path + DATA_SUFFIX, 'wb')
+
+    def write(self, frame, points):
+        ''' points: nx4 (or nx3) float array in velodyne coord '''
+        points = points[:, 0:self.channels]
+        if self.dtype == np.int16:
+            points = np.round(points / self.scales)
+            clipped = np.abs(points) > INT16_MAX
+            self.num_clipped += int(clipped.any(axis=1).sum())
+            points = np.clip(points, -INT16_MAX, INT16_MAX)
+        np.ascontiguousarray(points, dtype=self.dtype).tofile(self.fp)
+        self.frames.append(frame)
+        self.offsets.append(self.offsets[-1] + len(points))
+
+    def close(self):
+        self.fp.close()
+        index = {'dtype': np.dtype(self.dtype).name, 'channels': self.channels,
+                 'scale': self.scale, 'intensity_scale': self.intensity_scale,
+                 'frames': self.frames, 'offsets': self.offsets}
+        with open(self.path + INDEX_SUFFIX, 'w') as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader(object):
+    ''' Memory-mapped read access to the frames of one shard. '''
+
+    def __init__(self, path):
+        with open(path + INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+        self.path = path
+        self.scale = index['scale']
+        # shards written without intensity_scale quantized intensity with scale
+        self.intensity_scale = index.get('intensity_scale', self.scale)
+        self.channels = index['channels']
+        self.frames = index['frames']
+        self.offsets = np.array(index['offsets'], dtype=np.int64)
+        self.frame_to_idx = {frame: i for i, frame in enumerate(self.frames)}
+        num_points = int(self.offsets[-1])
+        if num_points > 0:
+            self.data = np.memmap(path + DATA_SUFFIX, dtype=np.dtype(index['dtype']),
+                                  mode='r', shape=(num_points, self.channels))
+        else:
+            self.data = np.zeros((0, self.channels), dtype=np.dtype(index['dtype']))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame):
+        return frame in self.frame_to_idx
+
+    def get_raw(self, frame):
+        ''' Zero-copy nxC view of a frame, still quantized if the shard is '''
+        i = self.frame_to_idx[frame]
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def load(self, frame):
+        ''' nx4 float32 scan of a frame, as stored in a <frame>.bin file '''
+        raw = self.get_raw(frame)
+        scan = np.ones((len(raw), 4), dtype=np.float32)
+        scan[:, 0:self.channels] = raw
+        if self.scale != 1.0:
+            scan[:, 0:3] *= self.scale
+        if self.channels == 4 and self.intensity_scale != 1.0:
+            scan[:, 3] *= self.intensity_scale
+        return scan
+
+
+class ShardDirectory(object):
+    ''' All shards of a directory, addressed by frame id. '''
+
+    def __init__(self, shard_dir):
+        names = sorted(x[:-len(INDEX_SUFFIX)] for x in os.listdir(shard_dir)
+                       if x.endswith(INDEX_SUFFIX))
+        self.shards = [ShardReader(os.path.join(shard_dir, name)) for name in names]
+        self.frame_to_shard = {}
+        for shard in self.shards:
+            for frame in shard.frames:
+                self.frame_to_shard[frame] = shard
+
+    def __contains__(self, frame):
+        return frame in self.frame_to_shard
+
+    def frames(self):
+        return sorted(self.frame_to_shard)
+
+    def get_raw(self, frame):
+        return self.frame_to_shard[frame].get_raw(frame)
+
+    def load(self, frame):
+        return self.frame_to_shard[frame].load(frame)
+
+
+@lru_cache(maxsize=16)
+def open_shard_dir(shard_dir):
+    ''' Process-wide cached ShardDirectory '''
+    return ShardDirectory(shard_dir)
+
+
+def has_shards(lidar_dir):
+    return any(x.endswith(INDEX_SUFFIX) for x in os.listdir(lidar_dir))
+
+
+def list_frames(lidar_dir):
+    ''' Frame ids of the <frame>.bin files or the shards in lidar_dir '''
+    frames = [x[:-4] for x in os.listdir(lidar_dir) if x[-4:] == '.bin']
+    if len(frames) == 0 and has_shards(lidar_dir):
+        frames = open_shard_dir(os.path.abspath(lidar_dir)).frames()
+    return sorted(frames)
+
+
+def load_velo_scan(velo_filename):
+    ''' nx4 float32 scan from <dir>/<frame>.bin, falling back to the shards
+        in <dir> if there is no such file.
+    '''
+    if os.path.isfile(velo_filename):
+        scan = np.fromfile(velo_filename, dtype=np.float32)
+        return scan.reshape((-1, 4))
+    lidar_dir, filename = os.path.split(os.path.abspath(velo_filename))
+    return open_shard_dir(lidar_dir).load(os.path.splitext(filename)[0])
+
+
+def convert_to_shards(src_dir, dst_dir, shard_size=1000, quantize=False,
+                      drop_intensity=False, max_range=128.0, max_intensity=1.0):
+    ''' Pack the <frame>.bin files of src_dir into shards in dst_dir '''
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    frames = list_frames(src_dir)
+    for shard_idx, start in enumerate(range(0, len(frames), shard_size)):
+        shard_path = os.path.join(dst_dir, 'shard_{:05d}'.format(shard_idx))
+        with ShardWriter(shard_path, quantize, drop_intensity, max_range,
+                         max_intensity) as writer:
+            for frame in frames[start:start + shard_size]:
+                writer.write(frame, load_velo_scan(os.path.join(src_dir, frame + '.bin')))
+        print('Finish Shard {} ({} frames, {} clipped points)'.format(
+            shard_path, len(writer.frames), writer.num_clipped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack LiDAR scans into shards')
+    parser.add_argument('--src_dir', type=str, required=True)
+    parser.add_argument('--dst_dir', type=str, required=True)
+    parser.add_argument('--shard_size', type=int, default=1000,
+                        help='number of frames per shard')
+    parser.add_argument('--quantize', action='store_true',
+                        help='store xyz and intensity as int16')
+    parser.add_argument('--drop_intensity', action='store_true',
+                        help='do not store the intensity channel')
+    parser.add_argument('--max_range', type=float, default=128.0,
+                        help='largest absolute coordinate (m) of quantized shards')
+    parser.add_argument('--max_intensity', type=float, default=1.0,
+                        help='largest intensity of quantized shards')
+    args = parser.parse_args()
+
+    convert_to_shards(args.src_dir, args.dst_dir, args.shard_size,
+                      args.quantize, args.drop_intensity, args.max_range,
+                      args.max_intensity)
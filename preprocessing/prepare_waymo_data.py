@@ -18,6 +18,10 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 import waymo.waymo_util as utils
 import pickle
 from waymo.waymo_object import *
+import box_util
+from image_grid import ImageGridIndex
+from frustum_store import FRUSTUM_FIELDS, RGB_DETECTION_FIELDS, load_frustums, \
+    open_frustum_writer
 import argparse
 
 
@@ -30,7 +34,7 @@ def in_hull(p, hull):
 
 def extract_pc_in_box3d(pc, box3d):
     ''' pc: (N,3), box3d: (8,3) '''
-    box3d_roi_inds = in_hull(pc[:,0:3], box3d)
+    box3d_roi_inds = box_util.points_in_box3d(pc[:, 0:3], box3d)
     return pc[box3d_roi_inds,:], box3d_roi_inds
 
 
@@ -150,7 +154,8 @@ def random_shift_box2d(box2d, shift_ratio=0.1):
 
 
 def extract_frustum_data(idx_filename, split, output_filename, viz=False,
-                       perturb_box2d=False, augmentX=1, type_whitelist=['Car']):
+                       perturb_box2d=False, augmentX=1, type_whitelist=['Car'],
+                       output_format='store'):
     ''' Extract point clouds and corresponding annotations in frustums
         defined generated from 2D bounding boxes
         Lidar points and 3d boxes are in *rect camera* coord system
@@ -159,28 +164,21 @@ def extract_frustum_data(idx_filename, split, output_filename, viz=False,
     Input:
         idx_filename: string, each line of the file is a sample ID
         split: string, either training or testing
-        output_filename: string, the name for output .pickle file
+        output_filename: string, the name of the output without extension
         viz: bool, whether to visualize extracted data
         perturb_box2d: bool, whether to perturb the box2d
             (used for data augmentation in train set)
         augmentX: scalar, how many augmentations to have for each 2D box.
         type_whitelist: a list of strings, object types we are interested in.
+        output_format: string, 'pickle' or 'store' (see frustum_store)
     Output:
-        None (will write a .pickle file to the disk)
+        None (will write a .pickle file or a .frustums store to the disk)
     '''
     dataset = kitti_object(os.path.join(ROOT_DIR,'dataset/KITTI/object'), split)
     data_idx_list = [int(line.rstrip()) for line in open(idx_filename)]
 
-    id_list = [] # int number
-    box2d_list = [] # [xmin,ymin,xmax,ymax]
-    box3d_list = [] # (8,3) array in rect camera coord
-    input_list = [] # channel number = 4, xyz,intensity in rect camera coord
-    label_list = [] # 1 for roi object, 0 for clutter
-    type_list = [] # string e.g. Car
-    heading_list = [] # ry (along y-axis in rect camera coord) radius of
-    # (cont.) clockwise angle from positive x axis in velo coord.
-    box3d_size_list = [] # array of l,w,h
-    frustum_angle_list = [] # angle of 2d box center from pos x-axis
+    # frustums are streamed to disk as they are produced, see frustum_store
+    writer = open_frustum_writer(output_filename, FRUSTUM_FIELDS, output_format)
 
     pos_cnt = 0
     all_cnt = 0
@@ -192,10 +190,15 @@ def extract_frustum_data(idx_filename, split, output_filename, viz=False,
         pc_rect = np.zeros_like(pc_velo)
         pc_rect[:, 0:3] = calib.project_velo_to_rect(pc_velo[:, 0:3])
         pc_rect[:,3] = pc_velo[:,3]
-        img = dataset.get_image(data_idx)
-        img_height, img_width, img_channel = img.shape
+        img_width, img_height = dataset.get_image_size(data_idx)
         _, pc_image_coord, img_fov_inds = get_lidar_in_image_fov(pc_velo[:,0:3],
             calib, 0, 0, img_width, img_height, True)
+        fov_index = ImageGridIndex(pc_image_coord, img_fov_inds)
+
+        # 3D BOX: Get pts rect in every 3d box of the frame at once
+        box3d_pts_3d_list = [utils.compute_box_3d(obj, calib.P)[1] for obj in objects]
+        in_box3d = box_util.points_in_boxes3d(pc_rect[:, 0:3],
+            np.reshape(box3d_pts_3d_list, (-1, 8, 3)))
 
         for obj_idx in range(len(objects)):
             if objects[obj_idx].type not in type_whitelist :continue
@@ -210,11 +213,7 @@ def extract_frustum_data(idx_filename, split, output_filename, viz=False,
                     print(xmin, ymin, xmax, ymax)
                 else:
                     xmin, ymin, xmax, ymax = box2d
-                box_fov_inds = (pc_image_coord[:,0]<xmax) & \
-                    (pc_image_coord[:,0]>=xmin) & \
-                    (pc_image_coord[:,1]<ymax) & \
-                    (pc_image_coord[:,1]>=ymin)
-                box_fov_inds = box_fov_inds & img_fov_inds
+                box_fov_inds = fov_index.query(xmin, ymin, xmax, ymax)
                 pc_in_box_fov = pc_rect[box_fov_inds,:]
                 # Get frustum angle (according to center pixel in 2D BOX)
                 box2d_center = np.array([(xmin+xmax)/2.0, (ymin+ymax)/2.0])
@@ -226,10 +225,8 @@ def extract_frustum_data(idx_filename, split, output_filename, viz=False,
                     box2d_center_rect[0,0])
                 # 3D BOX: Get pts velo in 3d box
                 obj = objects[obj_idx]
-                box3d_pts_2d, box3d_pts_3d = utils.compute_box_3d(obj, calib.P)
-                _,inds = extract_pc_in_box3d(pc_in_box_fov, box3d_pts_3d)
-                label = np.zeros((pc_in_box_fov.shape[0]))
-                label[inds] = 1
+                box3d_pts_3d = box3d_pts_3d_list[obj_idx]
+                label = in_box3d[obj_idx][box_fov_inds].astype(np.float64)
                 # Get 3D BOX heading
                 heading_angle = obj.ry
                 # Get 3D BOX size
@@ -239,39 +236,32 @@ def extract_frustum_data(idx_filename, split, output_filename, viz=False,
                 if ymax-ymin<25 or np.sum(label)==0:
                     continue
 
-                id_list.append(data_idx)
-                box2d_list.append(np.array([xmin,ymin,xmax,ymax]))
-                box3d_list.append(box3d_pts_3d)
-                input_list.append(pc_in_box_fov)
-                label_list.append(label)
-                type_list.append(objects[obj_idx].type)
-                heading_list.append(heading_angle)
-                box3d_size_list.append(box3d_size)
-                frustum_angle_list.append(frustum_angle)
+                # heading: ry (along y-axis in rect camera coord) radius of
+                # clockwise angle from positive x axis in velo coord.
+                writer.append(ids=data_idx,
+                              boxes_2d=np.array([xmin,ymin,xmax,ymax]),
+                              boxes_3d=box3d_pts_3d,
+                              point_clouds=pc_in_box_fov,
+                              mask_logits=label,
+                              class_names=objects[obj_idx].type,
+                              heading_angles=heading_angle,
+                              sizes=box3d_size,
+                              frustum_rotation_angles=frustum_angle)
 
                 # collect statistics
                 pos_cnt += np.sum(label)
                 all_cnt += pc_in_box_fov.shape[0]
 
+    writer.close()
     print('Average pos ratio: %f' % (pos_cnt/float(all_cnt)))
-    print('Average npoints: %f' % (float(all_cnt)/len(id_list)))
-
-    with open(output_filename,'wb') as fp:
-        pickle.dump(id_list, fp)
-        pickle.dump(box2d_list,fp)
-        pickle.dump(box3d_list,fp)
-        pickle.dump(input_list, fp)
-        pickle.dump(label_list, fp)
-        pickle.dump(type_list, fp)
-        pickle.dump(heading_list, fp)
-        pickle.dump(box3d_size_list, fp)
-        pickle.dump(frustum_angle_list, fp)
+    print('Average npoints: %f' % (float(all_cnt)/writer.num_frustums))
 
     if viz:
         import mayavi.mlab as mlab
+        frustums = load_frustums(output_filename)
         for i in range(10):
-            p1 = input_list[i]
-            seg = label_list[i]
+            p1 = frustums['point_clouds'][i]
+            seg = frustums['mask_logits'][i]
             fig = mlab.figure(figure=None, bgcolor=(0.4,0.4,0.4),
                 fgcolor=None, engine=None, size=(500, 500))
             mlab.points3d(p1[:,0], p1[:,1], p1[:,2], seg, mode='point',
@@ -327,7 +317,8 @@ def extract_frustum_data_rgb_detection(det_filename, split, output_filename,
                                        viz=False,
                                        type_whitelist=['Car'],
                                        img_height_threshold=25,
-                                       lidar_point_threshold=5):
+                                       lidar_point_threshold=5,
+                                       output_format='store'):
     ''' Extract point clouds in frustums extruded from 2D detection boxes.
         Update: Lidar points and 3d boxes are in *rect camera* coord system
             (as that in 3d box label files)
@@ -336,12 +327,13 @@ def extract_frustum_data_rgb_detection(det_filename, split, output_filename,
         det_filename: string, each line is
             img_path typeid confidence xmin ymin xmax ymax
         split: string, either trianing or testing
-        output_filename: string, the name for output .pickle file
+        output_filename: string, the name of the output without extension
         type_whitelist: a list of strings, object types we are interested in.
         img_height_threshold: int, neglect image with height lower than that.
         lidar_point_threshold: int, neglect frustum with too few points.
+        output_format: string, 'pickle' or 'store' (see frustum_store)
     Output:
-        None (will write a .pickle file to the disk)
+        None (will write a .pickle file or a .frustums store to the disk)
     '''
     dataset = kitti_object(os.path.join(ROOT_DIR, 'dataset/KITTI/object'), split)
     det_id_list, det_type_list, det_box2d_list, det_prob_list = \
@@ -349,12 +341,7 @@ def extract_frustum_data_rgb_detection(det_filename, split, output_filename,
     cache_id = -1
     cache = None
 
-    id_list = []
-    type_list = []
-    box2d_list = []
-    prob_list = []
-    input_list = [] # channel number = 4, xyz,intensity in rect camera coord
-    frustum_angle_list = [] # angle of 2d box center from pos x-axis
+    writer = open_frustum_writer(output_filename, RGB_DETECTION_FIELDS, output_format)
 
     for det_idx in range(len(det_id_list)):
         data_idx = det_id_list[det_idx]
@@ -366,24 +353,20 @@ def extract_frustum_data_rgb_detection(det_filename, split, output_filename,
             pc_rect = np.zeros_like(pc_velo)
             pc_rect[:,0:3] = calib.project_velo_to_rect(pc_velo[:,0:3])
             pc_rect[:,3] = pc_velo[:,3]
-            img = dataset.get_image(data_idx)
-            img_height, img_width, img_channel = img.shape
+            img_width, img_height = dataset.get_image_size(data_idx)
             _, pc_image_coord, img_fov_inds = get_lidar_in_image_fov(
                 pc_velo[:,0:3], calib, 0, 0, img_width, img_height, True)
-            cache = [calib,pc_rect,pc_image_coord,img_fov_inds]
+            fov_index = ImageGridIndex(pc_image_coord, img_fov_inds)
+            cache = [calib,pc_rect,fov_index]
             cache_id = data_idx
         else:
-            calib,pc_rect,pc_image_coord,img_fov_inds = cache
+            calib,pc_rect,fov_index = cache
 
         if det_type_list[det_idx] not in type_whitelist: continue
 
         # 2D BOX: Get pts rect backprojected
         xmin,ymin,xmax,ymax = det_box2d_list[det_idx]
-        box_fov_inds = (pc_image_coord[:,0]<xmax) & \
-            (pc_image_coord[:,0]>=xmin) & \
-            (pc_image_coord[:,1]<ymax) & \
-            (pc_image_coord[:,1]>=ymin)
-        box_fov_inds = box_fov_inds & img_fov_inds
+        box_fov_inds = fov_index.query(xmin, ymin, xmax, ymax)
         pc_in_box_fov = pc_rect[box_fov_inds,:]
         # Get frustum angle (according to center pixel in 2D BOX)
         box2d_center = np.array([(xmin+xmax)/2.0, (ymin+ymax)/2.0])
@@ -399,25 +382,19 @@ def extract_frustum_data_rgb_detection(det_filename, split, output_filename,
             len(pc_in_box_fov)<lidar_point_threshold:
             continue
 
-        id_list.append(data_idx)
-        type_list.append(det_type_list[det_idx])
-        box2d_list.append(det_box2d_list[det_idx])
-        prob_list.append(det_prob_list[det_idx])
-        input_list.append(pc_in_box_fov)
-        frustum_angle_list.append(frustum_angle)
-
-    with open(output_filename,'wb') as fp:
-        pickle.dump(id_list, fp)
-        pickle.dump(box2d_list,fp)
-        pickle.dump(input_list, fp)
-        pickle.dump(type_list, fp)
-        pickle.dump(frustum_angle_list, fp)
-        pickle.dump(prob_list, fp)
+        writer.append(ids=data_idx,
+                      boxes_2d=det_box2d_list[det_idx],
+                      point_clouds=pc_in_box_fov,
+                      class_names=det_type_list[det_idx],
+                      frustum_rotation_angles=frustum_angle,
+                      probs=det_prob_list[det_idx])
+    writer.close()
 
     if viz:
         import mayavi.mlab as mlab
+        frustums = load_frustums(output_filename, RGB_DETECTION_FIELDS)
         for i in range(10):
-            p1 = input_list[i]
+            p1 = frustums['point_clouds'][i]
             fig = mlab.figure(figure=None, bgcolor=(0.4,0.4,0.4),
                 fgcolor=None, engine=None, size=(500, 500))
             mlab.points3d(p1[:,0], p1[:,1], p1[:,2], p1[:,1], mode='point',
@@ -478,6 +455,9 @@ if __name__=='__main__':
     parser.add_argument('--gen_val', action='store_true', help='Generate val split frustum data with GT 2D boxes')
     parser.add_argument('--gen_val_rgb_detection', action='store_true', help='Generate val split frustum data with RGB detection 2D boxes')
     parser.add_argument('--car_only', action='store_true', help='Only generate cars; otherwise cars, peds and cycs')
+    parser.add_argument('--output_format', type=str, default='store', choices=['pickle', 'store'],
+                        help='streamed columnar .frustums store, or legacy pickle '
+                             '(not constant-memory: its readers load it entirely)')
     args = parser.parse_args()
 
     test(path)
@@ -497,22 +477,25 @@ if __name__=='__main__':
         extract_frustum_data(
             os.path.join(BASE_DIR, 'image_sets/train.txt'),
             'train',
-            os.path.join(BASE_DIR, output_prefix+'train.pickle'),
+            os.path.join(BASE_DIR, output_prefix+'train'),
             viz=False, perturb_box2d=True, augmentX=5,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            output_format=args.output_format)
 
     if args.gen_val:
         extract_frustum_data(
             os.path.join(BASE_DIR, 'image_sets/val.txt'),
             'val',
-            os.path.join(BASE_DIR, output_prefix+'val.pickle'),
+            os.path.join(BASE_DIR, output_prefix+'val'),
             viz=False, perturb_box2d=False, augmentX=1,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            output_format=args.output_format)
 
     if args.gen_val_rgb_detection:
         extract_frustum_data_rgb_detection(
             os.path.join(BASE_DIR, 'rgb_detections/rgb_detection_val.txt'),
             'val',
-            os.path.join(BASE_DIR, output_prefix+'val_rgb_detection.pickle'),
+            os.path.join(BASE_DIR, output_prefix+'val_rgb_detection'),
             viz=False,
-            type_whitelist=type_whitelist)
+            type_whitelist=type_whitelist,
+            output_format=args.output_format)
@@ -0,0 +1,85 @@
+''' Point cloud sparsification for pseudo-LiDAR.
+
+Pseudo-LiDAR keeps every valid pixel of a depth map, about 10x the points of
+a real HDL-64 scan. These filters thin such clouds down. All of them take a
+nxC array whose first three channels are xyz in velodyne coord and return
+the kept rows in their original order.
+'''
+
+import numpy as np
+
+# Velodyne HDL-64E vertical field of view (degrees)
+HDL64_FOV_UP = 2.0
+HDL64_FOV_DOWN = -24.9
+
+
+def _first_per_cell(cell_ids, order=None):
+    ''' Indices of the first point of every cell, in original point order.
+        order: optional permutation deciding which point of a cell is first.
+    '''
+    if order is None:
+        order = np.arange(len(cell_ids))
+    _, first = np.unique(cell_ids[order], return_index=True)
+    return np.sort(order[first])
+
+
+def voxel_downsample(pc, voxel_size=0.1):
+    ''' Keep one point per voxel_size^3 voxel. '''
+    if len(pc) == 0:
+        return pc
+    voxels = np.floor(pc[:, 0:3] / voxel_size).astype(np.int64)
+    voxels -= voxels.min(axis=0)
+    dims = voxels.max(axis=0) + 1
+    cell_ids = np.ravel_multi_index(voxels.T, dims)
+    return pc[_first_per_cell(cell_ids)]
+
+
+def distance_subsample(pc, ref_distance=20.0, min_keep_ratio=0.1, seed=None):
+    ''' Randomly drop points closer than ref_distance.
+
+        A pixel covers an area growing with the squared distance, so near
+        points are denser than far ones. A point at range r is kept with
+        probability (r / ref_distance)^2, clipped to [min_keep_ratio, 1],
+        which evens out the density without touching the sparse far field.
+    '''
+    dist = np.sqrt(np.sum(pc[:, 0:3] ** 2, axis=1))
+    keep_prob = np.clip((dist / ref_distance) ** 2, min_keep_ratio, 1.0)
+    rng = np.random.RandomState(seed)
+    return pc[rng.random_sample(len(pc)) < keep_prob]
+
+
+def beam_downsample(pc, num_beams=64, azimuth_res=0.2,
+                    fov_up=HDL64_FOV_UP, fov_down=HDL64_FOV_DOWN):
+    ''' Simulate a spinning LiDAR: bin points by elevation into num_beams
+        beams spanning [fov_down, fov_up] and by azimuth into azimuth_res
+        degree steps, then keep the nearest point of every bin, i.e. the
+        first return of that laser. Points outside the vertical FOV are dropped.
+    '''
+    xy_dist = np.sqrt(pc[:, 0] ** 2 + pc[:, 1] ** 2)
+    elevation = np.degrees(np.arctan2(pc[:, 2], xy_dist))
+    azimuth = np.degrees(np.arctan2(pc[:, 1], pc[:, 0])) + 180.0
+    beam = np.floor((elevation - fov_down) / (fov_up - fov_down) * num_beams).astype(np.int64)
+    in_fov = (beam >= 0) & (beam < num_beams)
+    pc, beam, azimuth, xy_dist = pc[in_fov], beam[in_fov], azimuth[in_fov], xy_dist[in_fov]
+
+    num_columns = int(np.ceil(360.0 / azimuth_res))
+    column = np.minimum(np.floor(azimuth / azimuth_res).astype(np.int64), num_columns - 1)
+    cell_ids = beam * num_columns + column
+    dist = np.sqrt(xy_dist ** 2 + pc[:, 2] ** 2)
+    return pc[_first_per_cell(cell_ids, np.lexsort((dist, cell_ids)))]
+
+
+def sparsify(pc, mode, voxel_size=0.1, ref_distance=20.0, min_keep_ratio=0.1,
+             num_beams=64, azimuth_res=0.2, seed=None):
+    ''' Apply the sparsification named by mode ('none', 'voxel', 'distance'
+        or 'beam') with its density parameters.
+    '''
+    if mode == 'none':
+        return pc
+    elif mode == 'voxel':
+        return voxel_downsample(pc, voxel_size)
+    elif mode == 'distance':
+        return distance_subsample(pc, ref_distance, min_keep_ratio, seed)
+    elif mode == 'beam':
+        return beam_downsample(pc, num_beams, azimuth_res)
+    raise ValueError('Unknown sparsify mode: {}'.format(mode))
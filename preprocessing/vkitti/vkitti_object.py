@@ -7,6 +7,8 @@ from __future__ import print_function
 
 import os
 import sys
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 import cv2
@@ -21,6 +23,7 @@ scenes_dict = {"train": ["Scene01", "Scene02", "Scene06", "Scene18"],
 sub_scenes = ["15-deg-left", "30-deg-left", "15-deg-right", "30-deg-right",
               "clone", "morning", "rain", "fog", "overcast", "sunset"]
 MAX_DEPTH = 80
+CALIB_CACHE_SIZE = 64
 
 
 class vkitti_object(object):
@@ -43,70 +46,105 @@ class vkitti_object(object):
         self.intrinsic_file = os.path.join(self.sub_scene_dir, 'intrinsic.txt')
         self.extrinsic_file = os.path.join(self.sub_scene_dir, "extrinsic.txt")
 
-        self.intrinsics = [self._process_file(self.intrinsic_file, 0),
-                           self._process_file(self.intrinsic_file, 1)]
+        # per camera (num_frames, 3, 4) intrinsics/extrinsics and (num_frames, 3, 3) R0
+        intrinsics = pd.read_csv(self.intrinsic_file, sep=" ", header=0)
+        extrinsics = pd.read_csv(self.extrinsic_file, sep=" ", header=0)
+        self.intrinsics = [utils.intrinsics_table(self._camera_rows(intrinsics, cam_idx))
+                           for cam_idx in range(len(self.cameras))]
+        self.extrinsics = [utils.extrinsics_table(self._camera_rows(extrinsics, cam_idx))
+                           for cam_idx in range(len(self.cameras))]
+        self.R0 = [np.linalg.inv(table[:, :, 0:3]) for table in self.extrinsics]
+        self._calibrations = OrderedDict()
 
-        self.extrinsics = [self._process_file(self.extrinsic_file, 0),
-                           self._process_file(self.extrinsic_file, 1)]
+        path, dirs, files = next(
+            os.walk(os.path.join(self.image_dir, self.cameras[0])))
+        self.num_samples = len(files)
 
         self.label_file_2d = os.path.join(self.sub_scene_dir, 'bbox.txt')
         self.label_file_3d = os.path.join(self.sub_scene_dir, 'pose.txt')
         self.label_object_type = os.path.join(self.sub_scene_dir, 'info.txt')
-        self.labels = [self._get_label_data(0), self._get_label_data(1)]
-
-        path, dirs, files = next(
-            os.walk(os.path.join(self.image_dir, self.cameras[0])))
-        self.num_samples = len(files)
+        # per camera: label rows as a structured array sorted by frame and
+        # the row offsets of every frame, frame i is labels[offsets[i]:offsets[i + 1]]
+        self.labels, self.label_offsets = self._get_label_data()
 
     def __len__(self):
         return self.num_samples
 
     @staticmethod
-    def _process_file(file, cam_idx):
-        params = pd.read_csv(file, sep=" ", header=0)
+    def _camera_rows(params, cam_idx):
         return params[params["cameraID"] == cam_idx]
 
-    def get_image(self, idx, cam_idx):
+    def get_image_filename(self, idx, cam_idx):
         assert (idx < self.num_samples)
         image_dir = os.path.join(self.image_dir, self.cameras[cam_idx])
-        img_filename = os.path.join(image_dir, "rgb_{:05d}.jpg".format(idx))
-        return utils.load_image(img_filename)
+        return os.path.join(image_dir, "rgb_{:05d}.jpg".format(idx))
+
+    def get_image(self, idx, cam_idx):
+        return utils.load_image(self.get_image_filename(idx, cam_idx))
+
+    def get_image_size(self, idx, cam_idx):
+        """ (width, height) of a frame without decoding it """
+        return utils.load_image_size(self.get_image_filename(idx, cam_idx))
 
     def get_calibration(self, idx, cam_idx):
         assert (idx < self.num_samples)
-        return utils.Calibration(self.scene, self.sub_scene,
-                                 self.intrinsics[cam_idx].iloc[idx],
-                                 self.extrinsics[cam_idx].iloc[idx])
+        key = (idx, cam_idx)
+        calib = self._calibrations.get(key)
+        if calib is None:
+            calib = utils.Calibration(self.scene, self.sub_scene,
+                                      self.intrinsics[cam_idx][idx],
+                                      self.extrinsics[cam_idx][idx],
+                                      self.R0[cam_idx][idx])
+            self._calibrations[key] = calib
+            if len(self._calibrations) > CALIB_CACHE_SIZE:
+                self._calibrations.popitem(last=False)
+        else:
+            self._calibrations.move_to_end(key)
+        return calib
 
-    def get_label_objects(self, idx, cam_idx):
+    def get_label_records(self, idx, cam_idx):
+        """ Structured array view of the label rows of a frame """
         assert (idx < self.num_samples)
-        labels = self.labels[cam_idx]
-        label_data = labels[labels["frame"] == idx]
-        objects = [utils.Object3d(row) for idx, row in label_data.iterrows()]
-        return objects
+        offsets = self.label_offsets[cam_idx]
+        return self.labels[cam_idx][offsets[idx]:offsets[idx + 1]]
 
-    def get_depth_map(self, idx, cam_idx, pred):
+    def get_label_objects(self, idx, cam_idx):
+        return [utils.Object3d(row) for row in self.get_label_records(idx, cam_idx)]
+
+    def get_depth_filename(self, idx, cam_idx, pred):
         assert (idx < self.num_samples)
         depth_dir = os.path.join(self.depth_dir, self.cameras[cam_idx])
         if pred:
             depth_dir = depth_dir.replace("depth", "pred_depth")
-            filename = os.path.join(depth_dir, "depth_{:05d}.npy".format(idx))
+            return os.path.join(depth_dir, "depth_{:05d}.npy".format(idx))
+        return os.path.join(depth_dir, "depth_{:05d}.png".format(idx))
+
+    def get_depth_map(self, idx, cam_idx, pred):
+        filename = self.get_depth_filename(idx, cam_idx, pred)
+        if pred:
             depth = np.load(filename) * 655.36 / 255.
             return depth
         else:
-            filename = os.path.join(depth_dir, "depth_{:05d}.png".format(idx))
             return utils.load_depth(filename)
 
-    def _get_label_data(self, cam_idx):
+    def _get_label_data(self):
         bbox = pd.read_csv(self.label_file_2d, sep=" ", header=0)
         obj = pd.read_csv(self.label_file_3d, sep=" ", header=0)
-        data = pd.merge(bbox, obj, on=["frame", "cameraID", "trackID"],
-                        how="inner")
-        data = data[data["cameraID"] == cam_idx]
-
         info = pd.read_csv(self.label_object_type, sep=" ", header=0)
-        data = pd.merge(data, info, on="trackID")
-        return data
+        merged = pd.merge(bbox, obj, on=["frame", "cameraID", "trackID"],
+                          how="inner")
+
+        labels, label_offsets = [], []
+        for cam_idx in range(len(self.cameras)):
+            data = merged[merged["cameraID"] == cam_idx]
+            data = pd.merge(data, info, on="trackID")
+            # stable sort keeps the row order within each frame
+            data = data.sort_values("frame", kind="mergesort")
+            records = data.to_records(index=False)
+            labels.append(records)
+            label_offsets.append(np.searchsorted(records["frame"],
+                                                 np.arange(self.num_samples + 1)))
+        return labels, label_offsets
 
     def get_lidar(self, idx, cam_idx, pred=False):
         calib = self.get_calibration(idx, cam_idx)
@@ -115,6 +153,14 @@ class vkitti_object(object):
         velo = np.concatenate([velo, np.ones((velo.shape[0], 1))], 1)
         return velo
 
+    def get_rect_points(self, idx, cam_idx, pred=False):
+        """ The points of get_lidar directly in rect camera coord, see
+            project_depth_to_rect
+        """
+        calib = self.get_calibration(idx, cam_idx)
+        depth = self.get_depth_map(idx, cam_idx, pred)
+        return project_depth_to_rect(calib, depth)
+
 
 def project_depth_to_points(calib, depth, max_high=1.0):
     depth[depth > MAX_DEPTH] = MAX_DEPTH
@@ -132,6 +178,37 @@ def project_depth_to_points(calib, depth, max_high=1.0):
     return cloud[valid]
 
 
+def project_depth_to_rect(calib, depth, max_high=1.0):
+    ''' Back-project the same pixels as project_depth_to_points, but keep
+        them in rect camera coord next to their pixel coordinates instead of
+        going through velodyne coord and projecting them back.
+
+    Output:
+        pc_rect: nx4 float32 points in rect camera coord, intensity 1
+        pts_2d: nx2 float32 image coordinates (u, v) of the points
+        velo_x: (n,) forward distance of the points in velodyne coord
+    '''
+    depth = np.round(np.minimum(depth, MAX_DEPTH), 2)
+    rows, cols = np.nonzero(depth[::2, ::2] > 0)
+    rows, cols = rows * 2, cols * 2
+    z = depth[rows, cols].astype(np.float32)
+    u, v = cols.astype(np.float32), rows.astype(np.float32)
+
+    pc_rect = np.empty((len(z), 4), dtype=np.float32)
+    pc_rect[:, 0] = (u - np.float32(calib.c_u)) * z / np.float32(calib.f_u) + np.float32(calib.b_x)
+    pc_rect[:, 1] = (v - np.float32(calib.c_v)) * z / np.float32(calib.f_v) + np.float32(calib.b_y)
+    pc_rect[:, 2] = z
+    pc_rect[:, 3] = 1
+
+    # only the velodyne x and z rows are needed for the filters of project_depth_to_points
+    rect_to_velo_xz = np.dot(calib.C2V[[0, 2], 0:3], np.linalg.inv(calib.R0))
+    velo_xz = np.dot(pc_rect[:, 0:3], rect_to_velo_xz.T.astype(np.float32)) + \
+        calib.C2V[[0, 2], 3].astype(np.float32)
+    valid = (velo_xz[:, 0] >= 0) & (velo_xz[:, 1] < max_high)
+    pts_2d = np.stack([u[valid], v[valid]], axis=1)
+    return pc_rect[valid], pts_2d, velo_xz[valid, 0]
+
+
 def show_image_with_boxes(img, objects, calib, show3d=True):
     ''' Show image with 2D bounding boxes '''
     img1 = np.copy(img)  # for 2d bbox
@@ -147,6 +224,13 @@ def show_image_with_boxes(img, objects, calib, show3d=True):
         Image.fromarray(img2).show()
 
 
+def get_rect_in_image_fov(pts_2d, velo_x, xmin, ymin, xmax, ymax, clip_distance=2.0):
+    ''' FOV mask of get_lidar_in_image_fov for the output of project_depth_to_rect '''
+    fov_inds = (pts_2d[:, 0] < xmax) & (pts_2d[:, 0] >= xmin) & \
+               (pts_2d[:, 1] < ymax) & (pts_2d[:, 1] >= ymin)
+    return fov_inds & (velo_x > clip_distance)
+
+
 def get_lidar_in_image_fov(pc_velo, calib, xmin, ymin, xmax, ymax,
                            return_more=False, clip_distance=2.0):
     ''' Filter lidar points, keep those in image FOV '''
@@ -5,11 +5,17 @@ Date: February 2020
 """
 from __future__ import print_function
 
+from functools import lru_cache
+
 import numpy as np
 import cv2
 
 from PIL import Image
 
+from calibration import CameraCalibration, inverse_rigid_trans
+import image_util
+import lidar_shard
+
 transform_mat = {"Scene01": {"15-deg-left": -6/12.0, "30-deg-left":-5/12.0,
                              "15-deg-right":-8/12.0, "30-deg-right":-9/12.0,
                              "clone":-7/12.0, "morning":-7/12.0, "rain":-7/12.0,
@@ -75,63 +81,31 @@ class Object3d(object):
               (self.t[0], self.t[1], self.t[2], self.ry))
 
 
-class Calibration(object):
-    """ Calibration matrices and utils
-        3d XYZ in <label>.txt are in rect camera coord.
-        2d box xy are in image2 coord
-        Points in <lidar>.bin are in Velodyne coord.
-
-        y_image2 = P^2_rect * x_rect
-        y_image2 = P^2_rect * R0_rect * Tr_velo_to_cam * x_velo
-        x_ref = Tr_velo_to_cam * x_velo
-        x_rect = R0_rect * x_ref
-
-        P^2_rect = [f^2_u,  0,      c^2_u,  -f^2_u b^2_x;
-                    0,      f^2_v,  c^2_v,  -f^2_v b^2_y;
-                    0,      0,      1,      0]
-                 = K * [1|t]
-
-        image2 coord:
-         ----> x-axis (u)
-        |
-        |
-        v y-axis (v)
-
-        velodyne coord:
-        front x, left y, up z
-
-        rect/ref camera coord:
-        right x, down y, front z
+class Calibration(CameraCalibration):
+    """ Virtual KITTI calibration of one frame.
+        The camera matrix of the frame is P, the rect camera coord is the
+        world-aligned camera coord (R0 = inverse extrinsic rotation) and the
+        virtual velodyne is fixed per sub-scene. The projections are those of
+        calibration.CameraCalibration.
     """
 
-    def __init__(self, scene, subscene, intrinsic_values, extrinsic_values):
-        # Projection matrix from rect camera coord to image2 coord
-        self.P = self.process_intrinsic(intrinsic_values)
-
-        # Rotation from reference camera coord to rect camera coord
-        self.extrinsics = self.process_extrinsic(extrinsic_values)
-        self.R0 = np.linalg.inv(self.extrinsics[:3, :3])
-        # R0= "9.999239000000e-01 9.837760000000e-03 -7.445048000000e-03 -9.869795000000e-03 9.999421000000e-01 -4.278459000000e-03 7.402527000000e-03 4.351614000000e-03 9.999631000000e-01"
-        # self.R0 = np.reshape(np.array([float(x) for x in R0.split()]), [3,3])
-
-        # transform = {"Scene01": -np.pi / 2.0, "Scene02": np.pi/4.0}
-        velo = "7.533745000000e-03 -9.999714000000e-01 -6.166020000000e-04 -4.069766000000e-03 1.480249000000e-02 7.280733000000e-04 -9.998902000000e-01 -7.631618000000e-02 9.998621000000e-01 7.523790000000e-03 1.480755000000e-02 -2.717806000000e-01"
-
-        self.V2C = np.array([float(x) for x in velo.split()])
-        self.V2C = np.reshape(self.V2C, [3,4])
-        self.C2V = inverse_rigid_trans(self.V2C)
-        angle = transform_mat[scene][subscene] * np.pi # morning
-        self.C2V = np.dot(rotz(angle), inverse_rigid_trans(self.V2C))
-        self.V2C = inverse_rigid_trans(self.C2V)
-
-
-        # Camera intrinsics and extrinsics
-        self.c_u = self.P[0, 2]
-        self.c_v = self.P[1, 2]
-        self.f_u = self.P[0, 0]
-        self.f_v = self.P[1, 1]
-        self.b_x = self.P[0, 3] / (-self.f_u)  # relative
-        self.b_y = self.P[1, 3] / (-self.f_v)
+    def __init__(self, scene, subscene, P, extrinsics, R0=None):
+        """
+        :param P: 3x4 camera intrinsics of the frame
+        :param extrinsics: 3x4 (or 4x4) world to camera transform of the frame
+        :param R0: optional precomputed inverse of extrinsics[:3, :3]
+        """
+        self.extrinsics = extrinsics
+        if R0 is None:
+            R0 = np.linalg.inv(extrinsics[:3, :3])
+        V2C, C2V = velo_to_cam(scene, subscene)
+        super(Calibration, self).__init__(P, V2C, R0, C2V=C2V, R0_inv=extrinsics[:3, :3])
+
+    @classmethod
+    def from_values(cls, scene, subscene, intrinsic_values, extrinsic_values):
+        """ Calibration from one row of intrinsic.txt and extrinsic.txt """
+        return cls(scene, subscene, cls.process_intrinsic(intrinsic_values),
+                   cls.process_extrinsic(extrinsic_values))
 
     @staticmethod
     def process_intrinsic(intrinsic_values):
@@ -148,86 +122,39 @@ class Calibration(object):
         extrinsics = np.array(list(extrinsic_values)[2:]).reshape((4, 4))
         return extrinsics
 
-    def cart2hom(self, pts_3d):
-        ''' Input: nx3 points in Cartesian
-            Oupput: nx4 points in Homogeneous by pending 1
-        '''
-        n = pts_3d.shape[0]
-        pts_3d_hom = np.hstack((pts_3d, np.ones((n,1))))
-        return pts_3d_hom
-
-    # ===========================
-    # ------- 3d to 3d ----------
-    # ===========================
-    def project_velo_to_ref(self, pts_3d_velo):
-        pts_3d_velo = self.cart2hom(pts_3d_velo) # nx4
-        return np.dot(pts_3d_velo, np.transpose(self.V2C))
-
-    def project_ref_to_velo(self, pts_3d_ref):
-        pts_3d_ref = self.cart2hom(pts_3d_ref) # nx4
-        temp = np.dot(pts_3d_ref, np.transpose(self.C2V))
-        # temp[:,0], temp[:, 1] = temp[:, 1], temp[:, 0]
-        return temp
-
-    def project_rect_to_ref(self, pts_3d_rect):
-        ''' Input and Output are nx3 points '''
-        return np.transpose(np.dot(np.linalg.inv(self.R0), np.transpose(pts_3d_rect)))
-
-    def project_ref_to_rect(self, pts_3d_ref):
-        ''' Input and Output are nx3 points '''
-        return np.transpose(np.dot(self.R0, np.transpose(pts_3d_ref)))
-
-    def project_rect_to_velo(self, pts_3d_rect):
-        ''' Input: nx3 points in rect camera coord.
-            Output: nx3 points in velodyne coord.
-        '''
-        pts_3d_ref = self.project_rect_to_ref(pts_3d_rect)
-        return self.project_ref_to_velo(pts_3d_ref)
-
-    def project_velo_to_rect(self, pts_3d_velo):
-        pts_3d_ref = self.project_velo_to_ref(pts_3d_velo)
-        return self.project_ref_to_rect(pts_3d_ref)
-
-    # ===========================
-    # ------- 3d to 2d ----------
-    # ===========================
-    def project_rect_to_image(self, pts_3d_rect):
-        ''' Input: nx3 points in rect camera coord.
-            Output: nx2 points in image2 coord.
-        '''
-        pts_3d_rect = self.cart2hom(pts_3d_rect)
-        pts_2d = np.dot(pts_3d_rect, np.transpose(self.P)) # nx3
-        pts_2d[:,0] /= pts_2d[:,2]
-        pts_2d[:,1] /= pts_2d[:,2]
-        return pts_2d[:,0:2]
-
-    def project_velo_to_image(self, pts_3d_velo):
-        ''' Input: nx3 points in velodyne coord.
-            Output: nx2 points in image2 coord.
-        '''
-        pts_3d_rect = self.project_velo_to_rect(pts_3d_velo)
-        return self.project_rect_to_image(pts_3d_rect)
-
-    # ===========================
-    # ------- 2d to 3d ----------
-    # ===========================
-    def project_image_to_rect(self, uv_depth):
-        ''' Input: nx3 first two channels are uv, 3rd channel
-                   is depth in rect camera coord.
-            Output: nx3 points in rect camera coord.
-        '''
-        n = uv_depth.shape[0]
-        x = ((uv_depth[:,0]-self.c_u)*uv_depth[:,2])/self.f_u + self.b_x
-        y = ((uv_depth[:,1]-self.c_v)*uv_depth[:,2])/self.f_v + self.b_y
-        pts_3d_rect = np.zeros((n,3))
-        pts_3d_rect[:,0] = x
-        pts_3d_rect[:,1] = y
-        pts_3d_rect[:,2] = uv_depth[:,2]
-        return pts_3d_rect
-
-    def project_image_to_velo(self, uv_depth):
-        pts_3d_rect = self.project_image_to_rect(uv_depth)
-        return self.project_rect_to_velo(pts_3d_rect)
+
+@lru_cache(maxsize=None)
+def velo_to_cam(scene, subscene):
+    """ Rigid transforms between the virtual velodyne and the camera of a
+        sub-scene as read-only (V2C, C2V), shared by all its frames.
+    """
+    # transform = {"Scene01": -np.pi / 2.0, "Scene02": np.pi/4.0}
+    velo = "7.533745000000e-03 -9.999714000000e-01 -6.166020000000e-04 -4.069766000000e-03 1.480249000000e-02 7.280733000000e-04 -9.998902000000e-01 -7.631618000000e-02 9.998621000000e-01 7.523790000000e-03 1.480755000000e-02 -2.717806000000e-01"
+
+    V2C = np.array([float(x) for x in velo.split()])
+    V2C = np.reshape(V2C, [3, 4])
+    angle = transform_mat[scene][subscene] * np.pi # morning
+    C2V = np.dot(rotz(angle), inverse_rigid_trans(V2C))
+    V2C = inverse_rigid_trans(C2V)
+    V2C.flags.writeable = False
+    C2V.flags.writeable = False
+    return V2C, C2V
+
+
+def intrinsics_table(intrinsics):
+    """ (num_frames, 3, 4) camera matrices from the rows of intrinsic.txt """
+    K = np.zeros((len(intrinsics), 3, 4))
+    K[:, 0, 0] = intrinsics["K[0,0]"].values
+    K[:, 1, 1] = intrinsics["K[1,1]"].values
+    K[:, 1, 2] = intrinsics["K[1,2]"].values
+    K[:, 0, 2] = intrinsics["K[0,2]"].values
+    K[:, 2, 2] = 1
+    return K
+
+
+def extrinsics_table(extrinsics):
+    """ (num_frames, 3, 4) world to camera transforms from the rows of extrinsic.txt """
+    return extrinsics.values[:, 2:].astype(np.float64).reshape((-1, 4, 4))[:, 0:3, :]
 
 
 def rotx(t):
@@ -264,16 +191,6 @@ def transform_from_rot_trans(R, t):
     return np.vstack((np.hstack([R, t]), [0, 0, 0, 1]))
 
 
-def inverse_rigid_trans(Tr):
-    """ Inverse a rigid body transform matrix (3x4 as [R|t])
-        [R'|-R't; 0|1]
-    """
-    inv_Tr = np.zeros_like(Tr)  # 3x4
-    inv_Tr[0:3, 0:3] = np.transpose(Tr[0:3, 0:3])
-    inv_Tr[0:3, 3] = np.dot(-np.transpose(Tr[0:3, 0:3]), Tr[0:3, 3])
-    return inv_Tr
-
-
 def load_depth(depth_filename):
     return np.array(Image.open(depth_filename)).astype(
         np.float64) / 100.0  # convert to meters
@@ -283,10 +200,13 @@ def load_image(img_filename):
     return cv2.imread(img_filename)
 
 
+def load_image_size(img_filename):
+    ''' (width, height) from the image header, all frames of a camera share it '''
+    return image_util.get_image_size(img_filename, uniform_dir=True)
+
+
 def load_velo_scan(velo_filename):
-    scan = np.fromfile(velo_filename, dtype=np.float32)
-    scan = scan.reshape((-1, 4))
-    return scan
+    return lidar_shard.load_velo_scan(velo_filename)
 
 
 def project_to_image(pts_3d, P):
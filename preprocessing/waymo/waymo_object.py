@@ -46,6 +46,12 @@ class WaymoObject(object):
         img_filename = os.path.join(self.image_dir, '%06d.jpg'%(idx))
         return utils.load_image(img_filename)
 
+    def get_image_size(self, idx):
+        ''' (width, height) of an image without decoding it '''
+        assert(idx<self.num_samples)
+        img_filename = os.path.join(self.image_dir, '%06d.jpg'%(idx))
+        return utils.load_image_size(img_filename)
+
     def get_lidar(self, idx): 
         assert(idx<self.num_samples) 
         lidar_filename = os.path.join(self.lidar_dir, '%06d.bin'%(idx))
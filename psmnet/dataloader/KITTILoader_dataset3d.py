@@ -21,8 +21,40 @@ def default_loader(path):
     return Image.open(path).convert('RGB')
 
 
-def disparity_loader(path):
-    return np.load(path).astype(np.float32)
+def disparity_loader(path, window=None):
+    """
+    Load a disparity map written by preprocessing/generate_disp.py
+    :param path: .npy (dense), .png (uint16 x256) or .npz (coo) file
+    :param window: optional (top, left, height, width) crop, only this part is densified
+    :return: float32 disparity map, empty pixels are <= 0
+    """
+    if window is None:
+        top, left, height, width = 0, 0, None, None
+    else:
+        top, left, height, width = window
+
+    if path.endswith('.npz'):
+        coo = np.load(path)
+        rows, cols, values = coo['rows'].astype(np.int64), coo['cols'].astype(np.int64), coo['values']
+        if window is None:
+            height, width = coo['shape']
+        else:
+            sel = (rows >= top) & (rows < top + height) & (cols >= left) & (cols < left + width)
+            rows, cols, values = rows[sel], cols[sel], values[sel]
+        disp = np.zeros((height, width), dtype=np.float32)
+        disp[rows - top, cols - left] = values
+        return disp
+
+    if path.endswith('.png'):
+        disp = np.array(Image.open(path))
+    else:
+        # only the pages of the window are read
+        disp = np.load(path, mmap_mode='r')
+    if window is not None:
+        disp = disp[top:top + height, left:left + width]
+    if path.endswith('.png'):
+        return disp.astype(np.float32) / 256.
+    return disp.astype(np.float32)
 
 
 class myImageFloder(data.Dataset):
@@ -42,7 +74,6 @@ class myImageFloder(data.Dataset):
 
         left_img = self.loader(left)
         right_img = self.loader(right)
-        dataL = self.dploader(disp_L)
 
         if self.training:
             w, h = left_img.size
@@ -54,7 +85,7 @@ class myImageFloder(data.Dataset):
             left_img = left_img.crop((x1, y1, x1 + tw, y1 + th))
             right_img = right_img.crop((x1, y1, x1 + tw, y1 + th))
 
-            dataL = dataL[y1:y1 + th, x1:x1 + tw]
+            dataL = self.dploader(disp_L, (y1, x1, th, tw))
 
             processed = preprocess.get_transform(augment=False)
             left_img = processed(left_img)
@@ -70,7 +101,7 @@ class myImageFloder(data.Dataset):
             w1, h1 = left_img.size
 
             # dataL1 = dataL[h - 368:h, w - 1232:w]
-            dataL = dataL[h - 352:h, w - 1200:w]
+            dataL = self.dploader(disp_L, (h - 352, w - 1200, 352, 1200))
 
             processed = preprocess.get_transform(augment=False)
             left_img = processed(left_img)
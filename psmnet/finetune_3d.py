@@ -41,6 +41,8 @@ parser.add_argument('--lr_scale', type=int, default=200, metavar='S',
                     help='random seed (default: 1)')
 parser.add_argument('--split_file', default='Kitti/object/train.txt',
                     help='save model')
+parser.add_argument('--disp_ext', default='.npy', choices=['.npy', '.png', '.npz'],
+                    help='extension of the disparity ground truth files')
 parser.add_argument('--btrain', type=int, default=4)
 parser.add_argument('--start_epoch', type=int, default=1)
 
@@ -56,7 +58,8 @@ print(os.path.join(args.savemodel, 'training.log'))
 log = logger.setup_logger(os.path.join(args.savemodel, 'training.log'))
 
 all_left_img, all_right_img, all_left_disp, = ls.dataloader(args.datapath,
-                                                            args.split_file)
+                                                            args.split_file,
+                                                            args.disp_ext)
 
 TrainImgLoader = torch.utils.data.DataLoader(
     DA.myImageFloder(all_left_img, all_right_img, all_left_disp, True),